@@ -1,35 +1,122 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file
+from flask import Flask, render_template, request, redirect, url_for, send_file, jsonify, g, Response
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import inch
-from reportlab.lib.utils import ImageReader
-from PIL import Image, ImageDraw, ImageFont
-import barcode
-from barcode.writer import ImageWriter
-from io import BytesIO
+from datetime import date, timedelta
+from functools import cache
+from tempfile import SpooledTemporaryFile
+from typing import Any, BinaryIO, Callable, Iterator
+import hashlib
 import os
+import time
 
-from src.data_handling import MealDB, PantryDirectoryDB, PantryDB
+from src import metrics
+from src.allocators import make_allocator
+from src.bulk_io import FORMATS, export_table, import_table
+from src.data_handling import ConnectionPool, MealDB, PantryDirectoryDB, PantryDB, table_versions
+from src.expiry_report import generate_expiry_report
+from src.jobs import JobQueue
+from src.pdf_cache import PDFCache, pdf_filename, pdf_key, render_pdf
+from src.shopping_list import build_shopping_list
+
+# Serialize dates as ISO strings rather than HTTP dates in JSON responses
+class JSONProvider(DefaultJSONProvider):
+    @staticmethod
+    def default(o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
 
 # Initialize the Flask app and load the environment variables
 load_dotenv()
 app = Flask(__name__)
+app.json = JSONProvider(app)
+
+PANTRY_PAGE_SIZE = 50
+
+# Days ahead covered by expiry reports when no end date is given
+EXPIRY_WINDOW_DAYS = int(os.getenv('EXPIRY_WINDOW_DAYS', 7))
+
+# Generated PDFs up to this size stay in memory, larger ones spill to a temporary file
+PDF_SPOOL_SIZE = int(os.getenv('PDF_SPOOL_SIZE', 1024 * 1024))
+
+# Seconds the label page waits for a background render job before rendering the labels itself
+LABEL_JOB_WAIT = float(os.getenv('LABEL_JOB_WAIT', 10))
+
+# Requests issuing more SQL statements than this, or repeating one statement of an operation this many times, are logged
+QUERY_BUDGET = int(os.getenv('QUERY_BUDGET', 20))
+QUERY_REPEAT_THRESHOLD = int(os.getenv('QUERY_REPEAT_THRESHOLD', 5))
+CATEGORIES = [
+    'Ingredients',
+    'Meats',
+    'Dairy',
+    'Pasta',
+    'Spices',
+    'Canned goods',
+    'Frozen goods',
+    'Frozen meals',
+    'Drinks'
+]
+
+# Initialize the database connections using environment variables.
+# The schema is managed separately, run `python -m src.migrations` before starting the app.
+pool = ConnectionPool.from_env()
+id_allocator = os.getenv("ID_ALLOCATOR", "feistel")
+mdb = MealDB(pool)
+pddb = PantryDirectoryDB(pool, make_allocator(id_allocator, 'pantry_directory_id'),
+                         cache_size=int(os.getenv('DIRECTORY_CACHE_SIZE', 4096)),
+                         cache_check_interval=float(os.getenv('DIRECTORY_CACHE_CHECK_INTERVAL', 1.0)))
+pdb = PantryDB(pool, make_allocator(id_allocator, 'pantry_serial'))
+jobs = JobQueue(pool)
+pdf_cache = PDFCache.from_env()
+del id_allocator
+
+# Load the PDF and imaging stack, label fonts and layout, and compile and hash every template ahead of the
+# first request. gunicorn.conf.py calls this in the master when it preloads the app, so workers fork
+# with all of it in memory and share it copy-on-write. No database connection is opened here.
+def warm_up() -> None:
+    from src import labels
+    labels.preload()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    templates_version()
+
+# Start timing the request and counting the SQL statements it issues
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.query_log = metrics.QueryLog()
+    g.query_log_token = metrics.track_queries(g.query_log)
+
+# Record the request's latency and statement count, and log requests over the query budget
+def finish_request_metrics(log: metrics.QueryLog, started: float, route: str, method: str, status: int) -> None:
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=method, status=status)
+    metrics.REQUEST_QUERIES.observe(log.count, route=route)
+    repeated = log.repeated(QUERY_REPEAT_THRESHOLD)
+    if log.count > QUERY_BUDGET or repeated:
+        app.logger.warning("%s %s issued %d SQL statements in %.1f ms, repeated: %s", method, route,
+                           log.count, log.seconds * 1000, ', '.join(f"{op} x{n}" for op, n in repeated) or 'none')
+    metrics.flush()
 
-# Initialize the database connections using environment variables
-if not (db_host := os.getenv("DB_HOST")):
-    raise Exception("No database host specified")
-if not (db_name := os.getenv("DB_NAME")):
-    raise Exception("No database name specified")
-if not (db_user := os.getenv("DB_USER")):
-    raise Exception("No database user specified")
-if not (db_password := os.getenv("DB_PASSWORD")):
-    raise Exception("No database password specified")
-db_port = int(os.getenv("DB_PORT", "5432"))
-mdb = MealDB(db_host, db_name, db_user, db_password, db_port)
-pddb = PantryDirectoryDB(db_host, db_name, db_user, db_password, db_port)
-pdb = PantryDB(db_host, db_name, db_user, db_password, db_port)
-del db_host, db_name, db_user, db_password, db_port
+# Generated bodies, such as the streamed expiry report, run after this hook as the server sends them:
+# their statements are counted as they run and the request is recorded once the response is closed.
+# Files are sent as they are, so the server can still use sendfile for them.
+@app.after_request
+def record_request_metrics(response):
+    if (log := g.get('query_log')) is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    args = (log, g.request_started, route, request.method, response.status_code)
+    if response.is_streamed and not response.direct_passthrough:
+        response.response = metrics.tracked_iter(response.response, log)
+        response.call_on_close(lambda: finish_request_metrics(*args))
+    else:
+        finish_request_metrics(*args)
+    return response
+
+@app.teardown_request
+def stop_request_metrics(exc):
+    if (token := g.pop('query_log_token', None)) is not None:
+        metrics.untrack_queries(token)
 
 # Default route to main page
 @app.route('/')
@@ -75,7 +162,99 @@ def save_week():
     mdb.save_week(week, meals)
     return redirect(url_for('index'))
 
-# Route to get the week's meals
+# Turn every ingredient list of a saved week into {"id", "qty", "name"} objects,
+# resolving all names with one directory lookup. Ingredients saved as bare IDs get a quantity of 1.
+# With directory_version, cached names older than that version of the directory are not used.
+def hydrate_week(week_data: dict, directory_version: int | None = None) -> dict:
+    lists = [key for key, value in week_data.items() if key.endswith('_ingredients') and isinstance(value, list)]
+    for key in lists:
+        week_data[key] = [item if isinstance(item, dict) else {'id': item, 'qty': 1} for item in week_data[key]]
+    item_ids = [int(item['id']) for key in lists for item in week_data[key] if str(item.get('id', '')).isdigit()]
+    if directory_version is not None:
+        pddb.cache.validate(directory_version)
+    names = pddb.get_items_by_ids(item_ids)
+    for key in lists:
+        for item in week_data[key]:
+            if str(item.get('id', '')).isdigit() and (entry := names.get(int(item['id']))):
+                item['name'] = entry['name']
+    return week_data
+
+# Send the PDF of a kind and its parameters, using the hash of both as the ETag
+def send_pdf(kind: str, params: dict):
+    return send_pdf_key(pdf_key(kind, params), pdf_filename(kind, params), lambda out: render_pdf(kind, params, out))
+
+# Send the PDF with cache key key, written by render if it is not cached. A browser that already has
+# this exact PDF gets a 304 without anything being rendered. Otherwise the PDF comes from the on-disk
+# cache, rendered into it first if needed, or with the cache disabled is rendered into a spooled
+# temporary file. Either way it is sent in chunks rather than held in memory.
+def send_pdf_key(key: str, filename: str, render: Callable[[BinaryIO], None]):
+    if key in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(key)
+        response.cache_control.no_cache = True
+        return response
+    if pdf_cache is not None:
+        out = pdf_cache.get_or_render(key, render)
+    else:
+        out = SpooledTemporaryFile(max_size=PDF_SPOOL_SIZE)
+        try:
+            render(out)
+        except Exception:
+            out.close()
+            raise
+    size = out.seek(0, os.SEEK_END)
+    out.seek(0)
+    response = send_file(out, as_attachment=True, download_name=filename, mimetype="application/pdf", etag=key)
+    response.content_length = size
+    return response
+
+# Hash of every template's source, so deploying changed templates changes the ETag of every view
+@cache
+def templates_version() -> str:
+    digest = hashlib.sha256()
+    for name in sorted(app.jinja_env.list_templates()):
+        digest.update(name.encode() + b'\0' + app.jinja_env.loader.get_source(app.jinja_env, name)[0].encode())
+    return digest.hexdigest()
+
+# Send a view built by build(), tagged with a hash of its name, the change versions of the data it
+# shows and the templates. A browser sending that ETag gets a 304 without the view being loaded or
+# rendered. The versions must be read before the view is built, so a write landing in between only
+# costs the next request a full response, never a stale 304.
+def conditional_view(name: str, versions: Any, build: Callable[[], Any]):
+    etag = hashlib.sha256(repr((name, versions, templates_version())).encode()).hexdigest()[:32]
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = app.make_response(build())
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+# Label PDF parameters from a request's args or form, with the item name looked up now.
+# The label module, and with it the PDF and imaging stack, is loaded by the first label request.
+def label_params(values) -> dict:
+    from src.labels import LABEL_RENDERER, RENDERERS
+    serials = values.get('serials')
+    item_id = values.get('item_id')
+    expiration_date = values.get('expiration_date')
+    renderer = values.get('renderer', LABEL_RENDERER)
+    
+    if not serials or not item_id or not expiration_date:
+        raise Exception('Missing label parameters')
+    if renderer not in RENDERERS:
+        raise Exception(f"Unknown label renderer: {renderer}")
+    
+    item = pddb.get_item_by_id(int(item_id))
+    return {
+        'serials': serials.split(','),
+        'item_id': item_id,
+        'expiration_date': expiration_date,
+        'item_name': item['name'] if item else 'Unknown Item',
+        'renderer': renderer
+    }
+
+# Route to get the week's meals, with ingredient names resolved.
+# Conditional on the week's version and the directory's, which supplies the names.
 @app.route("/get_week_items")
 def get_week_items():
     week = request.args.get('week')
@@ -83,17 +262,137 @@ def get_week_items():
     if not week:
         raise Exception("No week specified")
     
-    resp = mdb.load_week(week)
-    if resp == None:
+    versions = mdb.week_version(week)
+    if versions[0] is None:
         raise Exception("No items found for week")
     
-    return resp
+    # The names must be at least as new as the directory version in the ETag, or a stale name could
+    # be cached by the browser under the new version until the week or directory changes again
+    def build():
+        if (resp := mdb.load_week(week)) is None:
+            raise Exception("No items found for week")
+        return hydrate_week(resp, versions[1])
+    return conditional_view(f"week {week}", versions, build)
+
+# Route to load every saved week in a range in one request, keyed by week
+@app.route("/weeks")
+def get_weeks():
+    start = request.args.get('start')
+    end = request.args.get('end')
+
+    if not start or not end:
+        raise Exception("Start and end weeks are required")
+    
+    return jsonify(mdb.load_weeks(start, end))
 
-# Route for pantry view
+# Route listing the weeks whose meal plan uses an item
+@app.route("/weeks/using_item")
+def get_weeks_using_item():
+    item_id = request.args.get('item_id')
+
+    if not item_id:
+        raise Exception("Item ID is required")
+    
+    return jsonify(mdb.weeks_using_item(int(item_id)))
+
+# Render the pantry view with the first page of items, further pages are fetched from /pantry/items
+def render_pantry_view(**kwargs):
+    return render_pantry_page(pdb.get_page(limit=PANTRY_PAGE_SIZE), **kwargs)
+
+def render_pantry_page(page: dict, **kwargs):
+    return render_template('pantry_view.html', active_tab='pantry-view', items=page['items'], next_cursor=page['next'],
+                           page_size=PANTRY_PAGE_SIZE, categories=CATEGORIES, **kwargs)
+
+# Expiry window from a request's args: from (default today) to `to`, or `days` after from (default
+# EXPIRY_WINDOW_DAYS), optionally of one category or item_id. With expired=1 there is no lower bound,
+# so units that have already expired are included.
+def expiry_window(values) -> dict:
+    try:
+        start = date.fromisoformat(values['from']) if values.get('from') else date.today()
+        end = date.fromisoformat(values['to']) if values.get('to') else \
+            start + timedelta(days=int(values.get('days', EXPIRY_WINDOW_DAYS)))
+        item_id = int(values['item_id']) if values.get('item_id') else None
+    except (ValueError, OverflowError):
+        raise Exception('Invalid expiry window')
+    if end < start:
+        raise Exception('The expiry window ends before it starts')
+    
+    return {'from': None if values.get('expired') == '1' else start, 'to': end,
+            'category': values.get('category') or None, 'item_id': item_id}
+
+# Serialize rows as the elements of a JSON array, a batch of rows per chunk
+def json_elements(rows) -> Iterator[str]:
+    batch = []
+    separator = ''
+    for row in rows:
+        batch.append(app.json.dumps(row))
+        if len(batch) == pdb.STREAM_BATCH:
+            yield separator + ','.join(batch)
+            batch, separator = [], ','
+    if batch:
+        yield separator + ','.join(batch)
+
+# Route to get the units expiring in a window as JSON: the window, unit and item counts overall and per
+# category, then every item with its unit count and expiry range, then every unit (omitted with units=0).
+# Items and units are streamed from server-side cursors, so the response is sent as it is read.
+@app.route('/pantry/expiring')
+def pantry_expiring():
+    window = expiry_window(request.args)
+    with_units = request.args.get('units') != '0'
+    
+    def body():
+        with pdb.expiry_report(window['from'], window['to'], window['category'], window['item_id']) as report:
+            yield app.json.dumps({**window, **report['summary']})[:-1] + ',"items":['
+            yield from json_elements(report['items'])
+            if with_units:
+                yield '],"units":['
+                yield from json_elements(report['units'])
+            yield ']}'
+    return Response(body(), mimetype='application/json')
+
+# Route to download the expiring units of a window as a printable PDF report, same args as /pantry/expiring.
+# The report is written page by page as rows stream in, to a spooled temporary file.
+@app.route('/pantry/expiring/report')
+def pantry_expiring_report():
+    window = expiry_window(request.args)
+    
+    out = SpooledTemporaryFile(max_size=PDF_SPOOL_SIZE)
+    try:
+        with metrics.RENDER_SECONDS.time(kind='expiry_report'), \
+                pdb.expiry_report(window['from'], window['to'], window['category'], window['item_id']) as report:
+            generate_expiry_report(window, report, out)
+    except Exception:
+        out.close()
+        raise
+    size = out.seek(0, os.SEEK_END)
+    out.seek(0)
+    response = send_file(out, as_attachment=True, download_name=f"expiring_{window['to'].isoformat()}.pdf",
+                         mimetype="application/pdf")
+    response.content_length = size
+    return response
+
+# Route for pantry view, conditional on the pantry's table version
 @app.route('/pantry')
 def pantry_view():
-    items = pdb.get_all_items()
-    return render_template('pantry_view.html', active_tab='pantry-view', items=items)
+    return conditional_view('pantry', table_versions(pool, ['pantry']), render_pantry_view)
+
+# Route to get a page of pantry items as JSON, filtered and sorted on the server
+@app.route('/pantry/items')
+def pantry_items():
+    limit = min(int(request.args.get('limit', PANTRY_PAGE_SIZE)), 200)
+    if limit < 1:
+        raise Exception('Limit must be at least 1')
+    
+    page = pdb.get_page(
+        limit=limit,
+        after=request.args.get('after') or None,
+        sort=request.args.get('sort', 'expiration'),
+        search=request.args.get('q') or None,
+        category=request.args.get('category') or None,
+        expires_from=request.args.get('expires_from') or None,
+        expires_to=request.args.get('expires_to') or None
+    )
+    return jsonify(page)
 
 # Route to search for an item in the pantry by its ID
 @app.route('/pantry/get_by_serial', methods=['POST'])
@@ -102,13 +401,12 @@ def get_by_serial():
     if not serial:
         raise Exception('Serial is required')
     
-    items = pdb.get_all_items()
     serial = int(serial)
     item = pdb.get_item_by_serial(serial)
     if not item:
-        return render_template('pantry_view.html', active_tab='pantry-view', items=items)
+        return render_pantry_view()
     
-    return render_template('pantry_view.html', active_tab='pantry-view', items=items, selected_item=item)
+    return render_pantry_view(selected_item=item)
 
 # Route to get the count of a specific item in the pantry by its ID
 @app.route('/pantry/get_count', methods=['POST'])
@@ -119,8 +417,7 @@ def get_item_count():
     
     item_id = int(item_id)
     count = pdb.item_count(item_id)
-    items = pdb.get_all_items()
-    return render_template('pantry_view.html', active_tab='pantry-view', items=items, item_count=count, searched_id=item_id)
+    return render_pantry_view(item_count=count, searched_id=item_id, next_expiration=pdb.next_expiration(item_id))
 
 # Route for pantry directory view
 @app.route('/pantry/delete', methods=['POST'])
@@ -151,22 +448,32 @@ def delete_oldest_by_id():
     pdb.remove_oldest_by_id(int(item_id))
     return redirect(url_for('pantry_view'))
 
-# Route for pantry intake
+# Route to check out many items at once, as queued by the scan-out mode of the pantry view.
+# Takes JSON {"serials": [...], "items": [{"id": ..., "qty": ...}]} where items are removed oldest first,
+# and returns the result for every serial and item.
+@app.route('/pantry/checkout', methods=['POST'])
+def checkout():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise Exception('Expected a JSON object')
+    
+    try:
+        serials = [int(serial) for serial in body.get('serials', [])]
+        fifo = [(int(item['id']), int(item.get('qty', 1))) for item in body.get('items', [])]
+    except (TypeError, ValueError, KeyError):
+        raise Exception('Invalid serials or items')
+    if not serials and not fifo:
+        raise Exception('Nothing to check out')
+    
+    return jsonify(pdb.checkout(serials, fifo))
+
+# Route for pantry intake, conditional on the directory's table version
 @app.route('/pantry/intake')
 def pantry_intake():
-    items = pddb.get_all_items()
-    categories = [
-        'Ingredients',
-        'Meats',
-        'Dairy',
-        'Pasta',
-        'Spices',
-        'Canned goods',
-        'Frozen goods',
-        'Frozen meals',
-        'Drinks'
-    ]
-    return render_template('pantry_intake.html', active_tab='pantry-intake', items=items, categories=categories)
+    def build():
+        items = pddb.get_all_items()
+        return render_template('pantry_intake.html', active_tab='pantry-intake', items=items, categories=CATEGORIES)
+    return conditional_view('pantry intake', table_versions(pool, ['pantry_directory']), build)
 
 # Route to add an item to the pantry directory
 @app.route('/pantry/intake/add', methods=['POST'])
@@ -181,10 +488,11 @@ def add_pantry_item():
     item_id = int(item_id)
     quantity = int(quantity)
     
-    serials = []
-    for _ in range(quantity):
-        serial = pdb.add_item(pddb, item_id, expiration_date)
-        serials.append(serial)
+    # Nothing to add or label, back to intake as with an empty form
+    if quantity < 1:
+        return redirect(url_for('pantry_intake'))
+    
+    serials = pdb.add_items(pddb, item_id, expiration_date, quantity)
     
     # Redirect to label generation page with all serials
     return redirect(url_for('generate_label', serials=','.join(map(str, serials)), item_id=item_id, expiration_date=expiration_date))
@@ -198,113 +506,52 @@ def generate_label():
     if not serials or not item_id or not expiration_date:
         return redirect(url_for('pantry_intake'))
     
-    return render_template('label_print.html', serials=serials, item_id=item_id, expiration_date=expiration_date)
+    return render_template('label_print.html', serials=serials, item_id=item_id, expiration_date=expiration_date,
+                           job_wait=LABEL_JOB_WAIT)
 
 @app.route('/pantry/label/image')
 def generate_label_image():
-    serials = request.args.get('serials')
-    item_id = request.args.get('item_id')
-    expiration_date = request.args.get('expiration_date')
-    
-    if not serials or not item_id or not expiration_date:
-        raise Exception('Missing label parameters')
+    return send_pdf('labels', label_params(request.args))
+
+# Route to queue a label PDF for a background render worker, returning the job to poll
+@app.route('/jobs/labels', methods=['POST'])
+def queue_labels():
+    job_id = jobs.submit('labels', label_params(request.form))
+    return jsonify(jobs.status(job_id)), 202
+
+# Route to queue a shopping list PDF. The list is worked out now, so the PDF matches the pantry at request time.
+@app.route('/jobs/shopping_list', methods=['POST'])
+def queue_shopping_list():
+    week = request.form.get('week')
+
+    if not week:
+        raise Exception("No week specified")
     
-    serial_list = serials.split(',')
+    week_data = mdb.load_week(week)
+    if not week_data:
+        raise Exception("No items found for week")
     
-    # Get item name from database
-    item = pddb.get_item_by_id(int(item_id))
-    item_name = item['name'] if item else 'Unknown Item'
-    
-    # Create PDF with multiple pages
-    buffer = BytesIO()
-    pdf = canvas.Canvas(buffer, pagesize=(4*inch, 6*inch))
-    
-    for serial in serial_list:
-        # Create label image (4x6 inches at 300 DPI - vertical layout)
-        width, height = 1200, 1800
-        img = Image.new('RGB', (width, height), 'white')
-        draw = ImageDraw.Draw(img)
-        
-        try:
-            font_huge = ImageFont.truetype('./static/Roboto-Bold.ttf', 120)
-            font_large = ImageFont.truetype('./static/Roboto-Bold.ttf', 80)
-            font_medium = ImageFont.truetype('./static/Roboto-Regular.ttf', 60)
-        except:
-            font_huge = ImageFont.load_default()
-            font_large = ImageFont.load_default()
-            font_medium = ImageFont.load_default()
-        
-        # Generate barcodes
-        CODE128 = barcode.get_barcode_class('code128')
-        
-        serial_barcode = CODE128(serial, writer=ImageWriter())
-        serial_barcode_img = serial_barcode.render({
-            'write_text': False,
-            'module_height': 25,
-            'module_width': 0.6,
-            'quiet_zone': 10
-        })
-        serial_barcode_img = serial_barcode_img.resize((1000, 300))
-        
-        item_barcode = CODE128(item_id, writer=ImageWriter())
-        item_barcode_img = item_barcode.render({
-            'write_text': False,
-            'module_height': 25,
-            'module_width': 0.6,
-            'quiet_zone': 10
-        })
-        item_barcode_img = item_barcode_img.resize((1000, 300))
-        
-        # Vertical layout
-        x_center = width // 2
-        y_pos = 50
-        
-        # Serial section
-        text_bbox = draw.textbbox((0, 0), 'Serial:', font=font_large)
-        text_width = text_bbox[2] - text_bbox[0]
-        draw.text((x_center - text_width // 2, y_pos), 'Serial:', font=font_large, fill='black')
-        y_pos += 90
-        img.paste(serial_barcode_img, ((width - 1000) // 2, y_pos))
-        y_pos += 310
-        text_bbox = draw.textbbox((0, 0), serial, font=font_medium)
-        text_width = text_bbox[2] - text_bbox[0]
-        draw.text((x_center - text_width // 2, y_pos), serial, font=font_medium, fill='black')
-        
-        # Item ID section
-        y_pos += 100
-        text_bbox = draw.textbbox((0, 0), 'Item ID:', font=font_large)
-        text_width = text_bbox[2] - text_bbox[0]
-        draw.text((x_center - text_width // 2, y_pos), 'Item ID:', font=font_large, fill='black')
-        y_pos += 90
-        img.paste(item_barcode_img, ((width - 1000) // 2, y_pos))
-        y_pos += 310
-        text_bbox = draw.textbbox((0, 0), item_id, font=font_medium)
-        text_width = text_bbox[2] - text_bbox[0]
-        draw.text((x_center - text_width // 2, y_pos), item_id, font=font_medium, fill='black')
-        
-        # Expiration date
-        y_pos += 100
-        text_bbox = draw.textbbox((0, 0), 'Expires:', font=font_large)
-        text_width = text_bbox[2] - text_bbox[0]
-        draw.text((x_center - text_width // 2, y_pos), 'Expires:', font=font_large, fill='black')
-        y_pos += 90
-        text_bbox = draw.textbbox((0, 0), expiration_date, font=font_huge)
-        text_width = text_bbox[2] - text_bbox[0]
-        draw.text((x_center - text_width // 2, y_pos), expiration_date, font=font_huge, fill='black')
-        
-        # Item name at bottom
-        y_pos += 140
-        text_bbox = draw.textbbox((0, 0), item_name, font=font_large)
-        text_width = text_bbox[2] - text_bbox[0]
-        draw.text((x_center - text_width // 2, y_pos), item_name, font=font_large, fill='black')
-        
-        pdf.drawImage(ImageReader(img), 0, 0, width=4*inch, height=6*inch)
-        pdf.showPage()
-    
-    pdf.save()
-    buffer.seek(0)
-    
-    return send_file(buffer, as_attachment=True, download_name=f"labels_{item_id}.pdf", mimetype="application/pdf")
+    job_id = jobs.submit('shopping_list', build_shopping_list(week, week_data, pdb))
+    return jsonify(jobs.status(job_id)), 202
+
+# Route to poll a render job: status is queued, running, done or failed
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    if not (job := jobs.status(job_id)):
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] == 'done':
+        job['result_url'] = url_for('job_result', job_id=job_id)
+    return jsonify(job)
+
+# Route to download the PDF of a finished render job. The job's PDF has the cache key of the request
+# it was queued for, so it is served from the PDF cache like any other PDF, copied there from the
+# job row in chunks the first time.
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    if not (result := jobs.result(job_id)):
+        return jsonify({'error': 'Job result not available'}), 404
+    filename, key = result
+    return send_pdf_key(key, filename, lambda out: jobs.write_result(job_id, out))
 
 # Route to add an item to the pantry directory
 @app.route('/pantry/directory/add', methods=['POST'])
@@ -332,7 +579,6 @@ def delete_pantry_directory_item():
 
 @app.route('/pantry/directory/get_item', methods=['POST'])
 def get_pantry_directory_item():
-    from flask import jsonify
     item_id = request.form.get('item_id')
     
     if not item_id:
@@ -347,69 +593,80 @@ def get_pantry_directory_item():
 
 @app.route('/pantry/directory/search', methods=['GET'])
 def search_pantry_directory():
-    from flask import jsonify
     query = request.args.get('q', '').lower()
     
     if not query:
         return jsonify([])
     
-    items = pddb.get_all_items()
-    results = [{'id': item['id'], 'name': item['name']} for item in items if query in item['name'].lower()]
-    return jsonify(results[:10])  # Limit to 10 results
-
-# Generates a PDF shopping list for the specified week, including checkboxes for each item
-# with 2 secions, one for items to check stock and one for items to buy, and handles pagination for long lists
-def generate_shopping_list(week: str, check_items: list[str], items: list[str]) -> BytesIO:
-    buffer = BytesIO()
-    pdf = canvas.Canvas(buffer, pagesize=letter)
-    pdf.setTitle(f"Shopping List - Week {week}")
-    
-    y_position = 10 * inch
-
-    # Section 1: Check Item Stock
-    if len(items) > 0:
-        pdf.setFont("Helvetica-Bold", 16)
-        pdf.drawString(1 * inch, y_position, f"Shopping List - {week}")
-        y_position -= 0.5 * inch
-        pdf.setFont("Helvetica", 12)
-        
-        for item in items:
-            if y_position < 1 * inch:
-                pdf.showPage()
-                y_position = 10.5 * inch
-                pdf.setFont("Helvetica", 12)
-            
-            pdf.rect(0.5 * inch, y_position - 0.05 * inch, 0.15 * inch, 0.15 * inch)
-            pdf.drawString(0.8 * inch, y_position, item)
-            y_position -= 0.3 * inch
-        
-        y_position -= 0.3 * inch  # Extra space between sections
-    
-    # Section 2: Shopping List
-    if len(check_items) > 0:
-        if y_position < 2 * inch:
-            pdf.showPage()
-            y_position = 10.5 * inch
-
-        pdf.setFont("Helvetica-Bold", 16)
-        pdf.drawString(1 * inch, y_position, "Check Item Stock")
-        y_position -= 0.5 * inch
-        pdf.setFont("Helvetica", 12)
-        
-        for item in check_items:
-            if y_position < 1 * inch:
-                pdf.showPage()
-                y_position = 10.5 * inch
-                pdf.setFont("Helvetica", 12)
-            
-            pdf.rect(0.5 * inch, y_position - 0.05 * inch, 0.15 * inch, 0.15 * inch)
-            pdf.drawString(0.8 * inch, y_position, item)
-            y_position -= 0.3 * inch
-    
-    pdf.save()
-    buffer.seek(0)
-
-    return buffer
+    return jsonify(pddb.search(query, limit=10))
+
+# Route to export the pantry directory or the pantry as CSV or NDJSON (?format=), through COPY.
+# The export is spooled to a temporary file, so the connection is free again before the download starts.
+@app.route('/pantry/export', defaults={'table': 'pantry'})
+@app.route('/pantry/directory/export', defaults={'table': 'directory'})
+def export_rows(table):
+    fmt = request.args.get('format', 'csv')
+    if fmt not in FORMATS:
+        raise Exception(f"Unknown format: {fmt}")
+    
+    out = SpooledTemporaryFile(max_size=PDF_SPOOL_SIZE)
+    try:
+        export_table(pool, table, fmt, out)
+    except Exception:
+        out.close()
+        raise
+    size = out.seek(0, os.SEEK_END)
+    out.seek(0)
+    response = send_file(out, as_attachment=True, download_name=f"{table}_{date.today().isoformat()}.{fmt}",
+                         mimetype=FORMATS[fmt])
+    response.content_length = size
+    return response
+
+# Route to import CSV or NDJSON rows into the pantry directory or the pantry, sent as the request body
+# or as the file field of a form. Existing IDs and serials are updated, and rows without one get a new one.
+# The format is taken from ?format=, else from the content type, else CSV.
+@app.route('/pantry/import', methods=['POST'], defaults={'table': 'pantry'})
+@app.route('/pantry/directory/import', methods=['POST'], defaults={'table': 'directory'})
+def import_rows(table):
+    if request.mimetype == 'multipart/form-data':
+        if not (upload := request.files.get('file')):
+            raise Exception('No file uploaded')
+        stream, mimetype = upload.stream, upload.mimetype
+    else:
+        stream, mimetype = request.stream, request.mimetype
+    fmt = request.args.get('format') or next((fmt for fmt, known in FORMATS.items() if known == mimetype), 'csv')
+    
+    if table == 'directory':
+        result = import_table(pool, table, fmt, stream, pddb.allocator)
+        pddb.cache.clear()
+    else:
+        result = import_table(pool, table, fmt, stream, pdb.allocator)
+    return jsonify(result)
+
+# Route exposing connection pool and cache metrics for sizing them
+@app.route('/stats')
+def stats():
+    return jsonify({'pool': pool.stats(), 'directory_cache': pddb.cache.stats(),
+                    'pdf_cache': pdf_cache.stats() if pdf_cache is not None else None})
+
+# Route exposing request, SQL and PDF rendering latency histograms in the Prometheus text format
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Route to get the week's shopping list as JSON
+@app.route("/shopping_list")
+def shopping_list():
+    week = request.args.get('week')
+
+    if not week:
+        raise Exception("No week specified")
+    
+    week_data = mdb.load_week(week)
+    if not week_data:
+        raise Exception("No items found for week")
+    
+    return jsonify(build_shopping_list(week, week_data, pdb))
 
 # Route to download the shopping list as a PDF
 @app.route("/download_shopping_list")
@@ -423,28 +680,4 @@ def download_shopping_list():
     if not week_data:
         raise Exception("No items found for week")
     
-    days = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
-    check_items = []
-    shopping_items = []
-
-    for day in days:
-        ingredients = week_data.get(f"{day}_ingredients", [])
-        for ingredient in ingredients:
-            item = pddb.get_item_by_id(int(ingredient['id']))
-            if item:
-                shopping_count = pdb.item_count(int(ingredient['id']))
-                if shopping_count - int(ingredient['qty']) < 0:
-                    shopping_items.append(item['name'])
-                elif shopping_count - int(ingredient['qty']) == 0:
-                    check_items.append(item['name'])
-    
-    # Add additional shopping items
-    additional_items = week_data.get('additional_ingredients', [])
-    for ingredient in additional_items:
-        item = pddb.get_item_by_id(int(ingredient['id']))
-        if item:
-            shopping_items.append(item['name'])
-    
-    buffer = generate_shopping_list(week, check_items, shopping_items)
-    
-    return send_file(buffer, as_attachment=True, download_name=f"shopping_list_{week}.pdf", mimetype="application/pdf")
+    return send_pdf('shopping_list', build_shopping_list(week, week_data, pdb))
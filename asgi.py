@@ -0,0 +1,128 @@
+from urllib.parse import parse_qs
+import os
+import time
+from a2wsgi import WSGIMiddleware
+from werkzeug.utils import redirect
+from werkzeug.wrappers import Response
+
+from app import app as flask_app, render_pantry_page, PANTRY_PAGE_SIZE, QUERY_BUDGET, QUERY_REPEAT_THRESHOLD
+from src import metrics
+from src.async_db import AsyncScannerDB
+
+# ASGI entry point for the async serving mode: `gunicorn -c gunicorn.conf.py -k uvicorn_worker.UvicornWorker asgi:app`.
+# The barcode scanner and autocomplete endpoints are handled on the event loop with an asyncpg pool,
+# so each process keeps hundreds of these small requests in flight on a few connections instead of
+# one per thread. Responses are the same as those of the Flask routes. Every other request, and
+# scanner requests that are not plain form posts, go to the Flask app in a pool of ASYNC_WSGI_THREADS
+# threads, so the whole app can be served from this entry point.
+
+ASYNC_WSGI_THREADS = int(os.getenv('ASYNC_WSGI_THREADS', 8))
+
+db = AsyncScannerDB.from_env()
+wsgi = WSGIMiddleware(flask_app, workers=ASYNC_WSGI_THREADS)
+
+async def get_directory_item(form: dict[str, str]) -> Response:
+    if not (item_id := form.get('item_id')):
+        return flask_app.json.response({'name': None})
+    item = await db.get_item_by_id(int(item_id))
+    return flask_app.json.response({'name': item['name'] if item else None})
+
+async def search_directory(query: dict[str, str]) -> Response:
+    if not (text := query.get('q', '').lower()):
+        return flask_app.json.response([])
+    return flask_app.json.response(await db.search(text, limit=10))
+
+async def delete_by_serial(form: dict[str, str]) -> Response:
+    if not (serial := form.get('serial')):
+        raise Exception('Serial is required')
+    await db.remove_item(int(serial))
+    return redirect('/pantry')
+
+async def get_by_serial(form: dict[str, str]) -> Response:
+    if not (serial := form.get('serial')):
+        raise Exception('Serial is required')
+    item = await db.get_item_by_serial(int(serial))
+    page = await db.first_page(PANTRY_PAGE_SIZE)
+    with flask_app.app_context():
+        html = render_pantry_page(page, selected_item=item) if item else render_pantry_page(page)
+    return Response(html, mimetype='text/html')
+
+# Routes served on the event loop, by method and path. GET handlers take the query string, POST
+# handlers the form body.
+ROUTES = {
+    ('POST', '/pantry/directory/get_item'): get_directory_item,
+    ('GET', '/pantry/directory/search'): search_directory,
+    ('POST', '/pantry/delete_by_serial'): delete_by_serial,
+    ('POST', '/pantry/get_by_serial'): get_by_serial,
+}
+
+FORM_TYPE = b'application/x-www-form-urlencoded'
+
+# First value of every field of a query string or form body, as request.args and request.form give them
+def _fields(data: bytes) -> dict[str, str]:
+    return {key: values[0] for key, values in parse_qs(data.decode('latin-1'), keep_blank_values=True).items()}
+
+async def _body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise Exception('Client disconnected')
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+# Open the pool at startup so the first scans do not wait for connections, and close it on shutdown.
+# If the database is unreachable the server still starts, and the pool is opened on first use.
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await db.open()
+            except Exception as e:
+                flask_app.logger.warning("Could not open database connections: %s", e)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await db.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+# Run a scanner route, recording its latency and SQL statements as the Flask request hooks do.
+# Errors are logged and answered with a 500, as Flask answers them.
+async def _serve(scope, receive, send, handler) -> None:
+    started = time.perf_counter()
+    log = metrics.QueryLog()
+    token = metrics.track_queries(log)
+    try:
+        values = await _body(receive) if scope['method'] == 'POST' else scope['query_string']
+        response = await handler(_fields(values))
+    except Exception:
+        flask_app.logger.exception("Exception on %s [%s]", scope['path'], scope['method'])
+        response = Response('Internal Server Error', status=500, mimetype='text/plain')
+    finally:
+        metrics.untrack_queries(token)
+    body = response.get_data()
+    await send({'type': 'http.response.start', 'status': response.status_code,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response.headers.items()]})
+    await send({'type': 'http.response.body', 'body': body})
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, route=scope['path'], method=scope['method'],
+                                    status=response.status_code)
+    metrics.REQUEST_QUERIES.observe(log.count, route=scope['path'])
+    repeated = log.repeated(QUERY_REPEAT_THRESHOLD)
+    if log.count > QUERY_BUDGET or repeated:
+        flask_app.logger.warning("%s %s issued %d SQL statements in %.1f ms, repeated: %s", scope['method'], scope['path'],
+                                 log.count, log.seconds * 1000, ', '.join(f"{op} x{n}" for op, n in repeated) or 'none')
+    metrics.flush()
+
+async def app(scope, receive, send) -> None:
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    handler = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if handler is not None and scope['method'] == 'POST':
+        content_type = dict(scope['headers']).get(b'content-type', b'')
+        if content_type.split(b';')[0].strip().lower() != FORM_TYPE:
+            handler = None
+    if handler is None:
+        return await wsgi(scope, receive, send)
+    await _serve(scope, receive, send, handler)
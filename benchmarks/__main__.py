@@ -0,0 +1,173 @@
+import argparse
+from datetime import datetime, timezone
+from json import dumps, loads
+import importlib
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.bulk import bench_bulk_io
+from benchmarks.load import bench_load
+from benchmarks.micro import bench_allocators, bench_label_parallel, bench_labels, bench_memory, bench_shopping_list
+from benchmarks.postgres import postgres, use_database
+from benchmarks.routes import RouteBench
+from benchmarks.scaling import bench_scaling
+from benchmarks.seed import SCALES, seed
+from benchmarks.startup import bench_startup
+
+# Run the benchmark suite against a throwaway Postgres and print the results as JSON.
+#   python -m benchmarks --scale small --output results.json
+#   python -m benchmarks --baseline results.json   # compare with an earlier run, exit 1 on regressions
+
+GROUPS = ['routes', 'labels', 'memory', 'shopping_list', 'allocators', 'scaling', 'bulk_io', 'startup', 'load']
+
+def _ints(value: str) -> list[int]:
+    return [int(part) for part in value.split(',') if part]
+
+def _git(*args: str) -> str | None:
+    try:
+        result = subprocess.run(['git', *args], capture_output=True, text=True, timeout=30,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def _print_result(result: dict) -> None:
+    if 'p50_ms' in result:
+        line = f"p50 {result['p50_ms']:10.3f} ms  p99 {result['p99_ms']:10.3f} ms  {result['ops_per_sec']:10.1f}/s"
+    else:
+        line = f"{result['seconds']:8.3f} s  peak {result['peak_mib']:8.2f} MiB  pdf {result['pdf_bytes'] / 2**20:7.2f} MiB"
+    print(f"{result['group']:14} {result['name']:48} {line}", file=sys.stderr)
+
+# The figure a result is compared on: median latency, or peak memory for the memory group
+def _headline(result: dict) -> tuple[str, float] | None:
+    for metric in ('p50_ms', 'peak_mib'):
+        if metric in result:
+            return metric, result[metric]
+    return None
+
+# Compare results with a baseline run, printing every change and returning the regressions
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    previous = {(result['group'], result['name']): result for result in baseline}
+    regressions = []
+    print(f"\n{'':14} {'compared with baseline':48} {'before':>12} {'after':>12} {'change':>8}", file=sys.stderr)
+    for result in results:
+        if (old := previous.get((result['group'], result['name']))) is None:
+            continue
+        if not (headline := _headline(result)) or headline[0] not in old or not old[headline[0]]:
+            continue
+        metric, value = headline
+        change = value / old[metric] - 1
+        flag = ' REGRESSION' if change > tolerance else ''
+        print(f"{result['group']:14} {result['name']:48} {old[metric]:12.3f} {value:12.3f} {change:+8.1%}{flag}",
+              file=sys.stderr)
+        if flag:
+            regressions.append(f"{result['group']}/{result['name']}")
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the meal planner against synthetic data")
+    parser.add_argument('--scale', choices=SCALES, default='small', help="size of the seeded data set")
+    parser.add_argument('--postgres', choices=['auto', 'initdb', 'server'], default='auto',
+                        help="initdb a private cluster, or create scratch databases on the DB_* server (default: server if DB_HOST is set)")
+    parser.add_argument('--only', default=','.join(GROUPS), help=f"comma separated groups to run ({', '.join(GROUPS)})")
+    parser.add_argument('--iterations', type=int, default=50, help="timed iterations per benchmark")
+    parser.add_argument('--threads', type=int, default=4, help="client threads for the concurrent route benchmark")
+    parser.add_argument('--label-counts', type=_ints, default=[1, 10, 100, 1000], help="label job sizes")
+    parser.add_argument('--label-workers', type=int, default=os.cpu_count() or 1, help="render processes for parallel labels")
+    parser.add_argument('--shopping-lines', type=int, default=2000, help="lines in the shopping list memory benchmark")
+    parser.add_argument('--scaling-sizes', type=_ints, default=[1_000, 10_000, 100_000], help="rows per scaling database")
+    parser.add_argument('--bulk-sizes', type=_ints, default=[10_000, 100_000], help="rows per bulk import and export database")
+    parser.add_argument('--bulk-per-row', type=int, default=200, help="rows added one at a time for the per-row comparison")
+    parser.add_argument('--startup-runs', type=int, default=5, help="fresh processes per startup benchmark")
+    parser.add_argument('--load-clients', type=_ints, default=[1, 16, 64, 256], help="concurrent clients per load test step")
+    parser.add_argument('--load-seconds', type=float, default=5.0, help="duration of each load test step")
+    parser.add_argument('--load-workers', type=int, default=2, help="server processes in each serving mode of the load test")
+    parser.add_argument('--load-db-delay', type=float, default=0.0,
+                        help="milliseconds added to every database round trip in the load test, as for a database on another host")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for the synthetic data")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    groups = [group for group in args.only.split(',') if group]
+    if unknown := set(groups) - set(GROUPS):
+        raise Exception(f"Unknown benchmark groups: {', '.join(sorted(unknown))}")
+    scale = SCALES[args.scale]
+    results = []
+    started = datetime.now(timezone.utc)
+
+    with postgres(args.postgres) as instance, instance.database('main') as params, \
+            tempfile.TemporaryDirectory(prefix='meal-planner-bench-pdfs-') as pdf_dir:
+        use_database(params)
+        os.environ['PDF_CACHE_DIR'] = pdf_dir
+        os.environ.pop('METRICS_DIR', None)
+        app = importlib.import_module('app')
+        print(f"Seeding {scale['items']} items, {scale['serials']} serials, {scale['weeks']} weeks", file=sys.stderr)
+        data = seed(app.pool, scale, app.CATEGORIES, args.seed)
+        with app.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SHOW server_version")
+            server_version = cur.fetchone()[0]
+            # Substring search only has an index with pg_trgm, so its timings depend on the server
+            cur.execute("SELECT extname FROM pg_extension ORDER BY extname")
+            extensions = [row[0] for row in cur.fetchall()]
+
+        runs = {
+            'routes': lambda: RouteBench(app, data, args.iterations, args.threads, args.seed).run(),
+            'labels': lambda: bench_labels(args.label_counts, args.iterations)
+                              + bench_label_parallel(args.label_counts, args.iterations, args.label_workers),
+            'memory': lambda: bench_memory([n for n in args.label_counts if n >= 100], args.shopping_lines),
+            'shopping_list': lambda: bench_shopping_list(app.pool, data['weeks'], args.iterations),
+            'allocators': lambda: bench_allocators(app.pool, args.iterations),
+            'scaling': lambda: bench_scaling(instance.database, args.scaling_sizes, app.CATEGORIES, args.iterations, args.seed),
+            'bulk_io': lambda: bench_bulk_io(instance.database, args.bulk_sizes, app.CATEGORIES, args.bulk_per_row, args.seed),
+            'startup': lambda: bench_startup(args.startup_runs),
+            'load': lambda: bench_load(data, args.load_clients, args.load_seconds, args.load_workers,
+                                       args.load_db_delay / 1000, args.seed),
+        }
+        for group in GROUPS:
+            if group not in groups:
+                continue
+            print(f"Running {group}", file=sys.stderr)
+            for result in runs[group]():
+                _print_result(result)
+                results.append(result)
+        app.pool.close()
+
+    report = {
+        'meta': {
+            'commit': _git('rev-parse', 'HEAD'),
+            'dirty': bool(_git('status', '--porcelain', '--untracked-files=no')),
+            'started_at': started.isoformat(),
+            'duration_seconds': round((datetime.now(timezone.utc) - started).total_seconds(), 1),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'postgres': server_version,
+            'postgres_extensions': extensions,
+            'postgres_kind': type(instance).__name__,
+            'scale': {'name': args.scale, **scale},
+            'iterations': args.iterations,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(dumps(report, indent=2) + '\n')
+    else:
+        print(dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, loads(file.read())['results'], args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+from io import BytesIO, StringIO
+from typing import Any, Callable
+import csv
+import random
+
+from benchmarks.seed import ADJECTIVES, FOODS, make_pool
+from benchmarks.timing import measure
+from src.allocators import FeistelAllocator
+from src.bulk_io import export_table, import_table
+from src.data_handling import PantryDB, PantryDirectoryDB
+from src.migrations import migrate
+
+# Bulk import and export throughput, next to the per-row path of the intake forms. Each size runs in
+# a fresh database: a catalogue of new directory items is imported, then as many pantry units, both
+# are exported as CSV and NDJSON and the exports imported again, which finds every row unchanged.
+# The per-row figures come from add_item, one commit per row, as the forms do.
+
+def _csv(header: list[str], rows: list[tuple]) -> bytes:
+    text = StringIO()
+    writer = csv.writer(text, lineterminator='\n')
+    writer.writerow(header)
+    writer.writerows(rows)
+    return text.getvalue().encode()
+
+def _once(name: str, rows: int, fn: Callable[[], Any]) -> dict[str, Any]:
+    result = measure('bulk_io', name, lambda i: fn(), 1, warmup=0, rows=rows)
+    result['rows_per_sec'] = round(result['ops_per_sec'] * rows, 1)
+    return result
+
+def bench_bulk_io(database: Callable, sizes: list[int], categories: list[str], per_row: int,
+                  seed_value: int = 0) -> list[dict[str, Any]]:
+    results = []
+    for size in sizes:
+        with database(f"bulk{size}") as params:
+            pool = make_pool(params)
+            try:
+                rng = random.Random(seed_value)
+                migrate(pool)
+                results.extend(_bench_size(pool, size, categories, per_row, rng))
+            finally:
+                pool.close()
+    return results
+
+def _bench_size(pool, size: int, categories: list[str], per_row: int, rng: random.Random) -> list[dict[str, Any]]:
+    items = FeistelAllocator('pantry_directory_id')
+    serials = FeistelAllocator('pantry_serial')
+    catalogue = _csv(['name', 'category'], [(f"{rng.choice(ADJECTIVES)} {rng.choice(FOODS)} {i}", rng.choice(categories))
+                                            for i in range(size)])
+    results = [_once(f"import directory csv x{size}", size,
+                     lambda: import_table(pool, 'directory', 'csv', BytesIO(catalogue), items))]
+
+    pddb = PantryDirectoryDB(pool, items)
+    item_ids = [item['id'] for item in pddb.get_all_items()]
+    units = _csv(['id', 'expiration_date'], [(rng.choice(item_ids), f"2030-{rng.randint(1, 12):02d}-01")
+                                             for _ in range(size)])
+    results.append(_once(f"import pantry csv x{size}", size,
+                         lambda: import_table(pool, 'pantry', 'csv', BytesIO(units), serials)))
+
+    for table in ('directory', 'pantry'):
+        for fmt in ('csv', 'ndjson'):
+            out = BytesIO()
+            results.append(_once(f"export {table} {fmt} x{size}", size, lambda: export_table(pool, table, fmt, out)))
+            exported = out.getvalue()
+            allocator = items if table == 'directory' else serials
+            results.append(_once(f"reimport {table} {fmt} x{size}", size,
+                                 lambda: import_table(pool, table, fmt, BytesIO(exported), allocator)))
+
+    pdb = PantryDB(pool, serials)
+    for name, add in (('directory', lambda i: pddb.add_item(f"per row item {i}", rng.choice(categories))),
+                      ('pantry', lambda i: pdb.add_item(pddb, rng.choice(item_ids), '2030-01-01'))):
+        result = measure('bulk_io', f"per-row add_item {name}", add, per_row)
+        result['rows_per_sec'] = result['ops_per_sec']
+        results.append(result)
+    return results
@@ -0,0 +1,226 @@
+from typing import Any
+from urllib.parse import urlencode
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from benchmarks.postgres import _free_port
+from benchmarks.seed import SEARCH_QUERIES
+from benchmarks.timing import summarize
+
+# Load test of the scanner and autocomplete endpoints against real servers, in both serving modes:
+# - sync: gunicorn with gunicorn.conf.py, `workers` processes of GUNICORN_THREADS threads each, so at
+#   most workers * threads requests are handled at once and the rest wait in the listen queue
+# - async: the same gunicorn settings with uvicorn workers running asgi.py, which serves these
+#   endpoints on the event loop
+# With db_delay, the servers reach Postgres through a proxy that holds every packet for half of it in
+# each direction, as a database on another host would add a round trip to every statement.
+# Each step runs a number of clients for a fixed time, every client sending its next request over a
+# keep-alive connection as soon as the previous one is answered. The clients run in this process, so
+# on a small machine they share its CPUs with the server.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TIMEOUT = 30.0
+FORM = 'application/x-www-form-urlencoded'
+
+# _Connection sends requests over one keep-alive HTTP/1.1 connection, reconnecting when the server closed it
+class _Connection:
+    def __init__(self, port: int):
+        self.port = port
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def request(self, method: str, path: str, form: dict | None = None) -> int:
+        body = urlencode(form).encode() if form is not None else b''
+        head = f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: {len(body)}\r\n"
+        if form is not None:
+            head += f"Content-Type: {FORM}\r\n"
+        for attempt in range(2):
+            reused = self.writer is not None
+            if not reused:
+                self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+            self.writer.write(head.encode() + b"\r\n" + body)
+            if (status_line := await self.reader.readline()) or not reused:
+                break
+            # A reused connection the server had already closed
+            await self.close()
+        if not status_line:
+            raise Exception("Connection closed without a response")
+        length, close = 0, False
+        while (line := await self.reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode('latin-1').partition(':')
+            if (name := name.strip().lower()) == 'content-length':
+                length = int(value)
+            elif name == 'connection' and value.strip().lower() == 'close':
+                close = True
+            elif name == 'transfer-encoding':
+                raise Exception("Chunked responses are not supported")
+        await self.reader.readexactly(length)
+        if close:
+            await self.close()
+        return int(status_line.split()[1])
+
+# The scanner traffic mix: autocomplete searches, item ID scans, serial lookups and serial scan-outs.
+# Scan-outs remove serials from the end of the seeded list; once it runs out they repeat, removing nothing.
+class _Traffic:
+    def __init__(self, data: dict[str, list], seed_value: int):
+        self.rng = random.Random(seed_value)
+        self.items = data['items']
+        half = len(data['serials']) // 2
+        self.read_serials = data['serials'][:half]
+        self.spare_serials = data['serials'][half:]
+        self.removed = 0
+
+    def next(self) -> tuple[str, str, dict | None, tuple[int, ...]]:
+        roll = self.rng.random()
+        if roll < 0.5:
+            query = self.rng.choice(SEARCH_QUERIES)[:self.rng.randint(2, 4)]
+            return 'GET', f"/pantry/directory/search?{urlencode({'q': query})}", None, (200,)
+        if roll < 0.85:
+            return 'POST', '/pantry/directory/get_item', {'item_id': self.rng.choice(self.items)}, (200,)
+        if roll < 0.95:
+            serial = self.spare_serials[-1 - self.removed % len(self.spare_serials)]
+            self.removed += 1
+            return 'POST', '/pantry/delete_by_serial', {'serial': serial}, (302,)
+        return 'POST', '/pantry/get_by_serial', {'serial': self.rng.choice(self.read_serials)}, (200,)
+
+async def _client(port: int, traffic: _Traffic, deadline: float, samples: list[float], errors: list[str]) -> None:
+    conn = _Connection(port)
+    try:
+        while time.perf_counter() < deadline:
+            method, path, form, expected = traffic.next()
+            start = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(conn.request(method, path, form), TIMEOUT)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+                await conn.close()
+                continue
+            samples.append(time.perf_counter() - start)
+            if status not in expected:
+                errors.append(f"{method} {path.split('?')[0]}: {status}")
+    finally:
+        await conn.close()
+
+async def _step(port: int, clients: int, seconds: float, traffic: _Traffic) -> tuple[list[float], list[str], float]:
+    samples: list[float] = []
+    errors: list[str] = []
+    start = time.perf_counter()
+    await asyncio.gather(*(_client(port, traffic, start + seconds, samples, errors) for _ in range(clients)))
+    return samples, errors, time.perf_counter() - start
+
+# _DelayProxy forwards TCP connections to a target, delaying what it forwards by delay seconds in each
+# direction. It runs its own event loop in a background thread.
+class _DelayProxy:
+    def __init__(self, host: str, port: int, delay: float):
+        self.target = (host, port)
+        self.delay = delay
+        self.port = _free_port()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    async def __pump(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def forward():
+            while (item := await queue.get()) is not None:
+                due, data = item
+                await asyncio.sleep(max(0.0, due - self.loop.time()))
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        sender = self.loop.create_task(forward())
+        try:
+            while data := await reader.read(65536):
+                queue.put_nowait((self.loop.time() + self.delay, data))
+        except OSError:
+            pass
+        queue.put_nowait(None)
+        await sender
+
+    async def __connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(*self.target)
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(self.__pump(reader, upstream_writer), self.__pump(upstream_reader, writer),
+                             return_exceptions=True)
+
+    def start(self) -> None:
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(asyncio.start_server(self.__connection, '127.0.0.1', self.port),
+                                         self.loop).result()
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+def _server(mode: str, port: int, workers: int, database: dict[str, str]) -> subprocess.Popen:
+    env = {**os.environ, 'PDF_CACHE_SIZE': '0', 'LABEL_WORKERS': '0', **database}
+    env.pop('METRICS_DIR', None)
+    env.update(GUNICORN_BIND=f"127.0.0.1:{port}", GUNICORN_WORKERS=str(workers))
+    command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--log-level', 'warning']
+    command += ['app:app'] if mode == 'sync' else ['-k', 'uvicorn_worker.UvicornWorker', 'asgi:app']
+    return subprocess.Popen(command, cwd=ROOT, env=env)
+
+async def _wait_ready(port: int, server: subprocess.Popen) -> None:
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise Exception(f"Server exited with status {server.returncode}")
+        conn = _Connection(port)
+        try:
+            if await conn.request('GET', '/pantry/directory/search?q=fresh') == 200:
+                return
+        except Exception:
+            pass
+        finally:
+            await conn.close()
+        await asyncio.sleep(0.2)
+    raise Exception("Server did not start")
+
+def bench_load(data: dict[str, list], clients: list[int], seconds: float, workers: int, db_delay: float = 0.0,
+               seed_value: int = 0) -> list[dict[str, Any]]:
+    results = []
+    traffic = _Traffic(data, seed_value)
+    threads = int(os.getenv('GUNICORN_THREADS', 4))
+    database = {}
+    proxy = None
+    if db_delay > 0:
+        proxy = _DelayProxy(os.environ['DB_HOST'], int(os.getenv('DB_PORT', '5432')), db_delay / 2)
+        proxy.start()
+        database = {'DB_HOST': '127.0.0.1', 'DB_PORT': str(proxy.port)}
+    suffix = f" (db +{db_delay * 1000:g} ms)" if db_delay > 0 else ""
+    for mode in ('sync', 'async'):
+        port = _free_port()
+        server = _server(mode, port, workers, database)
+        try:
+            asyncio.run(_wait_ready(port, server))
+            # Connections, plans and templates warm in every worker before timing
+            asyncio.run(_step(port, workers * 4, 1.0, traffic))
+            for n in clients:
+                samples, errors, wall = asyncio.run(_step(port, n, seconds, traffic))
+                if not samples:
+                    raise Exception(f"No requests completed in {mode} mode with {n} clients: {errors[:3]}")
+                results.append({'group': 'load', 'name': f"{mode} x{n} clients{suffix}", **summarize(samples),
+                                'ops_per_sec': round(len(samples) / wall, 2), 'clients': n, 'errors': len(errors),
+                                'error_samples': sorted(set(errors))[:5],
+                                'request_slots': workers * threads if mode == 'sync' else None,
+                                'workers': workers, 'db_delay_ms': db_delay * 1000})
+        finally:
+            server.terminate()
+            server.wait(30)
+    if proxy is not None:
+        proxy.stop()
+    return results
@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
+from typing import Any, Iterator
+
+from benchmarks.timing import measure, measure_memory
+from src import labels
+from src.allocators import FeistelAllocator, SequenceAllocator
+from src.data_handling import ConnectionPool, MealDB, PantryDB
+from src.shopping_list import build_shopping_list, generate_shopping_list
+
+# Microbenchmarks for the CPU-bound paths behind /pantry/label/image and /download_shopping_list,
+# and for the data layer pieces those routes and the intake route lean on. PDFs are generated
+# straight from the library functions, so the PDF cache never hides the rendering cost.
+
+ITEM_ID = '2087060470'
+EXPIRES = '2030-01-01'
+ITEM_NAME = 'Fresh tomato 42'
+
+def _serials(n: int) -> list[str]:
+    return [str(1000000000 + i) for i in range(n)]
+
+def _size(out) -> int:
+    size = out.seek(0, 2)
+    out.close()
+    return size
+
+# Render labels with a given number of render processes, 0 renders in this thread
+@contextmanager
+def _label_workers(workers: int) -> Iterator[None]:
+    previous = labels.LABEL_WORKERS
+    labels.LABEL_WORKERS = workers
+    try:
+        yield
+    finally:
+        labels.LABEL_WORKERS = previous
+
+# Time each label renderer over the given job sizes, rendering in this thread, with the PDF size
+def bench_labels(label_counts: list[int], iterations: int) -> list[dict[str, Any]]:
+    results = []
+    with _label_workers(0):
+        for renderer in labels.RENDERERS:
+            for n in label_counts:
+                sizes = []
+                render = lambda i: sizes.append(_size(labels.generate_labels(_serials(n), ITEM_ID, EXPIRES, ITEM_NAME, renderer)))
+                results.append(measure('labels', f"{renderer} x{n}", render, max(3, min(iterations, 1000 // n)),
+                                       warmup=1, labels=n))
+                results[-1]['pdf_bytes'] = sizes[-1]
+    return results
+
+# Raster jobs spread over the render processes, to compare with the same jobs rendered in this
+# thread by bench_labels. Jobs under LABEL_PARALLEL_MIN labels stay in the thread either way, so
+# they are skipped, and so is everything when there are fewer than two workers.
+def bench_label_parallel(label_counts: list[int], iterations: int, workers: int) -> list[dict[str, Any]]:
+    results = []
+    if workers < 2:
+        return results
+    with _label_workers(workers):
+        for n in (n for n in label_counts if n >= labels.LABEL_PARALLEL_MIN):
+            render = lambda i: _size(labels.generate_labels(_serials(n), ITEM_ID, EXPIRES, ITEM_NAME, 'raster'))
+            results.append(measure('labels', f"raster x{n} parallel", render, max(3, min(iterations, 1000 // n)),
+                                   warmup=1, labels=n, workers=workers))
+    return results
+
+# Peak Python heap while rendering a label job or shopping list into a spooled temporary file,
+# as send_pdf does, so the footprint of one request can be tracked
+def bench_memory(label_counts: list[int], shopping_lines: int) -> list[dict[str, Any]]:
+    results = []
+    with _label_workers(0):
+        for renderer in labels.RENDERERS:
+            for n in label_counts:
+                labels.item_template.cache_clear()
+                size, elapsed, peak = measure_memory(lambda: _size(labels.generate_labels(
+                    _serials(n), ITEM_ID, EXPIRES, ITEM_NAME, renderer, SpooledTemporaryFile(max_size=1024 * 1024))))
+                results.append({'group': 'memory', 'name': f"labels {renderer} x{n}", 'seconds': round(elapsed, 4),
+                                'peak_mib': round(peak / 2**20, 3), 'pdf_bytes': size})
+    half = shopping_lines // 2
+    shopping_list = {'week': '2030-W01', 'items': [{'name': f"Item {i}"} for i in range(half)],
+                     'check_items': [{'name': f"Check {i}"} for i in range(shopping_lines - half)], 'additional_items': []}
+    size, elapsed, peak = measure_memory(lambda: _size(generate_shopping_list(
+        shopping_list, SpooledTemporaryFile(max_size=1024 * 1024))))
+    results.append({'group': 'memory', 'name': f"shopping list {shopping_lines} lines", 'seconds': round(elapsed, 4),
+                    'peak_mib': round(peak / 2**20, 3), 'pdf_bytes': size})
+    return results
+
+# Time building and rendering the shopping list of the seeded week with the most ingredients
+def bench_shopping_list(pool: ConnectionPool, weeks: list[str], iterations: int) -> list[dict[str, Any]]:
+    mdb = MealDB(pool)
+    pdb = PantryDB(pool)
+    plans = {week: mdb.load_week(week) for week in weeks}
+    count = lambda plan: sum(len(value) for key, value in plan.items() if key.endswith('_ingredients'))
+    week = max(plans, key=lambda week: count(plans[week]))
+    ingredients = count(plans[week])
+    shopping_list = build_shopping_list(week, plans[week], pdb)
+    lines = len(shopping_list['items']) + len(shopping_list['check_items']) + len(shopping_list['additional_items'])
+    return [
+        measure('shopping_list', 'build 7 days', lambda i: build_shopping_list(week, plans[week], pdb), iterations,
+                ingredients=ingredients),
+        measure('shopping_list', 'render 7 days', lambda i: _size(generate_shopping_list(shopping_list)), iterations,
+                ingredients=ingredients, lines=lines),
+    ]
+
+# IDs handed out per second by each allocator, for batches the size of one, 50 and 1000 unit intakes
+def bench_allocators(pool: ConnectionPool, iterations: int) -> list[dict[str, Any]]:
+    results = []
+    for allocator in (FeistelAllocator('pantry_serial'), SequenceAllocator('pantry_serial')):
+        kind = type(allocator).__name__
+        for n in (1, 50, 1000):
+            with pool.connection() as conn:
+                result = measure('allocators', f"{kind} x{n}", lambda i: allocator.allocate(conn, n), iterations, ids=n)
+                conn.commit()
+            result['ids_per_sec'] = round(result['ops_per_sec'] * n, 2)
+            results.append(result)
+    return results
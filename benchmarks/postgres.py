@@ -0,0 +1,142 @@
+from contextlib import contextmanager
+from typing import Iterator
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import uuid
+import psycopg2
+
+# Throwaway Postgres databases for the benchmarks, so they never touch real data.
+# TemporaryCluster runs initdb and a private postmaster in a temporary directory, listening on a
+# Unix socket there and a free local port. ScratchServer uses the server named by the DB_*
+# environment variables instead, creating and dropping uniquely named databases on it.
+# Both hand out connection parameters in the form of the DB_* variables the app reads.
+
+# Settings for the private cluster, sized for a laptop rather than tuned for speed. Durability
+# settings are left at their defaults so commit costs stay comparable with a real server.
+CLUSTER_SETTINGS = {
+    'shared_buffers': '128MB',
+    'max_connections': '100',
+    'listen_addresses': "'127.0.0.1'",
+}
+
+# Find a PostgreSQL binary in PG_BIN, on the PATH or in the directory reported by pg_config
+def _pg_binary(name: str) -> str:
+    if (bin_dir := os.getenv("PG_BIN")) and os.path.exists(path := os.path.join(bin_dir, name)):
+        return path
+    if path := shutil.which(name):
+        return path
+    if pg_config := shutil.which('pg_config'):
+        bin_dir = subprocess.run([pg_config, '--bindir'], capture_output=True, text=True).stdout.strip()
+        if os.path.exists(path := os.path.join(bin_dir, name)):
+            return path
+    raise Exception(f"Could not find {name}, set PG_BIN to the PostgreSQL bin directory")
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# TemporaryCluster is a private Postgres instance that is deleted when it is stopped
+class TemporaryCluster:
+    def __init__(self):
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            raise Exception("initdb refuses to run as root, run the benchmarks as another user or use --postgres server")
+        self.directory = tempfile.mkdtemp(prefix='meal-planner-bench-')
+        self.data_dir = os.path.join(self.directory, 'data')
+        self.port = _free_port()
+        self.password = uuid.uuid4().hex
+        self.__started = False
+
+    def start(self) -> None:
+        password_file = os.path.join(self.directory, 'password')
+        with open(password_file, 'w') as file:
+            file.write(self.password)
+        subprocess.run([_pg_binary('initdb'), '-D', self.data_dir, '-U', 'postgres', '-A', 'scram-sha-256',
+                        '--pwfile', password_file, '-E', 'UTF8', '--no-sync'],
+                       check=True, capture_output=True)
+        options = ' '.join(f"-c {name}={value}" for name, value in CLUSTER_SETTINGS.items())
+        subprocess.run([_pg_binary('pg_ctl'), '-D', self.data_dir, '-l', os.path.join(self.directory, 'postgres.log'),
+                        '-o', f"-p {self.port} -k {self.directory} {options}", '-w', 'start'],
+                       check=True, capture_output=True)
+        self.__started = True
+
+    def stop(self) -> None:
+        if self.__started:
+            subprocess.run([_pg_binary('pg_ctl'), '-D', self.data_dir, '-m', 'immediate', '-w', 'stop'],
+                           capture_output=True)
+            self.__started = False
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def params(self, database: str) -> dict[str, str]:
+        return {'DB_HOST': '127.0.0.1', 'DB_PORT': str(self.port), 'DB_NAME': database,
+                'DB_USER': 'postgres', 'DB_PASSWORD': self.password}
+
+    @contextmanager
+    def database(self, prefix: str = 'bench') -> Iterator[dict[str, str]]:
+        with _scratch_database(self.params('postgres'), prefix) as params:
+            yield params
+
+# ScratchServer creates benchmark databases on the server named by the DB_* environment variables
+class ScratchServer:
+    def __init__(self):
+        self.admin = {name: os.getenv(name) for name in ('DB_HOST', 'DB_PORT', 'DB_USER', 'DB_PASSWORD')}
+        if not self.admin['DB_HOST']:
+            raise Exception("No database host specified")
+        self.admin['DB_PORT'] = self.admin['DB_PORT'] or '5432'
+        self.admin['DB_NAME'] = 'postgres'
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    @contextmanager
+    def database(self, prefix: str = 'bench') -> Iterator[dict[str, str]]:
+        with _scratch_database(self.admin, prefix) as params:
+            yield params
+
+# Open a plain connection to the database described by params, outside any pool
+def connect(params: dict[str, str]):
+    return psycopg2.connect(host=params['DB_HOST'], port=int(params['DB_PORT']), dbname=params['DB_NAME'],
+                            user=params['DB_USER'], password=params['DB_PASSWORD'])
+
+# Create a uniquely named database next to the one in params, dropping it afterwards. It is UTF8, as
+# the initdb cluster and production databases are, whatever the server's default encoding.
+@contextmanager
+def _scratch_database(params: dict[str, str], prefix: str) -> Iterator[dict[str, str]]:
+    name = f"meal_planner_{prefix}_{uuid.uuid4().hex[:8]}"
+    conn = connect(params)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"CREATE DATABASE {name} TEMPLATE template0 ENCODING 'UTF8'")
+        try:
+            yield {**params, 'DB_NAME': name}
+        finally:
+            with conn.cursor() as cur:
+                cur.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE)")
+    finally:
+        conn.close()
+
+# Start the Postgres stand-in of the given kind: 'initdb' for a private cluster, 'server' for
+# scratch databases on the DB_* server, or 'auto' to use the server when DB_HOST is set
+@contextmanager
+def postgres(kind: str = 'auto') -> Iterator[TemporaryCluster | ScratchServer]:
+    if kind == 'auto':
+        kind = 'server' if os.getenv("DB_HOST") else 'initdb'
+    if kind not in ('initdb', 'server'):
+        raise Exception(f"Unknown Postgres kind: {kind}")
+    instance = TemporaryCluster() if kind == 'initdb' else ScratchServer()
+    try:
+        instance.start()
+        yield instance
+    finally:
+        instance.stop()
+
+# Point the DB_* environment variables at a database, for code that builds its pool from them
+def use_database(params: dict[str, str]) -> None:
+    os.environ.update(params)
@@ -0,0 +1,180 @@
+from datetime import date, timedelta
+from types import ModuleType
+from typing import Any, Callable
+import random
+
+from benchmarks.seed import SEARCH_QUERIES, make_week
+from benchmarks.timing import WARMUP, measure, measure_concurrent
+
+# Route benchmarks: every app.py route is driven through the Flask test client against the seeded
+# database, so each measurement covers routing, the data layer, SQL and template rendering.
+# Routes that change data draw from pools of seeded rows set aside for them, so they never remove
+# rows the read-only routes are sampling.
+
+def _expect(*statuses: int) -> Callable[[int], None]:
+    def check(status: int) -> None:
+        if status not in statuses:
+            raise Exception(f"Unexpected status {status}, expected {', '.join(map(str, statuses))}")
+    return check
+
+OK = _expect(200)
+REDIRECT = _expect(302)
+ACCEPTED = _expect(202)
+
+# RouteBench runs the route benchmarks against an imported app module and the seeded data
+class RouteBench:
+    def __init__(self, app: ModuleType, data: dict[str, list], iterations: int, threads: int, seed_value: int = 0):
+        self.app = app
+        self.client = app.app.test_client()
+        self.iterations = iterations
+        self.threads = threads
+        self.rng = random.Random(seed_value)
+        self.items = data['items']
+        self.stocked = self.items[:max(1, len(self.items) // 5)]
+        self.weeks = data['weeks']
+        # Half the serials are only ever read, the other half are consumed by the deleting routes
+        half = len(data['serials']) // 2
+        self.read_serials = data['serials'][:half]
+        self.spare_serials = data['serials'][half:]
+        self.results: list[dict[str, Any]] = []
+
+    # Send a request and read the whole body, returning the status code
+    def call(self, method: str, path: str, **kwargs) -> int:
+        response = self.client.open(path, method=method, **kwargs)
+        response.get_data()
+        response.close()
+        return response.status_code
+
+    def take_serials(self, n: int) -> list[int]:
+        if len(self.spare_serials) < n:
+            raise Exception("Not enough seeded serials left, use a larger scale or fewer iterations")
+        taken = self.spare_serials[-n:]
+        del self.spare_serials[-n:]
+        return taken
+
+    def bench(self, name: str, fn: Callable[[int], int], check: Callable[[int], None] = OK,
+              iterations: int | None = None, **extra: Any) -> None:
+        self.results.append(measure('routes', name, fn, iterations or self.iterations, check=check, **extra))
+
+    def run(self) -> list[dict[str, Any]]:
+        rng = self.rng
+        week = lambda i: self.weeks[i % len(self.weeks)]
+        serial = lambda i: self.read_serials[rng.randrange(len(self.read_serials))]
+        item = lambda i: rng.choice(self.stocked)
+        label_base = {'item_id': str(self.stocked[0]), 'expiration_date': '2030-01-01', 'renderer': 'raster'}
+
+        # Pages and read-only JSON
+        self.bench('GET /', lambda i: self.call('GET', '/'))
+        self.bench('GET /get_week_items', lambda i: self.call('GET', '/get_week_items', query_string={'week': week(i)}))
+        self.bench('GET /weeks', lambda i: self.call('GET', '/weeks', query_string={'start': self.weeks[0], 'end': self.weeks[-1]}))
+        self.bench('GET /weeks/using_item', lambda i: self.call('GET', '/weeks/using_item', query_string={'item_id': item(i)}))
+        self.bench('GET /pantry', lambda i: self.call('GET', '/pantry'))
+        self.bench('GET /pantry/items', lambda i: self.call('GET', '/pantry/items'))
+        self.bench('GET /pantry/items?q', lambda i: self.call('GET', '/pantry/items', query_string={'q': 'fresh'}))
+        self.bench('GET /pantry/items?category&sort=name',
+                   lambda i: self.call('GET', '/pantry/items', query_string={'category': 'Dairy', 'sort': 'name'}))
+        next_page = self.client.get('/pantry/items').get_json()['next']
+        self.bench('GET /pantry/items?after', lambda i: self.call('GET', '/pantry/items', query_string={'after': next_page}))
+        self.bench('GET /pantry/intake', lambda i: self.call('GET', '/pantry/intake'),
+                   iterations=max(5, self.iterations // 10), directory_items=len(self.items))
+        self.bench('POST /pantry/get_by_serial', lambda i: self.call('POST', '/pantry/get_by_serial', data={'serial': serial(i)}))
+        self.bench('POST /pantry/get_count', lambda i: self.call('POST', '/pantry/get_count', data={'item_id': item(i)}))
+        self.bench('POST /pantry/directory/get_item',
+                   lambda i: self.call('POST', '/pantry/directory/get_item', data={'item_id': rng.choice(self.items)}))
+        for query in SEARCH_QUERIES:
+            self.bench(f"GET /pantry/directory/search?q={query}",
+                       lambda i, query=query: self.call('GET', '/pantry/directory/search', query_string={'q': query}))
+        self.bench('GET /stats', lambda i: self.call('GET', '/stats'))
+        self.bench('GET /metrics', lambda i: self.call('GET', '/metrics'))
+
+        # Unchanged views revalidated with the ETag of a previous response, next to the full responses above
+        views = [('/pantry', {}), ('/pantry/intake', {}), ('/get_week_items', {'week': self.weeks[0]})]
+        etags = {path: self.client.get(path, query_string=query).headers['ETag'] for path, query in views}
+        for path, query in views:
+            self.bench(f"GET {path} (304)", lambda i, path=path, query=query: self.call(
+                'GET', path, query_string=query, headers={'If-None-Match': etags[path]}), check=_expect(304))
+
+        # Shopping lists: JSON, and the PDF, which is served from the PDF cache after the first render
+        self.bench('GET /shopping_list', lambda i: self.call('GET', '/shopping_list', query_string={'week': week(i)}))
+        self.bench('GET /download_shopping_list', lambda i: self.call('GET', '/download_shopping_list', query_string={'week': week(i)}))
+
+        # Labels: the print page, a fresh PDF each time, the same PDF again, and a revalidation
+        self.bench('GET /pantry/label', lambda i: self.call('GET', '/pantry/label', query_string={**label_base, 'serials': serial(i)}))
+        self.bench('GET /pantry/label/image (render 4)', lambda i: self.call('GET', '/pantry/label/image', query_string={
+            **label_base, 'serials': ','.join(str(1000000000 + i * 4 + k) for k in range(4))}),
+            iterations=max(5, self.iterations // 5))
+        cached = {**label_base, 'serials': '1000000001,1000000002,1000000003,1000000004'}
+        self.bench('GET /pantry/label/image (cached 4)', lambda i: self.call('GET', '/pantry/label/image', query_string=cached))
+        etag = self.client.get('/pantry/label/image', query_string=cached).headers['ETag']
+        self.bench('GET /pantry/label/image (304)',
+                   lambda i: self.call('GET', '/pantry/label/image', query_string=cached, headers={'If-None-Match': etag}),
+                   check=_expect(304))
+
+        # Render jobs: queueing, polling, and downloading a finished job
+        self.bench('POST /jobs/labels', lambda i: self.call('POST', '/jobs/labels', data={
+            **label_base, 'serials': str(2000000000 + i)}), check=ACCEPTED)
+        self.bench('POST /jobs/shopping_list', lambda i: self.call('POST', '/jobs/shopping_list', data={'week': week(i)}),
+                   check=ACCEPTED)
+        job_id = self.client.post('/jobs/labels', data={**label_base, 'serials': '3000000000'}).get_json()['id']
+        while self.app.jobs.run_one():
+            pass
+        self.bench('GET /jobs/<id>', lambda i: self.call('GET', f"/jobs/{job_id}"))
+        self.bench('GET /jobs/<id>/result', lambda i: self.call('GET', f"/jobs/{job_id}/result"))
+
+        # Writes
+        unchanged = self.week_form(self.weeks[-1], self.app.mdb.load_week(self.weeks[-1]))
+        self.bench('POST /save_week (unchanged)', lambda i: self.call('POST', '/save_week', data=unchanged), check=REDIRECT)
+        bench_week = (date.today() + timedelta(weeks=60)).isocalendar()
+        bench_week = f"{bench_week[0]}-W{bench_week[1]:02d}"
+        plans = [self.week_form(bench_week, make_week(self.items, rng)) for _ in range(WARMUP + self.iterations)]
+        self.bench('POST /save_week (changed)', lambda i: self.call('POST', '/save_week', data=plans[i]), check=REDIRECT)
+        for quantity in (1, 50, 1000):
+            self.bench(f"POST /pantry/intake/add (qty {quantity})", lambda i, quantity=quantity: self.call(
+                'POST', '/pantry/intake/add', data={'item_id': item(i), 'expiration_date': '2030-01-01', 'quantity': quantity}),
+                check=REDIRECT, iterations=max(5, self.iterations // (10 if quantity >= 1000 else 1)))
+        self.bench('POST /pantry/delete', lambda i: self.call('POST', '/pantry/delete', data={'serial': self.take_serials(1)[0]}),
+                   check=REDIRECT)
+        self.bench('POST /pantry/delete_by_serial',
+                   lambda i: self.call('POST', '/pantry/delete_by_serial', data={'serial': self.take_serials(1)[0]}), check=REDIRECT)
+        self.bench('POST /pantry/delete_oldest_by_id',
+                   lambda i: self.call('POST', '/pantry/delete_oldest_by_id', data={'item_id': item(i)}), check=REDIRECT)
+        self.bench('POST /pantry/checkout (5 serials, 2 items)', lambda i: self.call('POST', '/pantry/checkout', json={
+            'serials': self.take_serials(5), 'items': [{'id': item(i), 'qty': 1}, {'id': item(i), 'qty': 2}]}))
+        self.bench('POST /pantry/directory/add', lambda i: self.call('POST', '/pantry/directory/add', data={
+            'name': f"bench item {i}", 'category': 'Ingredients'}), check=REDIRECT)
+        doomed = [self.app.pddb.add_item(f"bench doomed {i}", 'Ingredients') for i in range(WARMUP + self.iterations)]
+        self.bench('POST /pantry/directory/delete',
+                   lambda i: self.call('POST', '/pantry/directory/delete', data={'item_id': doomed[i]}), check=REDIRECT)
+
+        # Mixed read traffic from concurrent clients, as a web worker with several threads sees it
+        mixed = [
+            lambda i: self.call('GET', '/pantry/directory/search', query_string={'q': SEARCH_QUERIES[i % 2]}),
+            lambda i: self.call('POST', '/pantry/get_count', data={'item_id': item(i)}),
+            lambda i: self.call('GET', '/pantry/items'),
+            lambda i: self.call('GET', '/get_week_items', query_string={'week': week(i)}),
+        ]
+        self.results.append(measure_concurrent('routes', 'mixed reads (concurrent)', lambda i: mixed[i % len(mixed)](i),
+                                               self.iterations * len(mixed), self.threads, check=OK))
+
+        # Several tablets polling views that have not changed since the writes above, without and with their ETags
+        etags = {path: self.client.get(path, query_string=query).headers['ETag'] for path, query in views}
+        poll = lambda i, revalidate: self.call('GET', views[i % len(views)][0], query_string=views[i % len(views)][1],
+                                               headers={'If-None-Match': etags[views[i % len(views)][0]]} if revalidate else {})
+        self.results.append(measure_concurrent('routes', 'unchanged views full (concurrent)', lambda i: poll(i, False),
+                                               self.iterations * len(views), self.threads, check=OK))
+        self.results.append(measure_concurrent('routes', 'unchanged views revalidated (concurrent)', lambda i: poll(i, True),
+                                               self.iterations * len(views), self.threads, check=_expect(304)))
+        return self.results
+
+    # Turn a saved week back into the form the meal planner posts
+    @staticmethod
+    def week_form(week: str, data: dict) -> dict:
+        form = {'week': week}
+        for key, value in data.items():
+            if key.endswith('_ingredients'):
+                section = key.removesuffix('_ingredients')
+                form[f"{section}_ingredients[]"] = [str(entry['id']) for entry in value]
+                form[f"{section}_quantities[]"] = [str(entry['qty']) for entry in value]
+            else:
+                form[key] = value
+        return form
@@ -0,0 +1,61 @@
+from typing import Any, Callable
+import random
+
+from benchmarks.seed import SEARCH_QUERIES, make_pool, seed_directory, seed_pantry
+from benchmarks.timing import measure
+from src.data_handling import PantryDB, PantryDirectoryDB
+from src.migrations import migrate
+
+# Scaling benchmarks: directory search and pantry stock lookups measured in fresh databases of
+# growing size, so the curve shows whether a lookup stays flat as the tables grow. Each size gets
+# as many directory items as pantry serials. The stock lookups are measured next to the aggregate
+# queries they replaced, which scan every pantry row of the item.
+
+def bench_scaling(database: Callable, sizes: list[int], categories: list[str], iterations: int,
+                  seed_value: int = 0) -> list[dict[str, Any]]:
+    results = []
+    for size in sizes:
+        with database(f"scale{size}") as params:
+            pool = make_pool(params)
+            try:
+                rng = random.Random(seed_value)
+                migrate(pool)
+                item_ids = seed_directory(pool, size, categories, rng)
+                seed_pantry(pool, size, item_ids, rng)
+                with pool.connection() as conn:
+                    conn.autocommit = True
+                    with conn.cursor() as cur:
+                        cur.execute("ANALYZE")
+                    conn.autocommit = False
+                results.extend(_bench_size(pool, size, item_ids, iterations, rng))
+            finally:
+                pool.close()
+    return results
+
+def _bench_size(pool, size: int, item_ids: list[int], iterations: int, rng: random.Random) -> list[dict[str, Any]]:
+    # The directory cache is disabled so every search and lookup reaches the database
+    pddb = PantryDirectoryDB(pool, cache_size=1, cache_check_interval=0)
+    pdb = PantryDB(pool)
+    stocked = item_ids[:max(1, len(item_ids) // 5)]
+    item = lambda i: rng.choice(stocked)
+
+    def scalar(sql: str) -> Callable[[int], Any]:
+        def run(i: int) -> Any:
+            with pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(sql, (item(i),))
+                return cur.fetchone()[0]
+        return run
+
+    results = [
+        measure('scaling', f"search {query!r} @{size}", lambda i, query=query: pddb.search(query), iterations, rows=size)
+        for query in SEARCH_QUERIES
+    ]
+    results += [
+        measure('scaling', f"item_count @{size}", lambda i: pdb.item_count(item(i)), iterations, rows=size),
+        measure('scaling', f"count(*) baseline @{size}", scalar("SELECT count(*) FROM pantry WHERE id = %s"),
+                iterations, rows=size),
+        measure('scaling', f"next_expiration @{size}", lambda i: pdb.next_expiration(item(i)), iterations, rows=size),
+        measure('scaling', f"min(expiration_date) baseline @{size}",
+                scalar("SELECT min(expiration_date) FROM pantry WHERE id = %s"), iterations, rows=size),
+    ]
+    return results
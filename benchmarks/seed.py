@@ -0,0 +1,113 @@
+from datetime import date, timedelta
+import os
+import random
+
+from src.allocators import make_allocator
+from src.data_handling import ConnectionPool, MealDB
+from src.migrations import migrate
+
+# Synthetic pantry data for the benchmarks. Everything is drawn from a seeded random generator,
+# so the same scale and seed give the same database on every run and every commit.
+
+# Data set sizes: directory items, pantry serials and saved meal weeks
+SCALES = {
+    'small': {'items': 1_000, 'serials': 10_000, 'weeks': 8},
+    'medium': {'items': 10_000, 'serials': 100_000, 'weeks': 26},
+    'large': {'items': 100_000, 'serials': 1_000_000, 'weeks': 52},
+}
+
+CHUNK_SIZE = 10_000
+DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# Item names are an adjective, a food and a number, so searches match a realistic spread of rows
+ADJECTIVES = ['fresh', 'frozen', 'dried', 'smoked', 'organic', 'canned', 'roasted', 'spicy', 'sweet', 'whole',
+              'sliced', 'ground', 'pickled', 'salted', 'baby', 'wild', 'aged', 'light', 'green', 'red']
+FOODS = ['tomato', 'basil', 'chicken', 'beef', 'salmon', 'rice', 'pasta', 'beans', 'lentils', 'cheddar',
+         'yogurt', 'butter', 'onion', 'garlic', 'pepper', 'spinach', 'potato', 'carrot', 'apple', 'oats',
+         'tuna', 'corn', 'peas', 'flour', 'sugar', 'coffee', 'tea', 'milk', 'bread', 'mushroom']
+
+# Searches used by the route and scaling benchmarks: a common prefix, a substring and a miss
+SEARCH_QUERIES = ['fresh', 'toma', 'zzzz']
+
+# Build a pool for a database described by DB_* style parameters
+def make_pool(params: dict[str, str], max_size: int = 10) -> ConnectionPool:
+    return ConnectionPool(params['DB_HOST'], params['DB_NAME'], params['DB_USER'], params['DB_PASSWORD'],
+                          int(params['DB_PORT']), max_size=max_size)
+
+def _week_name(day: date) -> str:
+    year, week, _ = day.isocalendar()
+    return f"{year}-W{week:02d}"
+
+# Add n directory items, returning their IDs. IDs come from the app's allocator, so items added
+# later by the benchmarks never collide with seeded ones.
+def seed_directory(pool: ConnectionPool, n: int, categories: list[str], rng: random.Random) -> list[int]:
+    allocator = make_allocator(os.getenv("ID_ALLOCATOR", "feistel"), 'pantry_directory_id')
+    item_ids = []
+    with pool.connection() as conn, conn.cursor() as cur:
+        for start in range(0, n, CHUNK_SIZE):
+            ids = allocator.allocate(conn, min(CHUNK_SIZE, n - start))
+            names = [f"{rng.choice(ADJECTIVES)} {rng.choice(FOODS)} {start + i}" for i in range(len(ids))]
+            cur.execute("""
+                INSERT INTO pantry_directory (id, name, category)
+                SELECT * FROM unnest(%s::bigint[], %s::varchar[], %s::varchar[])
+            """, (ids, names, [rng.choice(categories) for _ in ids]))
+            item_ids.extend(ids)
+        conn.commit()
+    return item_ids
+
+# Add n pantry serials spread over a fifth of the directory, expiring between a month ago and a
+# year from now, returning the serials
+def seed_pantry(pool: ConnectionPool, n: int, item_ids: list[int], rng: random.Random) -> list[int]:
+    allocator = make_allocator(os.getenv("ID_ALLOCATOR", "feistel"), 'pantry_serial')
+    stocked = item_ids[:max(1, len(item_ids) // 5)]
+    today = date.today()
+    serials = []
+    with pool.connection() as conn, conn.cursor() as cur:
+        for start in range(0, n, CHUNK_SIZE):
+            batch = allocator.allocate(conn, min(CHUNK_SIZE, n - start))
+            cur.execute("""
+                INSERT INTO pantry (serial, id, name, category, ingestion_date, expiration_date)
+                SELECT s.serial, d.id, d.name, d.category, s.ingested, s.expires
+                FROM unnest(%s::bigint[], %s::bigint[], %s::timestamp[], %s::date[]) AS s(serial, id, ingested, expires)
+                JOIN pantry_directory d ON d.id = s.id
+            """, (batch, [rng.choice(stocked) for _ in batch],
+                  [today - timedelta(days=rng.randint(0, 90)) for _ in batch],
+                  [today + timedelta(days=rng.randint(-30, 365)) for _ in batch]))
+            serials.extend(batch)
+        conn.commit()
+    return serials
+
+# Build one week's meal plan: a meal and 8 to 16 ingredients a day plus 10 to 20 additional items
+def make_week(item_ids: list[int], rng: random.Random) -> dict:
+    stocked = item_ids[:max(1, len(item_ids) // 5)]
+    ingredients = lambda n: [{'id': str(rng.choice(stocked if rng.random() < 0.7 else item_ids)),
+                              'qty': rng.randint(1, 4)} for _ in range(n)]
+    week = {}
+    for day in DAYS:
+        week[day] = f"{rng.choice(ADJECTIVES)} {rng.choice(FOODS)} bowl"
+        week[f"{day}_recipe"] = ''
+        week[f"{day}_ingredients"] = ingredients(rng.randint(8, 16))
+    week['additional_ingredients'] = ingredients(rng.randint(10, 20))
+    return week
+
+# Save meal plans for the n weeks up to this one, returning the week names oldest first
+def seed_weeks(pool: ConnectionPool, n: int, item_ids: list[int], rng: random.Random) -> list[str]:
+    mdb = MealDB(pool)
+    weeks = [_week_name(date.today() - timedelta(weeks=k)) for k in reversed(range(n))]
+    for week in weeks:
+        mdb.save_week(week, make_week(item_ids, rng))
+    return weeks
+
+# Migrate an empty database and fill it, returning the seeded IDs, serials and weeks
+def seed(pool: ConnectionPool, scale: dict[str, int], categories: list[str], seed_value: int = 0) -> dict[str, list]:
+    rng = random.Random(seed_value)
+    migrate(pool)
+    item_ids = seed_directory(pool, scale['items'], categories, rng)
+    serials = seed_pantry(pool, scale['serials'], item_ids, rng)
+    weeks = seed_weeks(pool, scale['weeks'], item_ids, rng)
+    with pool.connection() as conn:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE")
+        conn.autocommit = False
+    return {'items': item_ids, 'serials': serials, 'weeks': weeks}
@@ -0,0 +1,88 @@
+from json import loads
+from typing import Any
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.timing import summarize
+
+# Startup benchmarks, each run in fresh interpreters so nothing is already imported or connected:
+# - `python -X importtime -c "import app"`, reporting the cumulative import time of app and whether
+#   the PDF and imaging stack was loaded by it
+# - a cold start: a new process imports the app and serves its first request, then its first label
+# - a preloaded worker: the app is imported and warmed up, the process forks as gunicorn does with
+#   preload_app, and the child serves its first request and first label
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PDF_MODULES = ('reportlab', 'PIL', 'barcode')
+
+# Child process for the cold start and preloaded worker runs, printing its timings as JSON
+CHILD = r'''
+import json, os, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+if sys.argv[1] == 'preload':
+    app.warm_up()
+    if (pid := os.fork()):
+        os.waitpid(pid, 0)
+        os._exit(0)
+client = app.app.test_client()
+start = time.perf_counter()
+assert client.get('/pantry/directory/search', query_string={'q': 'fresh'}).status_code == 200
+first_request = time.perf_counter() - start
+start = time.perf_counter()
+response = client.get('/pantry/label/image', query_string={'serials': '1000000001', 'item_id': '1000000001',
+                                                           'expiration_date': '2030-01-01', 'renderer': 'raster'})
+assert response.status_code == 200, response.status_code
+response.get_data()
+first_label = time.perf_counter() - start
+print(json.dumps({'import': imported - started, 'first_request': first_request, 'first_label': first_label}), flush=True)
+'''
+
+def _env() -> dict[str, str]:
+    env = {**os.environ, 'PDF_CACHE_SIZE': '0', 'LABEL_WORKERS': '0'}
+    env.pop('METRICS_DIR', None)
+    return env
+
+def _import_time() -> tuple[float, bool]:
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=ROOT, env=_env(),
+                            capture_output=True, text=True, check=True)
+    cumulative = None
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('| package'):
+            continue
+        _, total, name = line.split('|')
+        modules.add(name.strip().split('.')[0])
+        if name.strip() == 'app':
+            cumulative = int(total) / 1e6
+    if cumulative is None:
+        raise Exception("app was not imported")
+    return cumulative, any(module in modules for module in PDF_MODULES)
+
+def _child(mode: str) -> tuple[dict[str, float], float]:
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', CHILD, mode], cwd=ROOT, env=_env(), capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0 or not result.stdout.strip():
+        raise Exception(f"Startup child failed: {result.stderr.strip()[-2000:]}")
+    return loads(result.stdout.strip().splitlines()[-1]), wall
+
+def bench_startup(runs: int) -> list[dict[str, Any]]:
+    imports = [_import_time() for _ in range(runs)]
+    results = [{'group': 'startup', 'name': 'import app (-X importtime)', **summarize([seconds for seconds, _ in imports]),
+                'pdf_stack_imported': any(loaded for _, loaded in imports)}]
+
+    cold = [_child('cold') for _ in range(runs)]
+    results.append({'group': 'startup', 'name': 'cold start: spawn to first label', **summarize([wall for _, wall in cold])})
+    for phase in ('import', 'first_request', 'first_label'):
+        results.append({'group': 'startup', 'name': f"cold start: {phase.replace('_', ' ')}",
+                        **summarize([timings[phase] for timings, _ in cold])})
+
+    preloaded = [_child('preload')[0] for _ in range(runs)]
+    for phase in ('first_request', 'first_label'):
+        results.append({'group': 'startup', 'name': f"preloaded worker: {phase.replace('_', ' ')}",
+                        **summarize([timings[phase] for timings in preloaded])})
+    return results
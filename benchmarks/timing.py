@@ -0,0 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+import gc
+import time
+import tracemalloc
+
+# Measurement helpers. Every benchmark produces a flat result dict with a group and name, plus
+# latency percentiles in milliseconds and throughput in operations per second where they apply.
+
+# Untimed calls made before measuring, so caches, prepared plans and lazy imports are warm
+WARMUP = 3
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = q / 100 * (len(ordered) - 1)
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    return {
+        'iterations': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 4),
+        'p99_ms': round(percentile(samples, 99) * 1000, 4),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 4),
+        'min_ms': round(min(samples) * 1000, 4),
+        'max_ms': round(max(samples) * 1000, 4),
+        'ops_per_sec': round(len(samples) / sum(samples), 2) if sum(samples) else 0.0,
+    }
+
+# Time fn(i) for each iteration after some untimed warmup calls. Each call's return value is
+# passed to check, which can raise to fail the benchmark on a bad response.
+def measure(group: str, name: str, fn: Callable[[int], Any], iterations: int, warmup: int = WARMUP,
+            check: Callable[[Any], None] | None = None, **extra: Any) -> dict[str, Any]:
+    for i in range(warmup):
+        result = fn(i)
+        if check is not None:
+            check(result)
+    samples = []
+    gc.collect()
+    for i in range(warmup, warmup + iterations):
+        start = time.perf_counter()
+        result = fn(i)
+        samples.append(time.perf_counter() - start)
+        if check is not None:
+            check(result)
+    return {'group': group, 'name': name, **summarize(samples), **extra}
+
+# Run fn(i) for iterations calls spread over threads, reporting per-call latency and the
+# overall throughput, which includes any waiting on locks, the pool or the database
+def measure_concurrent(group: str, name: str, fn: Callable[[int], Any], iterations: int, threads: int,
+                       check: Callable[[Any], None] | None = None, **extra: Any) -> dict[str, Any]:
+    def timed(i: int) -> float:
+        start = time.perf_counter()
+        result = fn(i)
+        elapsed = time.perf_counter() - start
+        if check is not None:
+            check(result)
+        return elapsed
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        start = time.perf_counter()
+        samples = list(executor.map(timed, range(iterations)))
+        wall = time.perf_counter() - start
+    return {'group': group, 'name': name, **summarize(samples), 'threads': threads,
+            'ops_per_sec': round(iterations / wall, 2), **extra}
+
+# Run fn once under tracemalloc, returning its result, its wall time in seconds and the peak
+# Python heap allocated meanwhile in bytes. Memory used by child processes is not counted.
+def measure_memory(fn: Callable[[], Any]) -> tuple[Any, float, int]:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
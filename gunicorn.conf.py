@@ -0,0 +1,40 @@
+import os
+
+# Gunicorn settings, used with `gunicorn -c gunicorn.conf.py app:app`.
+# The app is imported once in the master and warmed up there, with the PDF and imaging stack, label
+# fonts and templates loaded, so workers fork with all of it in memory and share it copy-on-write.
+# Importing the app opens no database connections; each worker opens its own after it has forked.
+# The async serving mode runs asgi.py with the same settings, except threads, which uvicorn workers do
+# not use: `gunicorn -c gunicorn.conf.py -k uvicorn_worker.UvicornWorker asgi:app`.
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", 4))
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+# Set GUNICORN_PRELOAD=0 to import the app in each worker instead, e.g. to reload code on HUP
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") != "0"
+
+# Runs in the master before any worker is forked
+def when_ready(server):
+    if preload_app:
+        import app
+        app.warm_up()
+
+# Runs in each worker once it has loaded the app: connect now so the first request does not have to.
+# If the database is unreachable the worker still starts, and the pool retries on first use.
+def post_worker_init(worker):
+    import app
+    try:
+        app.pool.open()
+    except Exception as e:
+        worker.log.warning("Could not open database connections: %s", e)
+
+# Runs in each worker as it exits: write its last metrics, which are otherwise flushed at most once a second
+def worker_exit(server, worker):
+    from src import metrics
+    metrics.flush(force=True)
+
+# Runs in the master after a worker has exited: fold its metrics snapshot into the total of exited
+# processes, so METRICS_DIR does not keep a file for every worker that has ever run
+def child_exit(server, worker):
+    from src import metrics
+    metrics.retire(worker.pid)
@@ -0,0 +1,140 @@
+from abc import ABC, abstractmethod
+import os
+import secrets
+import threading
+from psycopg2.extensions import connection
+
+# ID allocators hand out the 10-digit, barcode friendly IDs used for directory items and pantry serials.
+# Every allocator draws from a Postgres sequence, so IDs are never handed out twice and inserts do not
+# have to retry on collisions.
+
+ID_MIN = 1000000000
+ID_MAX = 9999999999
+ID_SPACE = ID_MAX - ID_MIN + 1
+
+# Base class for allocators, name is used to derive the database objects backing the allocator
+class IDAllocator(ABC):
+    def __init__(self, name: str):
+        self.name = name
+
+    # Create the database objects the allocator needs
+    @abstractmethod
+    def setup(self, conn: connection) -> None:
+        pass
+
+    # Return n unique IDs, using conn for any database access
+    @abstractmethod
+    def allocate(self, conn: connection, n: int) -> list[int]:
+        pass
+
+# SequenceAllocator hands out consecutive IDs straight from a sequence
+class SequenceAllocator(IDAllocator):
+    def setup(self, conn: connection) -> None:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                CREATE SEQUENCE IF NOT EXISTS {self.name}_seq
+                    MINVALUE {ID_MIN} MAXVALUE {ID_MAX} START WITH {ID_MIN}
+            """)
+
+    def allocate(self, conn: connection, n: int) -> list[int]:
+        with conn.cursor() as cur:
+            cur.execute("SELECT nextval(%s) FROM generate_series(1, %s)", (f"{self.name}_seq", n))
+            return [row[0] for row in cur.fetchall()]
+
+# FeistelAllocator reserves blocks of counter values from a sequence and maps each counter through a
+# keyed Feistel permutation of the 10-digit range, so IDs look random but can never repeat.
+# Each process hands out IDs from its current block without touching the database.
+class FeistelAllocator(IDAllocator):
+    ROUNDS = 4
+    HALF_BITS = 17  # 2 * 17 bits covers the 9 * 10^9 IDs in the 10-digit range
+    HALF_MASK = (1 << HALF_BITS) - 1
+
+    def __init__(self, name: str, block_size: int = 1000):
+        super().__init__(name)
+        if ID_SPACE % block_size:
+            raise Exception("Block size must divide the ID space")
+        self.block_size = block_size
+        self.__lock = threading.Lock()
+        self.__round_keys: list[int] | None = None
+        self.__next = 0
+        self.__end = 0
+        self.__pid = os.getpid()
+
+    def setup(self, conn: connection) -> None:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                CREATE SEQUENCE IF NOT EXISTS {self.name}_block_seq
+                    MINVALUE 0 MAXVALUE {ID_SPACE // self.block_size - 1} START WITH 0
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS id_allocator_keys (
+                    name VARCHAR(64) PRIMARY KEY,
+                    key BIGINT NOT NULL
+                )
+            """)
+            cur.execute("""
+                INSERT INTO id_allocator_keys (name, key) VALUES (%s, %s)
+                ON CONFLICT (name) DO NOTHING
+            """, (self.name, secrets.randbits(62)))
+
+    # The permutation key is stored in the database so every worker maps counters the same way
+    def __load_key(self, conn: connection) -> list[int]:
+        with conn.cursor() as cur:
+            cur.execute("SELECT key FROM id_allocator_keys WHERE name = %s", (self.name,))
+            if not (result := cur.fetchone()):
+                raise Exception(f"No key stored for ID allocator {self.name}")
+        return [self.__mix(result[0] + i) for i in range(self.ROUNDS)]
+
+    @staticmethod
+    def __mix(x: int) -> int:
+        x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        return x ^ (x >> 31)
+
+    def __feistel(self, x: int) -> int:
+        left, right = x >> self.HALF_BITS, x & self.HALF_MASK
+        for key in self.__round_keys:
+            left, right = right, left ^ (self.__mix(right ^ key) & self.HALF_MASK)
+        return (left << self.HALF_BITS) | right
+
+    # Cycle-walk the permutation of the 34-bit space until it lands inside the 10-digit range
+    def permute(self, counter: int) -> int:
+        x = self.__feistel(counter)
+        while x >= ID_SPACE:
+            x = self.__feistel(x)
+        return ID_MIN + x
+
+    def allocate(self, conn: connection, n: int) -> list[int]:
+        with self.__lock:
+            # A forked child must not hand out the rest of its parent's block
+            if self.__pid != os.getpid():
+                self.__pid = os.getpid()
+                self.__next = self.__end = 0
+            if self.__round_keys is None:
+                self.__round_keys = self.__load_key(conn)
+            counters = []
+            while len(counters) < n:
+                if self.__next == self.__end:
+                    blocks = -(-(n - len(counters)) // self.block_size)
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT nextval(%s) FROM generate_series(1, %s)", (f"{self.name}_block_seq", blocks))
+                        reserved = [row[0] for row in cur.fetchall()]
+                    # Blocks are only contiguous by chance, so anything past the first block is used up now
+                    for block in reserved[1:]:
+                        start = block * self.block_size
+                        counters.extend(range(start, start + self.block_size))
+                    self.__next = reserved[0] * self.block_size
+                    self.__end = self.__next + self.block_size
+                take = min(n - len(counters), self.__end - self.__next)
+                counters.extend(range(self.__next, self.__next + take))
+                self.__next += take
+        return [self.permute(counter) for counter in counters[:n]]
+
+# Build an allocator by kind, as configured through the ID_ALLOCATOR environment variable
+def make_allocator(kind: str, name: str) -> IDAllocator:
+    if kind == 'feistel':
+        return FeistelAllocator(name)
+    if kind == 'sequence':
+        return SequenceAllocator(name)
+    raise Exception(f"Unknown ID allocator: {kind}")
@@ -0,0 +1,136 @@
+from datetime import date
+import asyncio
+import os
+import re
+import time
+import asyncpg
+
+from src.data_handling import (DIRECTORY_SEARCH_SQL, PANTRY_PAGE_SQL, database_from_env, directory_search_params,
+                               pantry_page)
+from src.metrics import record_query
+
+# Async data layer for the scanner and autocomplete endpoints of the async serving mode (see asgi.py),
+# on an asyncpg pool. Each method runs the same statement as its counterpart in data_handling, with
+# asyncpg's $n parameters, so both serving modes read and write the same rows the same way.
+
+# Convert a statement with psycopg2's named parameters to asyncpg's numbered ones, returning it
+# with the parameter names in the order asyncpg takes them
+def _numbered(sql: str) -> tuple[str, list[str]]:
+    names: list[str] = []
+
+    def number(match: re.Match) -> str:
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    return re.sub(r"%\((\w+)\)s", number, sql), names
+
+SEARCH_SQL, SEARCH_PARAMS = _numbered(DIRECTORY_SEARCH_SQL)
+FIRST_PAGE_SQL, FIRST_PAGE_PARAMS = _numbered(PANTRY_PAGE_SQL.format(where='', column='expiration_date'))
+
+# Connection class for asyncpg pools whose statements are timed like those of TimedConnection
+class TimedAsyncConnection(asyncpg.Connection):
+    async def execute(self, query, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, *args, **kwargs)
+        finally:
+            record_query(query, time.perf_counter() - start)
+
+    async def fetch(self, query, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().fetch(query, *args, **kwargs)
+        finally:
+            record_query(query, time.perf_counter() - start)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().fetchrow(query, *args, **kwargs)
+        finally:
+            record_query(query, time.perf_counter() - start)
+
+# Released connections skip asyncpg's reset query, a round trip on every release. Every statement here
+# runs on its own and leaves no session state behind; asyncpg still rolls back an open transaction.
+async def _keep_session(conn: asyncpg.Connection) -> None:
+    pass
+
+# AsyncScannerDB serves directory lookups and search, and pantry serial lookups and removal, from
+# an asyncpg pool of its own. The pool is created in the event loop that first uses it, so building
+# one opens nothing and is safe before a server forks or starts its loop.
+class AsyncScannerDB:
+    def __init__(self, host: str, database: str, username: str, password: str, port: int = 5432,
+                 min_size: int = 1, max_size: int = 10, timeout: float = 30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise Exception("Invalid connection pool size")
+        self.__params = dict(host=host, database=database, user=username, password=password, port=port)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.__pool: asyncpg.Pool | None = None
+        self.__opening: asyncio.Lock | None = None
+
+    # Build from the DB_* environment variables, with ASYNC_DB_POOL_MIN_SIZE and ASYNC_DB_POOL_MAX_SIZE
+    # sizing the pool of each process
+    @classmethod
+    def from_env(cls) -> 'AsyncScannerDB':
+        return cls(
+            *database_from_env(),
+            min_size=int(os.getenv("ASYNC_DB_POOL_MIN_SIZE", "1")),
+            max_size=int(os.getenv("ASYNC_DB_POOL_MAX_SIZE", "10")),
+            timeout=float(os.getenv("DB_POOL_TIMEOUT", "30"))
+        )
+
+    # Create the pool, opening min_size connections, unless it is already open
+    async def open(self) -> asyncpg.Pool:
+        if self.__pool is not None:
+            return self.__pool
+        if self.__opening is None:
+            self.__opening = asyncio.Lock()
+        async with self.__opening:
+            if self.__pool is None:
+                self.__pool = await asyncpg.create_pool(min_size=self.min_size, max_size=self.max_size,
+                                                        connection_class=TimedAsyncConnection, reset=_keep_session,
+                                                        **self.__params)
+        return self.__pool
+
+    async def close(self) -> None:
+        if (pool := self.__pool) is not None:
+            self.__pool = None
+            await pool.close()
+
+    # As PantryDirectoryDB.get_item_by_id, without its cache: the lookup is a primary key read
+    async def get_item_by_id(self, item_id: int) -> dict[str, str] | None:
+        pool = await self.open()
+        async with pool.acquire(timeout=self.timeout) as conn:
+            row = await conn.fetchrow("SELECT id, name, category FROM pantry_directory WHERE id = $1", item_id)
+            return dict(row) if row else None
+
+    # As PantryDirectoryDB.search: names starting with the query first, then names containing it
+    async def search(self, query: str, limit: int = 10) -> list[dict[str, str]]:
+        params = directory_search_params(query, limit)
+        pool = await self.open()
+        async with pool.acquire(timeout=self.timeout) as conn:
+            rows = await conn.fetch(SEARCH_SQL, *(params[name] for name in SEARCH_PARAMS))
+            return [dict(row) for row in rows]
+
+    async def get_item_by_serial(self, serial: int) -> dict[str, str | date] | None:
+        pool = await self.open()
+        async with pool.acquire(timeout=self.timeout) as conn:
+            row = await conn.fetchrow(
+                "SELECT serial, id, name, category, expiration_date FROM pantry WHERE serial = $1", serial)
+            return dict(row) if row else None
+
+    async def remove_item(self, serial: int) -> None:
+        pool = await self.open()
+        async with pool.acquire(timeout=self.timeout) as conn:
+            await conn.execute("DELETE FROM pantry WHERE serial = $1", serial)
+
+    # The first page of PantryDB.get_page in its default order, as the pantry view shows it
+    async def first_page(self, limit: int = 50) -> dict:
+        pool = await self.open()
+        async with pool.acquire(timeout=self.timeout) as conn:
+            params = {'limit': limit + 1}
+            rows = await conn.fetch(FIRST_PAGE_SQL, *(params[name] for name in FIRST_PAGE_PARAMS))
+        return pantry_page([dict(row) for row in rows], limit, 'expiration_date')
@@ -0,0 +1,324 @@
+from datetime import date, datetime
+from io import StringIO, TextIOWrapper
+from json import loads
+from typing import Any, BinaryIO, Callable, Iterator
+import argparse
+import csv
+import os
+import re
+import sys
+from dotenv import load_dotenv
+from psycopg2.extensions import cursor
+
+from src.allocators import IDAllocator, make_allocator
+from src.data_handling import ConnectionPool
+
+# Bulk import and export of the pantry directory and the pantry through Postgres COPY, as CSV or NDJSON.
+# Exports stream the table straight out of COPY. Imports are parsed and validated a batch at a time and
+# streamed by COPY into a temporary staging table, checked there against the file and the database, then
+# merged into the table in one transaction: rows whose ID or serial exists are updated, the rest inserted,
+# and rows without one are given a new one by the table's allocator. Nothing is written unless every row
+# is valid, and at most MAX_ERRORS problems are reported.
+#   python -m src.bulk_io export directory -o directory.csv
+#   python -m src.bulk_io import pantry pantry.ndjson
+
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# Rows parsed, given new keys and sent to COPY at a time
+BATCH_SIZE = 5000
+MAX_ERRORS = 20
+
+_ID = re.compile(r'[0-9]{1,18}')
+
+# Field parsers, raising ValueError with a message for the error report
+def _int(row: dict, field: str, required: bool = True) -> int | None:
+    if (value := row.get(field)) is None or value == '':
+        if required:
+            raise ValueError(f"{field} is required")
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not _ID.fullmatch(str(value).strip()):
+        raise ValueError(f"{field} must be a positive integer, got {value!r}")
+    if not (number := int(value)):
+        raise ValueError(f"{field} must be a positive integer, got {value!r}")
+    return number
+
+def _text(row: dict, field: str) -> str:
+    if not isinstance(value := row.get(field), str) or not (value := value.strip()):
+        raise ValueError(f"{field} is required")
+    if len(value) > 255:
+        raise ValueError(f"{field} is longer than 255 characters")
+    return value
+
+def _date(row: dict, field: str, parse: Callable[[str], date], required: bool = True) -> date | None:
+    if (value := row.get(field)) is None or value == '':
+        if required:
+            raise ValueError(f"{field} is required")
+        return None
+    try:
+        return parse(str(value).strip())
+    except ValueError:
+        raise ValueError(f"{field} is not a valid date, got {value!r}")
+
+def _directory_row(row: dict) -> tuple:
+    return _int(row, 'id', required=False), _text(row, 'name'), _text(row, 'category')
+
+# Pantry rows take their name and category from the directory, so those columns of an export are ignored
+def _pantry_row(row: dict) -> tuple:
+    return (_int(row, 'serial', required=False), _int(row, 'id'), _date(row, 'expiration_date', date.fromisoformat),
+            _date(row, 'ingestion_date', datetime.fromisoformat, required=False))
+
+# What import and export need to know about each table. The key is kept on round trips, staging is the
+# temporary table rows are copied into, and update and insert merge it into the table.
+TABLES: dict[str, dict[str, Any]] = {
+    'directory': {
+        'table': 'pantry_directory',
+        'key': 'id',
+        'allocator': 'pantry_directory_id',
+        'export': "SELECT id, name, category FROM pantry_directory ORDER BY id",
+        'parse': _directory_row,
+        'staging': "id BIGINT NOT NULL, name VARCHAR(255) NOT NULL, category VARCHAR(255) NOT NULL",
+        'columns': "id, name, category",
+        'update': """
+            UPDATE pantry_directory t SET name = s.name, category = s.category
+            FROM bulk_staging s
+            WHERE t.id = s.id AND (t.name, t.category) IS DISTINCT FROM (s.name, s.category)
+        """,
+        'insert': """
+            INSERT INTO pantry_directory (id, name, category)
+            SELECT s.id, s.name, s.category FROM bulk_staging s
+            WHERE NOT EXISTS (SELECT 1 FROM pantry_directory t WHERE t.id = s.id)
+            ORDER BY s.id
+        """,
+    },
+    'pantry': {
+        'table': 'pantry',
+        'key': 'serial',
+        'allocator': 'pantry_serial',
+        'export': """
+            SELECT serial, id, name, category, ingestion_date, expiration_date FROM pantry ORDER BY serial
+        """,
+        'parse': _pantry_row,
+        'staging': "serial BIGINT NOT NULL, id BIGINT NOT NULL, expiration_date DATE NOT NULL, ingestion_date TIMESTAMP",
+        'columns': "serial, id, expiration_date, ingestion_date",
+        'update': """
+            UPDATE pantry t SET id = d.id, name = d.name, category = d.category, expiration_date = s.expiration_date,
+                                ingestion_date = COALESCE(s.ingestion_date, t.ingestion_date)
+            FROM bulk_staging s JOIN pantry_directory d ON d.id = s.id
+            WHERE t.serial = s.serial
+              AND (t.id, t.name, t.category, t.expiration_date, t.ingestion_date)
+                  IS DISTINCT FROM (d.id, d.name, d.category, s.expiration_date, COALESCE(s.ingestion_date, t.ingestion_date))
+        """,
+        'insert': """
+            INSERT INTO pantry (serial, id, name, category, ingestion_date, expiration_date)
+            SELECT s.serial, d.id, d.name, d.category, COALESCE(s.ingestion_date, CURRENT_TIMESTAMP), s.expiration_date
+            FROM bulk_staging s JOIN pantry_directory d ON d.id = s.id
+            WHERE NOT EXISTS (SELECT 1 FROM pantry t WHERE t.serial = s.serial)
+            ORDER BY s.serial
+        """,
+    },
+}
+
+def _spec(table: str, fmt: str) -> dict[str, Any]:
+    if table not in TABLES:
+        raise Exception(f"Unknown table: {table}")
+    if fmt not in FORMATS:
+        raise Exception(f"Unknown format: {fmt}")
+    return TABLES[table]
+
+# Write a table to out, a binary file, returning the number of rows. NDJSON rows are built by the server
+# with row_to_json and copied out as CSV with a quote and delimiter that never occur in JSON text, so
+# they come out verbatim rather than with the escaping of COPY's text format.
+def export_table(pool: ConnectionPool, table: str, fmt: str, out: BinaryIO) -> int:
+    query = _spec(table, fmt)['export']
+    if fmt == 'csv':
+        copy = f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)"
+    else:
+        copy = f"COPY (SELECT row_to_json(r) FROM ({query}) r) TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.copy_expert(copy, out)
+        rows = cur.rowcount
+        conn.commit()
+    return rows
+
+# Rows of a CSV or NDJSON stream with their line numbers. A problem that stops the rest of the stream from
+# being read is reported against the last line read, 0 if none was.
+def _records(stream: BinaryIO, fmt: str) -> Iterator[tuple[int, dict | None, str | None]]:
+    text = TextIOWrapper(stream, encoding='utf-8-sig', newline='' if fmt == 'csv' else None)
+    line = 0
+    try:
+        if fmt == 'csv':
+            reader = csv.DictReader(text)
+            for row in reader:
+                line = reader.line_num
+                yield line, row, None
+            return
+        for line, raw in enumerate(text, 1):
+            if not raw.strip():
+                continue
+            try:
+                row = loads(raw)
+            except ValueError:
+                yield line, None, "not valid JSON"
+                continue
+            yield line, row, None if isinstance(row, dict) else "expected a JSON object"
+    except (UnicodeDecodeError, csv.Error) as e:
+        yield line, None, f"cannot be read from here on: {e}"
+    finally:
+        text.detach()
+
+# File-like source for COPY FROM: each read returns the next batch of valid rows as CSV, and stops early
+# once MAX_ERRORS invalid rows have been seen. Invalid rows are collected rather than raised, so the
+# COPY always ends cleanly and the caller decides what to do. Rows without a key, always the first field,
+# are given one from allocate as their batch is written, so staged rows never have to be rewritten.
+class _StagingStream:
+    def __init__(self, records: Iterator[tuple[int, dict | None, str | None]], parse: Callable[[dict], tuple],
+                 allocate: Callable[[int], list[int]]):
+        self.records = records
+        self.parse = parse
+        self.allocate = allocate
+        self.rows = 0
+        self.allocated = 0
+        self.errors: list[str] = []
+
+    def read(self, size: int = -1) -> str:
+        batch = []
+        for line, row, error in self.records:
+            try:
+                if error:
+                    raise ValueError(error)
+                batch.append((line, *self.parse(row)))
+            except ValueError as e:
+                self.errors.append(f"line {line}: {e}" if line else str(e))
+                if len(self.errors) >= MAX_ERRORS:
+                    break
+            if len(batch) >= BATCH_SIZE:
+                break
+        if self.errors or not batch:
+            return ''
+        keys = iter(self.allocate(sum(1 for row in batch if row[1] is None)))
+        buffer = StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        for line, key, *fields in batch:
+            writer.writerow((line, next(keys) if key is None else key, *fields, key is None))
+            self.allocated += key is None
+        self.rows += len(batch)
+        return buffer.getvalue()
+
+def _fail(problems: list[str]) -> None:
+    if problems:
+        raise Exception(f"Import failed, nothing was written: {'; '.join(problems[:MAX_ERRORS])}")
+
+# Checks of the staged rows that need the whole file or the database: keys repeated in the file, and for
+# the pantry, items missing from the directory
+def _check_staging(cur: cursor, spec: dict[str, Any]) -> list[str]:
+    key = spec['key']
+    cur.execute(f"""
+        SELECT {key}, array_agg(line ORDER BY line) FROM bulk_staging
+        WHERE NOT allocated GROUP BY {key} HAVING count(*) > 1
+        ORDER BY min(line) LIMIT %s
+    """, (MAX_ERRORS,))
+    problems = [f"lines {', '.join(map(str, lines))}: {key} {value} is repeated" for value, lines in cur.fetchall()]
+    if spec['table'] == 'pantry':
+        cur.execute("""
+            SELECT line, id FROM bulk_staging s
+            WHERE NOT EXISTS (SELECT 1 FROM pantry_directory d WHERE d.id = s.id)
+            ORDER BY line LIMIT %s
+        """, (MAX_ERRORS,))
+        problems += [f"line {line}: item {item_id} is not in the pantry directory" for line, item_id in cur.fetchall()]
+    return problems
+
+# Allocated keys are unique, but may be taken by rows from before the allocator or by keys in the file.
+# Those rows are given another key until none collide.
+def _replace_taken_keys(cur: cursor, spec: dict[str, Any], allocate: Callable[[int], list[int]]) -> None:
+    table, key = spec['table'], spec['key']
+    while True:
+        cur.execute(f"""
+            SELECT line FROM bulk_staging s
+            WHERE allocated AND (EXISTS (SELECT 1 FROM {table} t WHERE t.{key} = s.{key})
+                                 OR EXISTS (SELECT 1 FROM bulk_staging o WHERE o.{key} = s.{key} AND o.line <> s.line))
+        """)
+        if not (lines := [row[0] for row in cur.fetchall()]):
+            return
+        cur.execute(f"""
+            UPDATE bulk_staging s SET {key} = a.{key}
+            FROM unnest(%s::integer[], %s::bigint[]) AS a(line, {key})
+            WHERE s.line = a.line
+        """, (lines, allocate(len(lines))))
+
+# Import a CSV or NDJSON stream into a table, returning how many rows were read, inserted, updated and
+# left unchanged, and how many were given a new key. Raises without writing anything if any row is invalid.
+# New keys are allocated on a second connection, as the import's own is busy with the COPY meanwhile.
+def import_table(pool: ConnectionPool, table: str, fmt: str, stream: BinaryIO, allocator: IDAllocator) -> dict[str, int]:
+    spec = _spec(table, fmt)
+    allocator_conn = None
+
+    def allocate(n: int) -> list[int]:
+        nonlocal allocator_conn
+        if not n:
+            return []
+        if allocator_conn is None:
+            allocator_conn = pool.getconn()
+        ids = allocator.allocate(allocator_conn, n)
+        allocator_conn.commit()
+        return ids
+
+    source = _StagingStream(_records(stream, fmt), spec['parse'], allocate)
+    try:
+        with pool.connection() as conn, conn.cursor() as cur:
+            try:
+                cur.execute(f"""
+                    CREATE TEMPORARY TABLE bulk_staging (
+                        line INTEGER NOT NULL, {spec['staging']}, allocated BOOLEAN NOT NULL
+                    ) ON COMMIT DROP
+                """)
+                cur.copy_expert(f"COPY bulk_staging (line, {spec['columns']}, allocated) FROM STDIN WITH (FORMAT csv)",
+                                source)
+                _fail(source.errors)
+                cur.execute(f"CREATE INDEX ON bulk_staging ({spec['key']})")
+                cur.execute("ANALYZE bulk_staging")
+                _fail(_check_staging(cur, spec))
+                # Hold off other writers until commit, so rows added meanwhile cannot take an imported or allocated key
+                cur.execute(f"LOCK TABLE {spec['table']} IN SHARE ROW EXCLUSIVE MODE")
+                _replace_taken_keys(cur, spec, allocate)
+                cur.execute(spec['update'])
+                updated = cur.rowcount
+                cur.execute(spec['insert'])
+                inserted = cur.rowcount
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        if allocator_conn is not None:
+            pool.putconn(allocator_conn)
+    return {'rows': source.rows, 'inserted': inserted, 'updated': updated,
+            'unchanged': source.rows - inserted - updated, 'allocated': source.allocated}
+
+# Format of a file from its extension, CSV unless it looks like NDJSON
+def format_of(path: str) -> str:
+    return 'ndjson' if path.lower().endswith(('.ndjson', '.jsonl')) else 'csv'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk import and export the pantry directory and pantry")
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('table', choices=list(TABLES))
+    parser.add_argument('file', nargs='?', default='-', help="file to import, - for stdin (default)")
+    parser.add_argument('-o', '--output', default='-', help="file to export to, - for stdout (default)")
+    parser.add_argument('--format', choices=list(FORMATS), help="default: from the file extension, else csv")
+    args = parser.parse_args()
+
+    load_dotenv()
+    pool = ConnectionPool.from_env()
+    path = args.file if args.action == 'import' else args.output
+    fmt = args.format or format_of(path)
+    if args.action == 'export':
+        with (open(path, 'wb') if path != '-' else os.fdopen(sys.stdout.fileno(), 'wb', closefd=False)) as out:
+            rows = export_table(pool, args.table, fmt, out)
+        print(f"Exported {rows} row(s) from {TABLES[args.table]['table']}", file=sys.stderr)
+    else:
+        allocator = make_allocator(os.getenv("ID_ALLOCATOR", "feistel"), TABLES[args.table]['allocator'])
+        with (open(path, 'rb') if path != '-' else sys.stdin.buffer) as stream:
+            result = import_table(pool, args.table, fmt, stream, allocator)
+        print(f"Imported {result['rows']} row(s) into {TABLES[args.table]['table']}: {result['inserted']} inserted, "
+              f"{result['updated']} updated, {result['unchanged']} unchanged, {result['allocated']} given a new "
+              f"{TABLES[args.table]['key']}")
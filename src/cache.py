@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+import threading
+import time
+
+# In-process caches shared by the threads of one worker
+
+# Marks a key that is not in the cache, so cached None values can be told apart from misses
+MISSING = object()
+
+# LRUCache is a bounded, thread-safe mapping that evicts the least recently used entry when full.
+# It is tied to a version, read through version_reader at most once every check_interval seconds;
+# when the version has moved on, every entry is dropped. This keeps caches in different worker
+# processes coherent with writes made by any of them, within check_interval.
+class LRUCache:
+    def __init__(self, max_size: int, version_reader: Callable[[], int] | None = None, check_interval: float = 1.0):
+        if max_size < 1:
+            raise Exception("Cache size must be at least 1")
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.__version_reader = version_reader
+        self.__version: int | None = None
+        self.__generation = 0
+        self.__checked_at = 0.0
+        self.__entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__invalidations = 0
+
+    # Drop every entry if the version has changed since it was last read
+    def __revalidate(self) -> None:
+        if self.__version_reader is None or time.monotonic() - self.__checked_at < self.check_interval:
+            return
+        self.validate(self.__version_reader())
+
+    # Drop every entry unless version is the one they were cached at. Callers that have just read the
+    # version themselves, for example to build an ETag from it, pass it here so no entry cached at an
+    # older version is returned after it. Values still being loaded are kept out by put's generation check.
+    def validate(self, version: int) -> None:
+        with self.__lock:
+            self.__checked_at = time.monotonic()
+            if version != self.__version:
+                if self.__version is not None:
+                    self.__entries.clear()
+                    self.__invalidations += 1
+                self.__version = version
+                self.__generation += 1
+
+    # Counter bumped whenever the entries are dropped. Callers read it after a miss, before loading the
+    # value, and pass it to put, so a value loaded while another thread invalidated the cache is not
+    # cached under the newer version.
+    def generation(self) -> int:
+        with self.__lock:
+            return self.__generation
+
+    # Return the cached value for key, or MISSING
+    def get(self, key: Hashable) -> Any:
+        self.__revalidate()
+        with self.__lock:
+            if (value := self.__entries.get(key, MISSING)) is MISSING:
+                self.__misses += 1
+                return MISSING
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return value
+
+    # Cache value for key, unless generation is given and the entries have been dropped since it was read
+    def put(self, key: Hashable, value: Any, generation: int | None = None) -> None:
+        with self.__lock:
+            if generation is not None and generation != self.__generation:
+                return
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.__evictions += 1
+
+    # Drop every entry, used after this process writes so its own reads see the change at once
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.__invalidations += 1
+            self.__generation += 1
+
+    # Cache effectiveness metrics
+    def stats(self) -> dict[str, int]:
+        with self.__lock:
+            return {
+                'max_size': self.max_size,
+                'size': len(self.__entries),
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'evictions': self.__evictions,
+                'invalidations': self.__invalidations,
+            }
@@ -1,170 +1,723 @@
-from json import dumps
-import random
+from contextlib import contextmanager
+from datetime import date
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from json import dumps, loads
+from itertools import count
+from typing import Iterator
+import os
+import re
+import threading
+import time
 import psycopg2
+from psycopg2.extensions import connection, TRANSACTION_STATUS_IDLE
 from psycopg2.extras import RealDictCursor
 
+from src.allocators import IDAllocator, FeistelAllocator
+from src.cache import LRUCache, MISSING
+from src.metrics import TimedConnection
+
 # Data handling classes for meal planning and pantry directory
 
+# Escape LIKE wildcards so user input only ever matches literally
+def _like_escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# Page cursors carry the sort value and serial of the last row of the previous page
+def _encode_cursor(value, serial: int) -> str:
+    return urlsafe_b64encode(dumps([str(value), serial]).encode()).decode()
+
+def _decode_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        value, serial = loads(urlsafe_b64decode(cursor.encode()))
+        return str(value), int(serial)
+    except (ValueError, TypeError):
+        raise Exception("Invalid page cursor")
+
+# Statements shared with the async data layer (src/async_db.py), with named parameters
+
+# Directory search, ranking names that start with the query ahead of names that contain it.
+# Each branch is limited in the database, so only the returned rows leave the server.
+DIRECTORY_SEARCH_SQL = """
+    SELECT id, name FROM (
+        (SELECT id, name, 0 AS rank, 1 AS position FROM pantry_directory
+         WHERE lower(name) LIKE %(prefix)s
+         ORDER BY lower(name) LIMIT %(limit)s)
+        UNION ALL
+        (SELECT id, name, 1 AS rank, strpos(lower(name), %(query)s) AS position FROM pantry_directory
+         WHERE lower(name) LIKE %(contains)s AND lower(name) NOT LIKE %(prefix)s
+         ORDER BY position, lower(name) LIMIT %(limit)s)
+    ) matches
+    ORDER BY rank, position, lower(name), id
+    LIMIT %(limit)s
+"""
+
+def directory_search_params(query: str, limit: int) -> dict[str, str | int]:
+    query = query.lower()
+    pattern = _like_escape(query)
+    return {'query': query, 'prefix': f"{pattern}%", 'contains': f"%{pattern}%", 'limit': limit}
+
+# One page of pantry items ordered by column then serial, with the filters and page cursor as parameters.
+# One row more than the page is fetched, so pantry_page can tell whether there is a next page.
+PANTRY_PAGE_SQL = """
+    SELECT serial, id, name, category, expiration_date FROM pantry
+    {where}
+    ORDER BY {column}, serial
+    LIMIT %(limit)s
+"""
+
+def pantry_page(rows: list[dict], limit: int, column: str) -> dict:
+    items = rows[:limit]
+    next_cursor = _encode_cursor(items[-1][column], items[-1]['serial']) if len(rows) > limit else None
+    return {'items': items, 'next': next_cursor}
+
+# Drop a connection inherited by a forked process without touching the parent's session. Its socket
+# is swapped for /dev/null first, so closing it here sends nothing to the server.
+def _detach(conn: connection) -> None:
+    try:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        try:
+            os.dup2(devnull, conn.fileno())
+        finally:
+            os.close(devnull)
+        conn.close()
+    except (OSError, psycopg2.Error):
+        pass
+
+# Names for server-side cursors, which must be unique on a connection
+_cursor_names = count()
+
+# Host, database, user, password and port from the DB_* environment variables
+def database_from_env() -> tuple[str, str, str, str, int]:
+    if not (db_host := os.getenv("DB_HOST")):
+        raise Exception("No database host specified")
+    if not (db_name := os.getenv("DB_NAME")):
+        raise Exception("No database name specified")
+    if not (db_user := os.getenv("DB_USER")):
+        raise Exception("No database user specified")
+    if not (db_password := os.getenv("DB_PASSWORD")):
+        raise Exception("No database password specified")
+    return db_host, db_name, db_user, db_password, int(os.getenv("DB_PORT", "5432"))
+
+# ConnectionPool hands out a bounded set of connections to the threads of one worker process.
+# Idle connections are health checked before reuse and replaced when they have gone bad.
+# Nothing is connected until the pool is first used or open() is called, so a pool can be built
+# before a server forks its workers. A pool used in a forked child drops the connections it
+# inherited and opens its own.
+class ConnectionPool:
+    def __init__(self, host: str, database: str, username: str, password: str, port: int = 5432,
+                 min_size: int = 1, max_size: int = 10, timeout: float = 30.0, check_interval: float = 30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise Exception("Invalid connection pool size")
+        self.__params = dict(host=host, database=database, user=username, password=password, port=port)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.__idle: list[tuple[connection, float]] = []
+        self.__size = 0
+        self.__waiting = 0
+        self.__cond = threading.Condition()
+        self.__local = threading.local()
+        self.__checkouts = 0
+        self.__timeouts = 0
+        self.__reconnects = 0
+        self.__wait_total = 0.0
+        self.__wait_max = 0.0
+        self.__pid = os.getpid()
+
+    # Build a pool from the DB_* environment variables
+    @classmethod
+    def from_env(cls) -> 'ConnectionPool':
+        return cls(
+            *database_from_env(),
+            min_size=int(os.getenv("DB_POOL_MIN_SIZE", "1")),
+            max_size=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+            timeout=float(os.getenv("DB_POOL_TIMEOUT", "30"))
+        )
+
+    # Reset the pool in a process forked since it was last used. The lock and thread-local state are
+    # replaced rather than acquired, since another thread of the parent may have held them at fork.
+    def __check_fork(self) -> None:
+        if (pid := os.getpid()) == self.__pid:
+            return
+        for conn, _ in self.__idle:
+            _detach(conn)
+        self.__pid = pid
+        self.__idle = []
+        self.__size = 0
+        self.__waiting = 0
+        self.__cond = threading.Condition()
+        self.__local = threading.local()
+
+    # Open connections until the pool holds min_size, so the first requests do not wait for them
+    def open(self) -> None:
+        self.__check_fork()
+        while True:
+            with self.__cond:
+                if self.__size >= self.min_size:
+                    return
+                self.__size += 1
+            try:
+                conn = self.__connect()
+            except Exception:
+                with self.__cond:
+                    self.__size -= 1
+                    self.__cond.notify()
+                raise
+            with self.__cond:
+                self.__idle.append((conn, time.monotonic()))
+                self.__cond.notify()
+
+    def __connect(self) -> connection:
+        return psycopg2.connect(connection_factory=TimedConnection, **self.__params)
+
+    # A connection is reused as-is if it was returned recently, otherwise it is pinged first
+    def __healthy(self, conn: connection, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    # Check out a connection, waiting up to the pool timeout for one to be returned
+    def getconn(self) -> connection:
+        self.__check_fork()
+        start = time.monotonic()
+        with self.__cond:
+            self.__waiting += 1
+            try:
+                while not self.__idle and self.__size >= self.max_size:
+                    remaining = self.timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self.__timeouts += 1
+                        raise Exception("Timed out waiting for a database connection")
+                    self.__cond.wait(remaining)
+            finally:
+                self.__waiting -= 1
+            if self.__idle:
+                conn, last_used = self.__idle.pop()
+            else:
+                conn, last_used = None, 0.0
+                self.__size += 1
+            waited = time.monotonic() - start
+            self.__checkouts += 1
+            self.__wait_total += waited
+            self.__wait_max = max(self.__wait_max, waited)
+
+        if conn is not None and self.__healthy(conn, last_used):
+            return conn
+        try:
+            if conn is not None:
+                conn.close()
+                with self.__cond:
+                    self.__reconnects += 1
+            return self.__connect()
+        except Exception:
+            with self.__cond:
+                self.__size -= 1
+                self.__cond.notify()
+            raise
+
+    # Return a connection to the pool, discarding it if it is broken
+    def putconn(self, conn: connection, discard: bool = False) -> None:
+        if not discard and not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self.__cond:
+            if discard or conn.closed:
+                self.__size -= 1
+            else:
+                self.__idle.append((conn, time.monotonic()))
+            self.__cond.notify()
+        if discard and not conn.closed:
+            conn.close()
+
+    # Request-scoped checkout: nested uses on the same thread share one connection
+    @contextmanager
+    def connection(self) -> Iterator[connection]:
+        self.__check_fork()
+        if (conn := getattr(self.__local, 'conn', None)) is not None:
+            yield conn
+            return
+        conn = self.getconn()
+        self.__local.conn = conn
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.__local.conn = None
+            self.putconn(conn, discard=broken)
+
+    # Close the idle connections, for when a pool is done with. Using it again opens new connections.
+    def close(self) -> None:
+        with self.__cond:
+            idle, self.__idle = self.__idle, []
+            self.__size -= len(idle)
+            self.__cond.notify_all()
+        for conn, _ in idle:
+            conn.close()
+
+    # Pool sizing metrics
+    def stats(self) -> dict[str, int | float]:
+        with self.__cond:
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self.__size,
+                'idle': len(self.__idle),
+                'in_use': self.__size - len(self.__idle),
+                'waiting': self.__waiting,
+                'checkouts': self.__checkouts,
+                'timeouts': self.__timeouts,
+                'reconnects': self.__reconnects,
+                'wait_seconds_total': self.__wait_total,
+                'wait_seconds_max': self.__wait_max,
+            }
+
+WEEK_SECTION_MAX = 32  # length of meal_week_items.section
+
+# Rows of meal_week_items for one saved field, by the same rules as the migration 8 backfill: only
+# lists under a section name that fits the column are indexed, item IDs must be 1 to 18 digits so they
+# fit a bigint, and quantities that are not 1 to 9 digits count as 1
+def _week_item_rows(key: str, value) -> list[tuple[str, int, int, int]]:
+    section = key.removesuffix('_ingredients')
+    if not isinstance(value, list) or len(section) > WEEK_SECTION_MAX:
+        return []
+    rows = []
+    for position, item in enumerate(value):
+        item_id = str(item.get('id', '') if isinstance(item, dict) else item)
+        qty = str(item.get('qty', '')) if isinstance(item, dict) else ''
+        if re.fullmatch(r'[0-9]{1,18}', item_id):
+            rows.append((section, position, int(item_id), int(qty) if re.fullmatch(r'[0-9]{1,9}', qty) else 1))
+    return rows
+
 # MealDB handles the storage and retrieval of meal plans for different weeks
 class MealDB:
-    def __init__(self, host: str, database: str, username: str, password: str, port: int = 5432):
-        self.conn = psycopg2.connect(
-            host=host,
-            database=database,
-            user=username,
-            password=password,
-            port=port
-        )
-        self.__init_table()
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
     
-    def __init_table(self) -> None:
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS meal_weeks (
-                    week VARCHAR(10) PRIMARY KEY,
-                    data JSONB NOT NULL
-                )
-            """)
-            self.conn.commit()
-    
-    def save_week(self, week: str, data: dict[str, str]) -> None:
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO meal_weeks (week, data) VALUES (%s, %s)
-                ON CONFLICT (week) DO UPDATE SET data = meal_weeks.data || EXCLUDED.data
-            """, (week, dumps(data)))
-            self.conn.commit()
+    # Save a week's fields, merged into what is already stored. Only fields whose value changed are
+    # written, and the meal_week_items index is only rewritten for the ingredient lists that changed.
+    # Saves of the same week are serialised on its row. Returns the names of the changed fields.
+    def save_week(self, week: str, data: dict[str, str]) -> list[str]:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("INSERT INTO meal_weeks (week, data) VALUES (%s, '{}') ON CONFLICT (week) DO NOTHING", (week,))
+            cur.execute("SELECT data FROM meal_weeks WHERE week = %s FOR UPDATE", (week,))
+            current = cur.fetchone()[0]
+            changed = {key: value for key, value in data.items() if current.get(key, MISSING) != value}
+            if changed:
+                cur.execute("UPDATE meal_weeks SET data = data || %s WHERE week = %s", (dumps(changed), week))
+            sections = [key.removesuffix('_ingredients') for key in changed if key.endswith('_ingredients')]
+            if sections:
+                cur.execute("DELETE FROM meal_week_items WHERE week = %s AND section = ANY(%s)", (week, sections))
+                rows = [row for key, value in changed.items() if key.endswith('_ingredients')
+                        for row in _week_item_rows(key, value)]
+                if rows:
+                    cur.execute("""
+                        INSERT INTO meal_week_items (week, section, position, item_id, qty)
+                        SELECT %s, * FROM unnest(%s::varchar[], %s::int[], %s::bigint[], %s::int[])
+                    """, (week, *map(list, zip(*rows))))
+            conn.commit()
+            return list(changed)
     
     def load_week(self, week: str) -> dict[str, map] | None:
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute("SELECT data FROM meal_weeks WHERE week = %s", (week,))
             result = cur.fetchone()
             if result:
                 return dict(result['data'])
             return None
 
-# PantryDirectoryDB handles the storage and retrieval of pantry items
-class PantryDirectoryDB:
-    def __init__(self, host: str, database: str, username: str, password: str, port: int = 5432):
-        self.conn = psycopg2.connect(
-            host=host,
-            database=database,
-            user=username,
-            password=password,
-            port=port
-        )
-        self.__init_table()
-    
-    def __init_table(self) -> None:
-        with self.conn.cursor() as cur:
+    # Version of a saved week, or None when it is not saved, read with the directory's table version
+    # since loaded weeks carry item names from the directory. Any change to either changes the pair.
+    def week_version(self, week: str) -> tuple[int | None, int]:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS pantry_directory (
-                    id BIGINT PRIMARY KEY,
-                    name VARCHAR(255) NOT NULL,
-                    category VARCHAR(255) NOT NULL
-                )
-            """)
-            self.conn.commit()
+                SELECT (SELECT version FROM meal_weeks WHERE week = %s),
+                       coalesce((SELECT version FROM table_versions WHERE name = 'pantry_directory'), 0)
+            """, (week,))
+            return cur.fetchone()
+
+    # Load every saved week from start to end inclusive in one query, keyed by week in order.
+    # Weeks are "YYYY-Www" strings, so they sort chronologically and the range scans the primary key.
+    def load_weeks(self, start: str, end: str) -> dict[str, dict]:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT week, data FROM meal_weeks WHERE week BETWEEN %s AND %s ORDER BY week", (start, end))
+            return {week: dict(data) for week, data in cur.fetchall()}
+
+    # Find the weeks that plan an item, from the meal_week_items index, returning
+    # {week, sections, qty} with the days (or "additional") it appears in and its total quantity
+    def weeks_using_item(self, item_id: int) -> list[dict]:
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT week, array_agg(DISTINCT section) AS sections, sum(qty)::int AS qty
+                FROM meal_week_items WHERE item_id = %s
+                GROUP BY week ORDER BY week
+            """, (item_id,))
+            return [dict(row) for row in cur.fetchall()]
+
+# Read the write counter of a table, kept by the table_versions triggers
+def table_version(pool: ConnectionPool, name: str) -> int:
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT version FROM table_versions WHERE name = %s", (name,))
+        return 0 if not (result := cur.fetchone()) else result[0]
+
+# Read the write counters of several tables in one query, in the order given
+def table_versions(pool: ConnectionPool, names: list[str]) -> list[int]:
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT coalesce(v.version, 0)
+            FROM unnest(%s::varchar[]) WITH ORDINALITY n(name, position)
+            LEFT JOIN table_versions v ON v.name = n.name
+            ORDER BY n.position
+        """, (names,))
+        return [row[0] for row in cur.fetchall()]
 
-    # Add a new item to the pantry directory with a unique ID
-    def add_item(self, name: str, category: str) -> None:
-        with self.conn.cursor() as cur:
+# PantryDirectoryDB handles the storage and retrieval of pantry items.
+# Lookups by ID go through a per-process LRU cache, which is dropped whenever the directory's
+# table version changes, so writes from other workers show up within cache_check_interval seconds.
+class PantryDirectoryDB:
+    def __init__(self, pool: ConnectionPool, allocator: IDAllocator | None = None,
+                 cache_size: int = 4096, cache_check_interval: float = 1.0):
+        self.pool = pool
+        self.allocator = allocator or FeistelAllocator('pantry_directory_id')
+        self.cache = LRUCache(cache_size, lambda: table_version(pool, 'pantry_directory'), cache_check_interval)
+    
+    # Add a new item to the pantry directory with a unique ID, returning the ID.
+    # Allocated IDs are unique; the loop only skips IDs taken by items created before the allocator.
+    def add_item(self, name: str, category: str) -> int:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             while True:
-                item_id = random.randint(1000000000, 9999999999)
-                try:
-                    cur.execute("INSERT INTO pantry_directory (id, name, category) VALUES (%s, %s, %s)", (item_id, name, category))
-                    self.conn.commit()
-                    break
-                except psycopg2.IntegrityError:
-                    self.conn.rollback()
-                    continue
+                item_id = self.allocator.allocate(conn, 1)[0]
+                cur.execute("""
+                    INSERT INTO pantry_directory (id, name, category) VALUES (%s, %s, %s)
+                    ON CONFLICT (id) DO NOTHING
+                    RETURNING id
+                """, (item_id, name, category))
+                if cur.fetchone():
+                    conn.commit()
+                    self.cache.clear()
+                    return item_id
 
     # Retrieve all items from the pantry directory, returning a list of dictionaries
     def get_all_items(self) -> list[dict[str, str]]:
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute("SELECT id, name, category FROM pantry_directory ORDER BY id")
             return [dict(row) for row in cur.fetchall()]
     
-    # Retrieve a single item by its ID, returning a dictionary or None if not found
+    # Search items by name, names that start with the query first (see DIRECTORY_SEARCH_SQL)
+    def search(self, query: str, limit: int = 10) -> list[dict[str, str]]:
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(DIRECTORY_SEARCH_SQL, directory_search_params(query, limit))
+            return [dict(row) for row in cur.fetchall()]
+
+    # Retrieve a single item by its ID, returning a dictionary or None if not found.
+    # Misses are cached too, so repeated scans of an unknown ID do not reach the database.
     def get_item_by_id(self, item_id: int) -> dict[str, str] | None:
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
+        if (item := self.cache.get(item_id)) is not MISSING:
+            return None if item is None else dict(item)
+        generation = self.cache.generation()
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute("SELECT id, name, category FROM pantry_directory WHERE id = %s", (item_id,))
             result = cur.fetchone()
-            if result:
-                return dict(result)
-            return None
+            item = dict(result) if result else None
+        self.cache.put(item_id, item, generation)
+        return None if item is None else dict(item)
     
+    # Retrieve many items by ID, keyed by ID, with a single query for the ones not in the cache.
+    # IDs not in the directory are left out.
+    def get_items_by_ids(self, item_ids: list[int]) -> dict[int, dict[str, str]]:
+        items = {}
+        missing = []
+        for item_id in dict.fromkeys(item_ids):
+            if (item := self.cache.get(item_id)) is MISSING:
+                missing.append(item_id)
+            elif item is not None:
+                items[item_id] = dict(item)
+        if missing:
+            generation = self.cache.generation()
+            with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT id, name, category FROM pantry_directory WHERE id = ANY(%s)", (missing,))
+                found = {row['id']: dict(row) for row in cur.fetchall()}
+            for item_id in missing:
+                self.cache.put(item_id, found.get(item_id), generation)
+                if item_id in found:
+                    items[item_id] = dict(found[item_id])
+        return items
+
     def delete_item(self, item_id: int) -> None:
-        with self.conn.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             cur.execute("DELETE FROM pantry_directory WHERE id = %s", (item_id,))
-            self.conn.commit()
+            conn.commit()
+        self.cache.clear()
 
 # PantryDB handles the storage and retrieval of pantry items with expiration dates
 class PantryDB:
-    def __init__(self, host: str, database: str, username: str, password: str, port: int = 5432):
-        self.conn = psycopg2.connect(
-            host=host,
-            database=database,
-            user=username,
-            password=password,
-            port=port
-        )
-        self.__init_table()
-    
-    def __init_table(self) -> None:
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS pantry (
-                    serial BIGINT PRIMARY KEY,
-                    id BIGINT NOT NULL,
-                    name VARCHAR(255) NOT NULL,
-                    category VARCHAR(255) NOT NULL,
-                    ingestion_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    expiration_date DATE NOT NULL
-                )
-            """)
-            self.conn.commit()
+    def __init__(self, pool: ConnectionPool, allocator: IDAllocator | None = None):
+        self.pool = pool
+        self.allocator = allocator or FeistelAllocator('pantry_serial')
     
     # Add an item to the pantry using its ID from the pantry directory and an expiration date
     def add_item(self, pdpb: PantryDirectoryDB, item_id: int, expiration_date: str) -> int:
-        with self.conn.cursor() as cur:
-            item = pdpb.get_item_by_id(item_id)
-            if not item:
-                raise Exception("Item ID not found in pantry directory")
-            while True:
-                serial = random.randint(1000000000, 9999999999)
-                try:
-                    cur.execute("""
-                        INSERT INTO pantry (serial, id, name, category, expiration_date) 
-                        VALUES (%s, %s, %s, %s, %s)
-                    """, (serial, item['id'], item['name'], item['category'], expiration_date))
-                    self.conn.commit()
-                    return serial
-                except psycopg2.IntegrityError:
-                    self.conn.rollback()
-                    continue
+        return self.add_items(pdpb, item_id, expiration_date, 1)[0]
+
+    # Add several units of an item in a single transaction, returning the serials created.
+    # Allocated serials are unique, so only serials left over from before the allocator can
+    # collide; those rows are skipped by ON CONFLICT and topped up by the next pass of the loop.
+    # When nothing was inserted, the item is looked up in the same transaction rather than in the
+    # directory cache, which may not have seen a delete made by another worker yet.
+    def add_items(self, pdpb: PantryDirectoryDB, item_id: int, expiration_date: str, quantity: int) -> list[int]:
+        if quantity < 1:
+            raise Exception("Quantity must be at least 1")
+        serials = []
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            while len(serials) < quantity:
+                cur.execute("""
+                    INSERT INTO pantry (serial, id, name, category, expiration_date)
+                    SELECT s, d.id, d.name, d.category, %s
+                    FROM pantry_directory d, unnest(%s::bigint[]) AS s
+                    WHERE d.id = %s
+                    ON CONFLICT (serial) DO NOTHING
+                    RETURNING serial
+                """, (expiration_date, self.allocator.allocate(conn, quantity - len(serials)), item_id))
+                if not (rows := cur.fetchall()):
+                    cur.execute("SELECT 1 FROM pantry_directory WHERE id = %s", (item_id,))
+                    if not cur.fetchone():
+                        conn.rollback()
+                        raise Exception("Item ID not found in pantry directory")
+                serials.extend(row[0] for row in rows)
+            conn.commit()
+        return serials
     
-    # Get the count of a specific item in the pantry by its ID
+    # Get the count of a specific item in the pantry by its ID.
+    # Counts are read from pantry_stock, which triggers on pantry keep up to date.
     def item_count(self, item_id: int) -> int:
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM pantry WHERE id = %s", (item_id,))
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT count FROM pantry_stock WHERE id = %s", (item_id,))
             return 0 if not (result := cur.fetchone()) else result[0]
+
+    # Get the earliest expiration date of an item in the pantry, or None if none are in stock
+    def next_expiration(self, item_id: int) -> date | None:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT earliest_expiration FROM pantry_stock WHERE id = %s", (item_id,))
+            return None if not (result := cur.fetchone()) else result[0]
+
+    # Get the directory name and pantry count of many items in one query, keyed by item ID.
+    # Items missing from the pantry directory are left out.
+    def stock_for_items(self, item_ids: list[int]) -> dict[int, dict[str, str | int]]:
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT d.id, d.name, COALESCE(s.count, 0) AS count
+                FROM pantry_directory d LEFT JOIN pantry_stock s ON s.id = d.id
+                WHERE d.id = ANY(%s)
+            """, (list(item_ids),))
+            return {row['id']: dict(row) for row in cur.fetchall()}
+
+    # Compare pantry_stock with counts rebuilt from pantry, returning every item where they differ
+    # as {id, count, earliest_expiration, stock_count, stock_earliest_expiration}.
+    # With repair, pantry writes are blocked while the differing rows are rewritten.
+    def check_stock(self, repair: bool = False) -> list[dict]:
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            if repair:
+                cur.execute("LOCK TABLE pantry IN SHARE ROW EXCLUSIVE MODE")
+            cur.execute("""
+                SELECT COALESCE(r.id, s.id) AS id,
+                       COALESCE(r.count, 0) AS count, r.earliest_expiration,
+                       COALESCE(s.count, 0) AS stock_count, s.earliest_expiration AS stock_earliest_expiration
+                FROM (SELECT id, count(*) AS count, min(expiration_date) AS earliest_expiration FROM pantry GROUP BY id) r
+                FULL JOIN pantry_stock s ON s.id = r.id
+                WHERE r.count IS DISTINCT FROM s.count OR r.earliest_expiration IS DISTINCT FROM s.earliest_expiration
+                ORDER BY 1
+            """)
+            drift = [dict(row) for row in cur.fetchall()]
+            if repair and drift:
+                cur.execute("DELETE FROM pantry_stock WHERE id = ANY(%s)", ([row['id'] for row in drift],))
+                cur.execute("""
+                    INSERT INTO pantry_stock (id, count, earliest_expiration)
+                    SELECT id, count(*), min(expiration_date) FROM pantry WHERE id = ANY(%s) GROUP BY id
+                """, ([row['id'] for row in drift],))
+            conn.commit()
+            return drift
     
     # Remove an item from the pantry by its unique serial number
     def remove_item(self, serial: int) -> None:
-        with self.conn.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             cur.execute("DELETE FROM pantry WHERE serial = %s", (serial,))
-            self.conn.commit()
+            conn.commit()
     
+    # Remove many items in one transaction: specific serials, and (item_id, qty) pairs removing the
+    # qty units of each item that expire first. Returns a result per serial, with the removed row or
+    # removed False when the serial was not in the pantry, and a result per item with the serials
+    # removed, which can be fewer than requested when stock runs out.
+    def checkout(self, serials: list[int], fifo: list[tuple[int, int]]) -> dict[str, list[dict]]:
+        serials = list(dict.fromkeys(serials))
+        quantities = {}
+        for item_id, qty in fifo:
+            if qty < 1:
+                raise Exception("Quantity must be at least 1")
+            quantities[item_id] = quantities.get(item_id, 0) + qty
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            removed = {}
+            if serials:
+                cur.execute("""
+                    DELETE FROM pantry WHERE serial = ANY(%s)
+                    RETURNING serial, id, name, expiration_date
+                """, (serials,))
+                removed = {row['serial']: dict(row) for row in cur.fetchall()}
+            taken = {item_id: [] for item_id in quantities}
+            if quantities:
+                # Rows locked by a concurrent checkout are skipped, so it takes the next oldest unit instead
+                cur.execute("""
+                    DELETE FROM pantry WHERE serial IN (
+                        SELECT oldest.serial
+                        FROM unnest(%s::bigint[], %s::int[]) AS r(id, qty)
+                        CROSS JOIN LATERAL (
+                            SELECT serial FROM pantry WHERE id = r.id
+                            ORDER BY expiration_date, serial LIMIT r.qty
+                            FOR UPDATE SKIP LOCKED
+                        ) oldest
+                    )
+                    RETURNING serial, id, expiration_date
+                """, (list(quantities.keys()), list(quantities.values())))
+                for row in sorted(cur.fetchall(), key=lambda row: (row['expiration_date'], row['serial'])):
+                    taken[row['id']].append(row['serial'])
+            conn.commit()
+        return {
+            'serials': [removed.get(serial, {'serial': serial, 'removed': False}) | {'removed': serial in removed}
+                        for serial in serials],
+            'items': [{'id': item_id, 'requested': qty, 'removed': taken[item_id]} for item_id, qty in quantities.items()]
+        }
+
+    # Rows fetched per round trip by the server-side cursors of expiry reports
+    STREAM_BATCH = 1000
+
+    # Units expiring up to end, and from start unless it is None, optionally of one category or item.
+    # Each filter leads an index ending in (expiration_date, serial), so the window is one range scan.
+    @staticmethod
+    def __expiry_window(start: date | None, end: date, category: str | None, item_id: int | None) -> tuple[str, list]:
+        conditions = ["expiration_date <= %s"]
+        params = [end]
+        if start is not None:
+            conditions.append("expiration_date >= %s")
+            params.append(start)
+        if category:
+            conditions.append("category = %s")
+            params.append(category)
+        if item_id is not None:
+            conditions.append("id = %s")
+            params.append(item_id)
+        return ' AND '.join(conditions), params
+
+    # Yield the rows of a query from a server-side cursor, STREAM_BATCH at a time, so memory stays flat
+    # however many rows there are. The cursor lives in the current transaction.
+    def __stream(self, sql: str, params: list) -> Iterator[dict]:
+        with self.pool.connection() as conn, conn.cursor(f"pantry_stream_{next(_cursor_names)}") as cur:
+            cur.itersize = self.STREAM_BATCH
+            cur.execute(sql, params)
+            columns = None
+            for row in cur:
+                # A named cursor only has a description once the first rows are fetched
+                columns = columns or [column.name for column in cur.description]
+                yield dict(zip(columns, row))
+
+    # Report on the units expiring in a window, read from one snapshot so the totals match the listings:
+    # summary holds the unit and item counts with the earliest expiry, overall and per category, while
+    # items (unit count and expiry range per item, soonest first) and units (soonest first) are streamed.
+    # The iterators must be consumed inside the with block, which holds a connection until it exits.
+    @contextmanager
+    def expiry_report(self, start: date | None, end: date, category: str | None = None,
+                      item_id: int | None = None) -> Iterator[dict]:
+        where, params = self.__expiry_window(start, end, category, item_id)
+        with self.pool.connection() as conn:
+            snapshot = conn.info.transaction_status == TRANSACTION_STATUS_IDLE
+            try:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    if snapshot:
+                        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                    cur.execute(f"""
+                        SELECT category, GROUPING(category) AS total, count(*) AS unit_count,
+                               count(DISTINCT id) AS item_count, min(expiration_date) AS earliest_expiration
+                        FROM pantry WHERE {where}
+                        GROUP BY GROUPING SETS ((category), ())
+                        ORDER BY total DESC, earliest_expiration, category
+                    """, params)
+                    total, *categories = [dict(row) for row in cur.fetchall()]
+                summary = {key: total[key] for key in ('unit_count', 'item_count', 'earliest_expiration')}
+                summary['categories'] = [{key: row[key] for key in ('category', 'unit_count', 'item_count', 'earliest_expiration')}
+                                         for row in categories]
+                yield {
+                    'summary': summary,
+                    'items': self.__stream(f"""
+                        SELECT id, min(name) AS name, min(category) AS category, count(*) AS unit_count,
+                               min(expiration_date) AS earliest_expiration, max(expiration_date) AS latest_expiration
+                        FROM pantry WHERE {where}
+                        GROUP BY id
+                        ORDER BY earliest_expiration, id
+                    """, params),
+                    'units': self.__stream(f"""
+                        SELECT serial, id, name, category, expiration_date FROM pantry
+                        WHERE {where}
+                        ORDER BY expiration_date, serial
+                    """, params),
+                }
+            finally:
+                if snapshot:
+                    conn.rollback()
+
     # Retrieve all items from the pantry, returning a list of dictionaries
     def get_all_items(self) -> list[dict[str, str]]:
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute("SELECT serial, id, name, category, expiration_date FROM pantry ORDER BY expiration_date")
             return [dict(row) for row in cur.fetchall()]
     
+    # Sort orders for get_page, each backed by a (column, serial) index
+    PAGE_SORTS = {'expiration': 'expiration_date', 'name': 'name', 'category': 'category'}
+
+    # Retrieve one page of pantry items with keyset pagination, so the cost of a page depends on
+    # its size rather than on the size of the pantry. Pass the returned cursor as after to get the next page.
+    def get_page(self, limit: int = 50, after: str | None = None, sort: str = 'expiration',
+                 search: str | None = None, category: str | None = None,
+                 expires_from: str | None = None, expires_to: str | None = None) -> dict:
+        if not (column := self.PAGE_SORTS.get(sort)):
+            raise Exception("Invalid sort order")
+        conditions = []
+        params = {'limit': limit + 1}
+        if search:
+            conditions.append("(lower(name) LIKE %(pattern)s OR lower(category) LIKE %(pattern)s"
+                              " OR serial::text = %(search)s OR id::text = %(search)s)")
+            params.update(pattern=f"%{_like_escape(search.lower())}%", search=search)
+        if category:
+            conditions.append("category = %(category)s")
+            params['category'] = category
+        if expires_from:
+            conditions.append("expiration_date >= %(expires_from)s")
+            params['expires_from'] = expires_from
+        if expires_to:
+            conditions.append("expiration_date <= %(expires_to)s")
+            params['expires_to'] = expires_to
+        if after:
+            conditions.append(f"({column}, serial) > (%(after_value)s, %(after_serial)s)")
+            params['after_value'], params['after_serial'] = _decode_cursor(after)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(PANTRY_PAGE_SQL.format(where=where, column=column), params)
+            return pantry_page([dict(row) for row in cur.fetchall()], limit, column)
+    
     # Retrieve a single item by its serial number
     def get_item_by_serial(self, serial: int) -> dict[str, str] | None:
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute("SELECT serial, id, name, category, expiration_date FROM pantry WHERE serial = %s", (serial,))
             result = cur.fetchone()
             if result:
@@ -173,10 +726,10 @@ class PantryDB:
     
     # Remove the oldest item by item ID (based on expiration date)
     def remove_oldest_by_id(self, item_id: int) -> None:
-        with self.conn.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             cur.execute("""
                 DELETE FROM pantry WHERE serial = (
                     SELECT serial FROM pantry WHERE id = %s ORDER BY expiration_date ASC LIMIT 1
                 )
             """, (item_id,))
-            self.conn.commit()
+            conn.commit()
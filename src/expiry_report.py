@@ -0,0 +1,114 @@
+from io import BytesIO
+from typing import BinaryIO
+
+from src.pdf_stream import StreamingPDFWriter, text
+
+# Printable "expiring soon" report: the units of an expiry window summarised per category and per item,
+# then listed one per line, soonest first. Pages are written as they fill from the streamed rows of
+# PantryDB.expiry_report, so a report of any length is rendered in the same memory as a single page.
+
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792  # US letter, in points
+MARGIN = 54
+LINE = 12
+FONT_SIZE = 9
+CHARS = int((PAGE_WIDTH - 2 * MARGIN) / (FONT_SIZE * 0.6))  # Courier characters per line
+
+# Names as one line of text cut to fit
+def _clip(string: str, width: int) -> str:
+    string = ' '.join(str(string).split())
+    return string if len(string) <= width else string[:width - 3] + '...'
+
+# _ReportPages lays out headings and fixed-width rows, starting a page whenever one fills up. Each page
+# repeats the report title, and the column headings of the section it continues.
+class _ReportPages:
+    def __init__(self, pdf: StreamingPDFWriter, title: str):
+        self.pdf = pdf
+        self.title = title
+        self.number = 0
+        self.columns: str | None = None
+        self.content: list[bytes] = []
+        self.y = 0.0
+        self.__new_page()
+
+    def __flush(self) -> None:
+        if self.content:
+            self.pdf.add_text_page(b"".join(self.content))
+
+    def __new_page(self) -> None:
+        self.__flush()
+        self.number += 1
+        page = f"Page {self.number}"
+        self.content = [
+            text(MARGIN, PAGE_HEIGHT - MARGIN, 'F2', 10, _clip(self.title, 70)),
+            text(PAGE_WIDTH - MARGIN - len(page) * FONT_SIZE * 0.6, PAGE_HEIGHT - MARGIN, 'F1', FONT_SIZE, page),
+        ]
+        self.y = PAGE_HEIGHT - MARGIN - 2 * LINE
+        if self.columns:
+            self.__line('F2', self.columns)
+
+    def __line(self, font: str, string: str, size: float = FONT_SIZE) -> None:
+        self.content.append(text(MARGIN, self.y, font, size, string))
+        self.y -= LINE
+
+    def note(self, string: str) -> None:
+        if self.y < MARGIN:
+            self.__new_page()
+        self.__line('F1', _clip(string, CHARS))
+
+    # Start a section, on a new page unless its heading, column headings and first row fit on this one
+    def section(self, heading: str, columns: str) -> None:
+        self.columns = None
+        if self.y - 4 * LINE < MARGIN:
+            self.__new_page()
+        self.y -= LINE / 2
+        self.__line('F2', heading, 12)
+        self.y -= LINE / 4
+        self.columns = columns
+        self.__line('F2', columns)
+
+    def row(self, string: str) -> None:
+        if self.y < MARGIN:
+            self.__new_page()
+        self.__line('F1', string[:CHARS])
+
+    def close(self) -> None:
+        self.__flush()
+        self.pdf.close()
+
+# Write the report for a window ({from, to, category, item_id}, from None for no lower bound) from the
+# summary and row iterators of PantryDB.expiry_report. The PDF is written to out if given, otherwise
+# to a new in-memory buffer.
+def generate_expiry_report(window: dict, report: dict, out: BinaryIO | None = None) -> BinaryIO:
+    out = out if out is not None else BytesIO()
+    summary = report['summary']
+    if window['from'] is None:
+        title = f"Expired or expiring by {window['to']}"
+    else:
+        title = f"Expiring from {window['from']} to {window['to']}"
+    filters = [f"category {window['category']}" if window['category'] else None,
+               f"item {window['item_id']}" if window['item_id'] is not None else None]
+    pages = _ReportPages(StreamingPDFWriter(out, PAGE_WIDTH, PAGE_HEIGHT), title)
+
+    if filters := [f for f in filters if f]:
+        pages.note(f"Only {' and '.join(filters)}")
+    if not summary['unit_count']:
+        pages.note("Nothing expires in this window.")
+    else:
+        pages.note(f"{summary['unit_count']} units of {summary['item_count']} items, the first expiring {summary['earliest_expiration']}")
+
+        pages.section("By category", f"{'Category':<40} {'Units':>8} {'Items':>8}  First expiry")
+        for row in summary['categories']:
+            pages.row(f"{_clip(row['category'], 40):<40} {row['unit_count']:>8} {row['item_count']:>8}  {row['earliest_expiration']}")
+
+        pages.section("By item", f"{'First':<10} {'Last':<10} {'Units':>6} {'Item ID':>10}  Name")
+        for row in report['items']:
+            pages.row(f"{row['earliest_expiration']!s:<10} {row['latest_expiration']!s:<10} {row['unit_count']:>6} "
+                      f"{row['id']:>10}  {_clip(row['name'], CHARS - 42)}")
+
+        pages.section("Units", f"{'Expires':<10} {'Serial':>10} {'Item ID':>10}  Name")
+        for row in report['units']:
+            pages.row(f"{row['expiration_date']!s:<10} {row['serial']:>10} {row['id']:>10}  "
+                      f"{_clip(row['name'], CHARS - 35)}")
+    pages.close()
+    out.seek(0)
+    return out
@@ -0,0 +1,219 @@
+import argparse
+from json import dumps
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO
+import os
+import threading
+import traceback
+import uuid
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from dotenv import load_dotenv
+
+from src import metrics
+from src.data_handling import ConnectionPool
+from src.pdf_cache import PDF_KINDS, PDFCache, pdf_filename, pdf_key, render_pdf
+
+# Background render jobs for label and shopping list PDFs.
+# Jobs are rows in the render_jobs table: the web app queues them and returns straight away, and
+# job workers (`python -m src.jobs`) claim them with FOR UPDATE SKIP LOCKED, render the PDF and
+# store it on the row until it expires. Identical requests share one job while it is queued,
+# running, or done and not yet expired. With a PDFCache, workers reuse PDFs already rendered by
+# the web app or by earlier jobs.
+
+JOB_TTL = int(os.getenv("JOB_TTL", 3600))  # seconds a finished job and its PDF are kept
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1.0))  # seconds an idle worker waits between checks
+JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", 600))  # seconds before a running job is presumed lost
+JOB_MAX_ATTEMPTS = 3
+RESULT_CHUNK = 256 * 1024  # bytes of a finished PDF read from the database per row
+
+# Job IDs come from URLs, so they are checked before they reach a query
+def _job_uuid(job_id: str) -> str:
+    try:
+        return str(uuid.UUID(job_id))
+    except ValueError:
+        raise Exception("Invalid job ID")
+
+# JobQueue queues render jobs, reports their status and hands finished PDFs back
+class JobQueue:
+    def __init__(self, pool: ConnectionPool, ttl: int = JOB_TTL, cache: PDFCache | None = None):
+        self.pool = pool
+        self.ttl = ttl
+        self.cache = cache
+
+    # Queue a job, or return the ID of an identical job that is queued, running or done.
+    # Parameters must hold everything the renderer needs, so a job's output never depends on when it runs.
+    def submit(self, kind: str, params: dict) -> str:
+        if kind not in PDF_KINDS:
+            raise Exception(f"Unknown job kind: {kind}")
+        key = pdf_key(kind, params)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM render_jobs
+                WHERE dedupe_key = %s AND (status = 'failed' OR expires_at < CURRENT_TIMESTAMP)
+            """, (key,))
+            cur.execute("""
+                INSERT INTO render_jobs (id, kind, params, dedupe_key) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (dedupe_key) DO UPDATE SET dedupe_key = EXCLUDED.dedupe_key
+                RETURNING id
+            """, (str(uuid.uuid4()), kind, dumps(params), key))
+            job_id = cur.fetchone()[0]
+            conn.commit()
+            return str(job_id)
+
+    # Get a job's status, or None if it does not exist or has expired
+    def status(self, job_id: str) -> dict | None:
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT id::text, kind, status, error, filename, created_at, started_at, finished_at, expires_at
+                FROM render_jobs
+                WHERE id = %s AND (expires_at IS NULL OR expires_at >= CURRENT_TIMESTAMP)
+            """, (_job_uuid(job_id),))
+            return dict(result) if (result := cur.fetchone()) else None
+
+    # Get a finished job's file name and PDF cache key, or None if it is not done or has expired
+    def result(self, job_id: str) -> tuple[str, str] | None:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT filename, dedupe_key FROM render_jobs
+                WHERE id = %s AND status = 'done' AND expires_at >= CURRENT_TIMESTAMP
+            """, (_job_uuid(job_id),))
+            return tuple(result) if (result := cur.fetchone()) else None
+
+    # Copy a finished job's PDF to out in RESULT_CHUNK slices, read through a server-side cursor so
+    # only a few slices are in memory at a time. Results are stored uncompressed (migration 11), so
+    # each slice reads only its own part of the value.
+    def write_result(self, job_id: str, out: BinaryIO) -> None:
+        written = 0
+        with self.pool.connection() as conn:
+            with conn.cursor(name='job_result') as cur:
+                cur.itersize = 4
+                cur.execute("""
+                    SELECT substring(j.result FROM s FOR %s)
+                    FROM render_jobs j, generate_series(1, octet_length(j.result), %s) s
+                    WHERE j.id = %s AND j.status = 'done' AND j.expires_at >= CURRENT_TIMESTAMP
+                    ORDER BY s
+                """, (RESULT_CHUNK, RESULT_CHUNK, _job_uuid(job_id)))
+                for (chunk,) in cur:
+                    out.write(chunk)
+                    written += len(chunk)
+            conn.rollback()
+        if not written:
+            raise Exception("Job result not available")
+
+    # Claim the oldest queued job for this worker, returning (id, kind, params) or None if there is none
+    def claim(self) -> tuple[str, str, dict] | None:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE render_jobs SET status = 'running', started_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+                WHERE id = (
+                    SELECT id FROM render_jobs WHERE status = 'queued'
+                    ORDER BY created_at LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id::text, kind, params
+            """)
+            result = cur.fetchone()
+            conn.commit()
+            return result
+
+    def complete(self, job_id: str, filename: str, pdf: bytes) -> None:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE render_jobs
+                SET status = 'done', filename = %s, result = %s, finished_at = CURRENT_TIMESTAMP,
+                    expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE id = %s
+            """, (filename, psycopg2.Binary(pdf), self.ttl, job_id))
+            conn.commit()
+
+    # Failed jobs are kept until they expire so their error can be shown, but never deduplicated against
+    def fail(self, job_id: str, error: str) -> None:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE render_jobs
+                SET status = 'failed', error = %s, finished_at = CURRENT_TIMESTAMP,
+                    expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE id = %s
+            """, (error, self.ttl, job_id))
+            conn.commit()
+
+    # Requeue jobs whose worker died mid-render, failing those that have used up their attempts,
+    # and delete expired jobs. Returns the number of rows requeued, failed and deleted.
+    def maintain(self, stale_after: int = JOB_STALE_AFTER) -> int:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE render_jobs
+                SET status = CASE WHEN attempts < %s THEN 'queued' ELSE 'failed' END,
+                    error = CASE WHEN attempts < %s THEN NULL ELSE 'Render worker stopped responding' END,
+                    expires_at = CASE WHEN attempts < %s THEN NULL
+                                      ELSE CURRENT_TIMESTAMP + make_interval(secs => %s) END
+                WHERE status = 'running' AND started_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+            """, (JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, self.ttl, stale_after))
+            changed = cur.rowcount
+            cur.execute("DELETE FROM render_jobs WHERE expires_at < CURRENT_TIMESTAMP")
+            changed += cur.rowcount
+            conn.commit()
+            return changed
+
+    # Claim and render one job, returning False if there was nothing to do
+    def run_one(self) -> bool:
+        if not (job := self.claim()):
+            return False
+        job_id, kind, params = job
+        render = lambda out: render_pdf(kind, params, out)
+        try:
+            if self.cache is not None:
+                with self.cache.get_or_render(pdf_key(kind, params), render) as pdf:
+                    self.complete(job_id, pdf_filename(kind, params), pdf.read())
+            else:
+                with SpooledTemporaryFile(max_size=1024 * 1024) as out:
+                    render(out)
+                    out.seek(0)
+                    self.complete(job_id, pdf_filename(kind, params), out.read())
+        except Exception as e:
+            traceback.print_exc()
+            self.fail(job_id, str(e))
+        return True
+
+    # Work through queued jobs until stop is set, sleeping while the queue is empty
+    def run_worker(self, stop: threading.Event, poll_interval: float = JOB_POLL_INTERVAL) -> None:
+        while not stop.is_set():
+            try:
+                self.maintain()
+                while not stop.is_set() and self.run_one():
+                    metrics.flush()
+            except Exception:
+                # Database outages and pool timeouts must not end the worker; it retries after poll_interval
+                traceback.print_exc()
+            stop.wait(poll_interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render queued label and shopping list PDFs")
+    parser.add_argument('--threads', type=int, default=1, help="jobs rendered at the same time by this process")
+    parser.add_argument('--once', action='store_true', help="render every queued job, then exit")
+    args = parser.parse_args()
+
+    load_dotenv()
+    queue = JobQueue(ConnectionPool.from_env(), cache=PDFCache.from_env())
+    try:
+        if args.once:
+            queue.maintain()
+            while queue.run_one():
+                pass
+        else:
+            stop = threading.Event()
+            workers = [threading.Thread(target=queue.run_worker, args=(stop,)) for _ in range(args.threads)]
+            for worker in workers:
+                worker.start()
+            try:
+                for worker in workers:
+                    worker.join()
+            except KeyboardInterrupt:
+                stop.set()
+                for worker in workers:
+                    worker.join()
+    finally:
+        # This process's metrics go into the total of exited processes
+        metrics.flush(force=True)
+        metrics.retire(os.getpid())
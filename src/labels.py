@@ -0,0 +1,259 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from multiprocessing import get_context
+from typing import BinaryIO, Iterator
+import os
+import threading
+import zlib
+from reportlab.graphics.barcode.code128 import Code128
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont, TTFError
+from reportlab.pdfgen import canvas
+from reportlab.lib.units import inch
+from PIL import Image, ImageDraw, ImageFont
+import barcode
+from barcode.writer import ImageWriter
+
+from src.metrics import RENDER_PHASE_SECONDS, timed_iter
+from src.pdf_stream import StreamingPDFWriter
+
+# Label rendering for 4x6 inch pantry labels at 300 DPI (vertical layout).
+# Fonts, the static captions and item barcodes are rendered once and reused, so each page only
+# draws its serial barcode and serial text. Large jobs are rendered by a pool of worker processes,
+# which hand back each page as a compressed 1-bit image ready to be embedded in the PDF.
+
+# Two renderers produce the same layout: 'raster' draws 300 DPI bitmaps with Pillow, 'vector' draws
+# text and barcodes natively with ReportLab, giving much smaller files that print sharp at any DPI.
+LABEL_RENDERER = os.getenv("LABEL_RENDERER", "raster")
+
+# Number of render processes per app process (0 or 1 renders in the request thread) and the smallest job
+# worth sending to them. Every gunicorn worker has its own pool, so by default the CPUs are shared
+# between GUNICORN_WORKERS workers (gunicorn.conf.py's default of 4 when unset) rather than each one
+# starting a process per CPU.
+_CPUS_PER_WORKER = max(1, (os.cpu_count() or 1) // int(os.getenv("GUNICORN_WORKERS", 4)))
+LABEL_WORKERS = int(os.getenv("LABEL_WORKERS", _CPUS_PER_WORKER))
+LABEL_PARALLEL_MIN = int(os.getenv("LABEL_PARALLEL_MIN", "16"))
+LABEL_CHUNK_SIZE = 8
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static')
+WIDTH, HEIGHT = 1200, 1800
+BARCODE_SIZE = (1000, 300)
+BARCODE_OPTIONS = {
+    'write_text': False,
+    'module_height': 25,
+    'module_width': 0.6,
+    'quiet_zone': 10
+}
+
+# Bars only fill part of each rendered barcode image, python-barcode adds margins around them
+BARCODE_MODULE_MM = BARCODE_OPTIONS['module_width']
+BARCODE_QUIET_MM = BARCODE_OPTIONS['quiet_zone']
+BAR_TOP = 10
+BAR_HEIGHT = 281
+
+# Font sizes in label pixels
+FONT_HUGE, FONT_LARGE, FONT_MEDIUM = 120, 80, 60
+
+# Vertical position of each element on the label
+SERIAL_CAPTION_Y = 50
+SERIAL_BARCODE_Y = 140
+SERIAL_TEXT_Y = 450
+ITEM_CAPTION_Y = 550
+ITEM_BARCODE_Y = 640
+ITEM_TEXT_Y = 950
+EXPIRES_CAPTION_Y = 1050
+EXPIRES_TEXT_Y = 1140
+NAME_Y = 1280
+
+# Load the label fonts once per process, falling back to the default font if Roboto is missing
+@lru_cache(maxsize=1)
+def load_fonts() -> tuple[ImageFont.ImageFont, ImageFont.ImageFont, ImageFont.ImageFont]:
+    try:
+        font_huge = ImageFont.truetype(os.path.join(STATIC_DIR, 'Roboto-Bold.ttf'), FONT_HUGE)
+        font_large = ImageFont.truetype(os.path.join(STATIC_DIR, 'Roboto-Bold.ttf'), FONT_LARGE)
+        font_medium = ImageFont.truetype(os.path.join(STATIC_DIR, 'Roboto-Regular.ttf'), FONT_MEDIUM)
+    except OSError:
+        font_huge = ImageFont.load_default()
+        font_large = ImageFont.load_default()
+        font_medium = ImageFont.load_default()
+    return font_huge, font_large, font_medium
+
+# python-barcode starts in code set C and drops the first symbol when it is a switch to the start
+# code set, but in code set C the value 99 is also the digits "99", so codes starting with 99 lost them
+class _Code128(barcode.get_barcode_class('code128')):
+    def _try_to_optimize(self, encoded: list[int]) -> list[int]:
+        return encoded if encoded[1:2] == [99] else super()._try_to_optimize(encoded)
+
+# Render a Code128 barcode at label size
+def render_barcode(value: str) -> Image.Image:
+    code = _Code128(value, writer=ImageWriter())
+    return code.render(BARCODE_OPTIONS).convert('L').resize(BARCODE_SIZE)
+
+# Item barcodes are the same on every label of an item, keep the most recent ones around
+@lru_cache(maxsize=64)
+def item_barcode(item_id: str) -> Image.Image:
+    return render_barcode(item_id)
+
+def _draw_centered(draw: ImageDraw.ImageDraw, y: int, text: str, font: ImageFont.ImageFont) -> None:
+    text_bbox = draw.textbbox((0, 0), text, font=font)
+    text_width = text_bbox[2] - text_bbox[0]
+    draw.text((WIDTH // 2 - text_width // 2, y), text, font=font, fill='black')
+
+# Blank label with the 'Serial:', 'Item ID:' and 'Expires:' captions, rendered once per process
+@lru_cache(maxsize=1)
+def _static_template() -> Image.Image:
+    _, font_large, _ = load_fonts()
+    img = Image.new('L', (WIDTH, HEIGHT), 'white')
+    draw = ImageDraw.Draw(img)
+    _draw_centered(draw, SERIAL_CAPTION_Y, 'Serial:', font_large)
+    _draw_centered(draw, ITEM_CAPTION_Y, 'Item ID:', font_large)
+    _draw_centered(draw, EXPIRES_CAPTION_Y, 'Expires:', font_large)
+    return img
+
+# Label with everything except the serial, shared by every page of a label job
+@lru_cache(maxsize=4)
+def item_template(item_id: str, expiration_date: str, item_name: str) -> Image.Image:
+    font_huge, font_large, font_medium = load_fonts()
+    img = _static_template().copy()
+    draw = ImageDraw.Draw(img)
+    img.paste(item_barcode(item_id), ((WIDTH - BARCODE_SIZE[0]) // 2, ITEM_BARCODE_Y))
+    _draw_centered(draw, ITEM_TEXT_Y, item_id, font_medium)
+    _draw_centered(draw, EXPIRES_TEXT_Y, expiration_date, font_huge)
+    _draw_centered(draw, NAME_Y, item_name, font_large)
+    return img
+
+# Render the label for one serial on top of an item template
+def render_label(template: Image.Image, serial: str) -> Image.Image:
+    _, _, font_medium = load_fonts()
+    img = template.copy()
+    img.paste(render_barcode(serial), ((WIDTH - BARCODE_SIZE[0]) // 2, SERIAL_BARCODE_Y))
+    _draw_centered(ImageDraw.Draw(img), SERIAL_TEXT_Y, serial, font_medium)
+    return img
+
+# Render one label page as a Flate-compressed 1-bit image. Labels are black and white, so
+# thresholding keeps them sharp while making pages small to pass between processes and to embed.
+def render_page(item_id: str, expiration_date: str, item_name: str, serial: str) -> bytes:
+    img = render_label(item_template(item_id, expiration_date, item_name), serial)
+    return zlib.compress(img.convert('1', dither=Image.Dither.NONE).tobytes())
+
+def render_pages(item_id: str, expiration_date: str, item_name: str, serials: list[str]) -> list[bytes]:
+    return [render_page(item_id, expiration_date, item_name, serial) for serial in serials]
+
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+# The render pool is started on first use with spawn, so workers never inherit the web worker's
+# threads or database connections
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=LABEL_WORKERS, mp_context=get_context('spawn'), initializer=load_fonts)
+        return _executor
+
+# Yield encoded pages in serial order. Chunks are rendered in parallel with a bounded number in
+# flight, so pages are written to the PDF as they arrive without queueing up the whole job.
+def _iter_pages(serials: list[str], item_id: str, expiration_date: str, item_name: str) -> Iterator[bytes]:
+    if LABEL_WORKERS < 2 or len(serials) < LABEL_PARALLEL_MIN:
+        for serial in serials:
+            yield render_page(item_id, expiration_date, item_name, serial)
+        return
+
+    executor = _get_executor()
+    chunks = (serials[i:i + LABEL_CHUNK_SIZE] for i in range(0, len(serials), LABEL_CHUNK_SIZE))
+    in_flight = deque()
+    for chunk in chunks:
+        in_flight.append(executor.submit(render_pages, item_id, expiration_date, item_name, chunk))
+        if len(in_flight) >= LABEL_WORKERS * 2:
+            yield from in_flight.popleft().result()
+    while in_flight:
+        yield from in_flight.popleft().result()
+
+# Generate a PDF with one 4x6 inch bitmap label page per serial, written to out as pages arrive.
+# Only the page being written is held in memory, however long the job is.
+def generate_raster_labels(serials: list[str], item_id: str, expiration_date: str, item_name: str,
+                           out: BinaryIO | None = None) -> BinaryIO:
+    out = out if out is not None else BytesIO()
+    pdf = StreamingPDFWriter(out, 4*inch, 6*inch)
+    pages = _iter_pages(serials, item_id, expiration_date, item_name)
+    for page in timed_iter(pages, RENDER_PHASE_SECONDS, document='labels_raster', phase='raster'):
+        pdf.add_image_page(page, WIDTH, HEIGHT)
+    pdf.close()
+    out.seek(0)
+    return out
+
+PAGE_WIDTH, PAGE_HEIGHT = 4*inch, 6*inch
+PX = PAGE_WIDTH / WIDTH  # points per label pixel
+
+# Register the Roboto fonts with ReportLab once per process, falling back to Helvetica if they are missing
+@lru_cache(maxsize=1)
+def register_vector_fonts() -> tuple[str, str]:
+    try:
+        pdfmetrics.registerFont(TTFont('Roboto-Bold', os.path.join(STATIC_DIR, 'Roboto-Bold.ttf')))
+        pdfmetrics.registerFont(TTFont('Roboto-Regular', os.path.join(STATIC_DIR, 'Roboto-Regular.ttf')))
+        return 'Roboto-Bold', 'Roboto-Regular'
+    except (OSError, TTFError):
+        return 'Helvetica-Bold', 'Helvetica'
+
+# Draw text centred with its ascender line at y. The ascent comes from the Pillow font used by the raster
+# renderer, since ReportLab reads a smaller ascent from the Roboto font tables than FreeType does.
+def _draw_vector_text(pdf: canvas.Canvas, y: int, text: str, font: str, size: int, ascent: int) -> None:
+    pdf.setFont(font, size * PX)
+    pdf.drawCentredString(PAGE_WIDTH / 2, PAGE_HEIGHT - (y + ascent) * PX, text)
+
+# Draw a Code128 barcode with the same module proportions and quiet zones as the raster barcode
+def _draw_vector_barcode(pdf: canvas.Canvas, y: int, value: str) -> None:
+    modules = Code128(value, barWidth=1, quiet=0).width
+    scale = BARCODE_SIZE[0] * PX / (modules * BARCODE_MODULE_MM + 2 * BARCODE_QUIET_MM)
+    code = Code128(value, barWidth=BARCODE_MODULE_MM * scale, barHeight=BAR_HEIGHT * PX, quiet=0)
+    code.drawOn(pdf, (PAGE_WIDTH - BARCODE_SIZE[0] * PX) / 2 + BARCODE_QUIET_MM * scale,
+                PAGE_HEIGHT - (y + BAR_TOP + BAR_HEIGHT) * PX)
+
+# Generate a PDF with one 4x6 inch vector label page per serial. Everything but the serial is drawn
+# once into a form XObject that every page reuses.
+def generate_vector_labels(serials: list[str], item_id: str, expiration_date: str, item_name: str,
+                           out: BinaryIO | None = None) -> BinaryIO:
+    font_bold, font_regular = register_vector_fonts()
+    huge, large, medium = (font.getmetrics()[0] for font in load_fonts())
+    out = out if out is not None else BytesIO()
+    pdf = canvas.Canvas(out, pagesize=(PAGE_WIDTH, PAGE_HEIGHT))
+
+    pdf.beginForm('item')
+    _draw_vector_text(pdf, SERIAL_CAPTION_Y, 'Serial:', font_bold, FONT_LARGE, large)
+    _draw_vector_text(pdf, ITEM_CAPTION_Y, 'Item ID:', font_bold, FONT_LARGE, large)
+    _draw_vector_barcode(pdf, ITEM_BARCODE_Y, item_id)
+    _draw_vector_text(pdf, ITEM_TEXT_Y, item_id, font_regular, FONT_MEDIUM, medium)
+    _draw_vector_text(pdf, EXPIRES_CAPTION_Y, 'Expires:', font_bold, FONT_LARGE, large)
+    _draw_vector_text(pdf, EXPIRES_TEXT_Y, expiration_date, font_bold, FONT_HUGE, huge)
+    _draw_vector_text(pdf, NAME_Y, item_name, font_bold, FONT_LARGE, large)
+    pdf.endForm()
+
+    with RENDER_PHASE_SECONDS.time(document='labels_vector', phase='draw'):
+        for serial in serials:
+            pdf.doForm('item')
+            _draw_vector_barcode(pdf, SERIAL_BARCODE_Y, serial)
+            _draw_vector_text(pdf, SERIAL_TEXT_Y, serial, font_regular, FONT_MEDIUM, medium)
+            pdf.showPage()
+
+    with RENDER_PHASE_SECONDS.time(document='labels_vector', phase='save'):
+        pdf.save()
+    out.seek(0)
+    return out
+
+RENDERERS = {'raster': generate_raster_labels, 'vector': generate_vector_labels}
+
+# Generate a label PDF with the chosen renderer, into out if given or a new in-memory buffer
+def generate_labels(serials: list[str], item_id: str, expiration_date: str, item_name: str,
+                    renderer: str = LABEL_RENDERER, out: BinaryIO | None = None) -> BinaryIO:
+    if renderer not in RENDERERS:
+        raise Exception(f"Unknown label renderer: {renderer}")
+    return RENDERERS[renderer](serials, item_id, expiration_date, item_name, out)
+
+# Load the fonts and the static label layout now rather than for the first label, so a server that
+# preloads the app loads them once and its forked workers share them
+def preload() -> None:
+    load_fonts()
+    register_vector_fonts()
+    _static_template()
@@ -0,0 +1,266 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from functools import lru_cache
+from json import dumps, loads
+from typing import Iterable, Iterator, TypeVar
+import fcntl
+import os
+import sys
+import threading
+import time
+from psycopg2.extensions import connection, cursor
+
+# Prometheus-format latency histograms for routes, SQL statements and PDF rendering.
+# Every SQL statement run through a pooled connection is timed and labelled with the function or method
+# that issued it (e.g. PantryDB.stock_for_items), and counted against the request it belongs to.
+# Metrics live in each process. With METRICS_DIR set, every process writes a snapshot there at most
+# once a second and /metrics sums the snapshots of all processes, so gunicorn workers and render job
+# workers report together.
+
+METRICS_DIR = os.getenv("METRICS_DIR")
+FLUSH_INTERVAL = 1.0
+DEAD_SNAPSHOT = 'dead.json'  # metrics of every process that has exited, see retire
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_histograms: list['Histogram'] = []
+
+# Histogram is a labelled Prometheus histogram, observations are thread safe
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...], buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # Per label values: a count for each bucket (non-cumulative, the last is +Inf), the sum and the count
+        self.__series: dict[tuple[str, ...], list[float]] = {}
+        self.__lock = threading.Lock()
+        _histograms.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.__lock:
+            if (series := self.__series.get(key)) is None:
+                series = self.__series[key] = [0] * (len(self.buckets) + 3)
+            series[bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    # Time the body of a with block
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict[str, list[float]]:
+        with self.__lock:
+            return {dumps(key): list(series) for key, series in self.__series.items()}
+
+    def render(self, series: dict[str, list[float]]) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, values in sorted(series.items()):
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, loads(key))]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{{{','.join(labels + [le])}}} {cumulative}")
+            suffix = f"{{{','.join(labels)}}}" if labels else ''
+            lines.append(f"{self.name}_sum{suffix} {values[-2]}")
+            lines.append(f"{self.name}_count{suffix} {int(values[-1])}")
+        return lines
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', "Time spent handling a request", ('route', 'method', 'status'))
+REQUEST_QUERIES = Histogram('http_request_queries', "SQL statements issued by a request", ('route',), COUNT_BUCKETS)
+QUERY_SECONDS = Histogram('db_query_duration_seconds', "Time spent executing a SQL statement", ('operation',))
+RENDER_SECONDS = Histogram('pdf_render_duration_seconds', "Time spent generating a PDF", ('kind',))
+RENDER_PHASE_SECONDS = Histogram('pdf_render_phase_duration_seconds', "Time spent in each phase of PDF generation",
+                                 ('document', 'phase'))
+
+T = TypeVar('T')
+
+# Observe the total time spent producing the items of an iterable, once it is exhausted
+def timed_iter(items: Iterable[T], histogram: Histogram, **labels: str) -> Iterator[T]:
+    elapsed = 0.0
+    iterator = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            histogram.observe(elapsed + time.perf_counter() - start, **labels)
+            return
+        elapsed += time.perf_counter() - start
+        yield item
+
+# QueryLog counts the statements of one request by operation, so repeated lookups stand out
+class QueryLog:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.operations: dict[str, int] = {}
+        self.__statements: dict[tuple[str, str], int] = {}
+
+    def record(self, operation: str, statement: str, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        self.operations[operation] = self.operations.get(operation, 0) + 1
+        self.__statements[operation, statement] = self.__statements.get((operation, statement), 0) + 1
+
+    # Operations that ran the same statement at least threshold times, with the most repeats of one
+    # statement, most repeated first. An operation running several different statements is not counted.
+    def repeated(self, threshold: int) -> list[tuple[str, int]]:
+        worst: dict[str, int] = {}
+        for (operation, _), n in self.__statements.items():
+            worst[operation] = max(worst.get(operation, 0), n)
+        return sorted(((op, n) for op, n in worst.items() if n >= threshold), key=lambda item: -item[1])
+
+_query_log: ContextVar[QueryLog | None] = ContextVar('query_log', default=None)
+
+# Count the SQL statements issued in the current context in log, until untrack_queries is called with the token
+def track_queries(log: QueryLog) -> Token:
+    return _query_log.set(log)
+
+def untrack_queries(token: Token) -> None:
+    _query_log.reset(token)
+
+# Yield the items of a response body generated after its request has finished, counting the statements
+# issued while producing each one in log. The log is set for each item on its own, so it does not
+# matter which thread or context the server iterates the body in. Closing closes items too.
+def tracked_iter(items: Iterable[T], log: QueryLog) -> Iterator[T]:
+    iterator = iter(items)
+    try:
+        while True:
+            token = _query_log.set(log)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _query_log.reset(token)
+            yield item
+    finally:
+        if (close := getattr(iterator, 'close', None)) is not None:
+            close()
+
+# Time a statement against its operation and the current request. Called from the execute method of
+# a connection or cursor, whose caller is the operation.
+def record_query(statement, seconds: float) -> None:
+    # The caller of execute is the data layer function or method that issued the statement
+    code = sys._getframe(2).f_code
+    operation = getattr(code, 'co_qualname', code.co_name)
+    QUERY_SECONDS.observe(seconds, operation=operation)
+    if (log := _query_log.get()) is not None:
+        log.record(operation, str(statement), seconds)
+
+# Subclass a cursor class so its statements are timed
+@lru_cache(maxsize=None)
+def _timed_cursor(base: type) -> type:
+    class TimedCursor(base):
+        def execute(self, query, vars=None):
+            start = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            finally:
+                record_query(query, time.perf_counter() - start)
+
+        def executemany(self, query, vars_list):
+            start = time.perf_counter()
+            try:
+                return super().executemany(query, vars_list)
+            finally:
+                record_query(query, time.perf_counter() - start)
+
+    TimedCursor.__name__ = f"Timed{base.__name__}"
+    return TimedCursor
+
+# Connection class for psycopg2.connect whose cursors, of any cursor_factory, time their statements
+class TimedConnection(connection):
+    def cursor(self, *args, **kwargs):
+        kwargs['cursor_factory'] = _timed_cursor(kwargs.get('cursor_factory') or self.cursor_factory or cursor)
+        return super().cursor(*args, **kwargs)
+
+_last_flush = 0.0
+_flush_lock = threading.Lock()
+
+# Write this process's snapshot to METRICS_DIR, at most once a second unless forced
+def flush(force: bool = False) -> None:
+    global _last_flush
+    if not METRICS_DIR or (not force and time.monotonic() - _last_flush < FLUSH_INTERVAL):
+        return
+    with _flush_lock:
+        _last_flush = time.monotonic()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        with open(f"{path}.tmp", 'w') as file:
+            file.write(dumps({histogram.name: histogram.snapshot() for histogram in _histograms}))
+        os.replace(f"{path}.tmp", path)
+
+# Add the series of a snapshot to merged. Series whose buckets changed replace the old ones.
+def _merge(merged: dict[str, dict[str, list[float]]], snapshot: dict[str, dict[str, list[float]]]) -> None:
+    for metric, series in snapshot.items():
+        target = merged.setdefault(metric, {})
+        for key, values in series.items():
+            if (current := target.get(key)) is None or len(current) != len(values):
+                target[key] = values
+            else:
+                target[key] = [a + b for a, b in zip(current, values)]
+
+# Fold the snapshot of a process that has exited into DEAD_SNAPSHOT and delete it, so /metrics keeps
+# its counts while METRICS_DIR holds one file per live process. The gunicorn master calls this as each
+# worker exits, and render job workers as they stop; a lock file serialises them.
+def retire(pid: int) -> None:
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return
+    path = os.path.join(METRICS_DIR, f"{pid}.json")
+    dead = os.path.join(METRICS_DIR, DEAD_SNAPSHOT)
+    with open(os.path.join(METRICS_DIR, 'retire.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as file:
+                snapshot = loads(file.read())
+        except (OSError, ValueError):
+            snapshot = None
+        if snapshot:
+            merged = {}
+            try:
+                with open(dead) as file:
+                    merged = loads(file.read())
+            except (OSError, ValueError):
+                pass
+            _merge(merged, snapshot)
+            with open(f"{dead}.tmp", 'w') as file:
+                file.write(dumps(merged))
+            os.replace(f"{dead}.tmp", dead)
+        for leftover in (path, f"{path}.tmp"):
+            try:
+                os.remove(leftover)
+            except FileNotFoundError:
+                pass
+
+# Render every histogram in the Prometheus text format, summed over all processes when METRICS_DIR is set
+def render() -> str:
+    merged = {histogram.name: histogram.snapshot() for histogram in _histograms}
+    if METRICS_DIR and os.path.isdir(METRICS_DIR):
+        own = f"{os.getpid()}.json"
+        for name in os.listdir(METRICS_DIR):
+            if name == own or not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, name)) as file:
+                    snapshot = loads(file.read())
+            except (OSError, ValueError):
+                continue
+            _merge(merged, snapshot)
+    lines = []
+    for histogram in _histograms:
+        lines.extend(histogram.render(merged.get(histogram.name, {})))
+    return '\n'.join(lines) + '\n'
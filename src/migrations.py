@@ -0,0 +1,331 @@
+import argparse
+from typing import Callable
+import psycopg2
+from psycopg2.extensions import cursor
+from dotenv import load_dotenv
+
+from src.allocators import FeistelAllocator, SequenceAllocator
+from src.data_handling import ConnectionPool
+
+# Versioned schema migrations.
+# Each migration runs once, in its own transaction, and is recorded in schema_migrations.
+# Run `python -m src.migrations` before starting the app (the Docker image does this on start).
+
+# Arbitrary key for the advisory lock that keeps concurrent runners from applying the same migration
+LOCK_KEY = 7316425001
+
+# Version 1: the tables the app used to create at import time
+def _create_tables(cur: cursor) -> None:
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS meal_weeks (
+            week VARCHAR(10) PRIMARY KEY,
+            data JSONB NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pantry_directory (
+            id BIGINT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            category VARCHAR(255) NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pantry (
+            serial BIGINT PRIMARY KEY,
+            id BIGINT NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            category VARCHAR(255) NOT NULL,
+            ingestion_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            expiration_date DATE NOT NULL
+        )
+    """)
+
+# Version 2: sequences and keys for every ID allocator, so ID_ALLOCATOR can be switched at any time
+def _create_allocators(cur: cursor) -> None:
+    for name in ('pantry_directory_id', 'pantry_serial'):
+        FeistelAllocator(name).setup(cur.connection)
+        SequenceAllocator(name).setup(cur.connection)
+
+# Version 3: directory search indexes, the trigram index is skipped where pg_trgm is not available
+def _create_directory_search_indexes(cur: cursor) -> None:
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS pantry_directory_name_prefix_idx
+        ON pantry_directory (lower(name) text_pattern_ops)
+    """)
+    cur.execute("SAVEPOINT trigram")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS pantry_directory_name_trgm_idx
+            ON pantry_directory USING gin (lower(name) gin_trgm_ops)
+        """)
+        cur.execute("RELEASE SAVEPOINT trigram")
+    except psycopg2.Error:
+        cur.execute("ROLLBACK TO SAVEPOINT trigram")
+
+# Version 4: pantry indexes. (id, expiration_date, serial) serves item counts and FIFO removal,
+# the (column, serial) indexes serve each sort order of the paginated pantry view
+def _create_pantry_indexes(cur: cursor) -> None:
+    cur.execute("DROP INDEX IF EXISTS pantry_id_idx")
+    cur.execute("CREATE INDEX IF NOT EXISTS pantry_id_expiration_idx ON pantry (id, expiration_date, serial)")
+    cur.execute("CREATE INDEX IF NOT EXISTS pantry_expiration_idx ON pantry (expiration_date, serial)")
+    cur.execute("CREATE INDEX IF NOT EXISTS pantry_name_idx ON pantry (name, serial)")
+    cur.execute("CREATE INDEX IF NOT EXISTS pantry_category_idx ON pantry (category, serial)")
+
+# Version 5: per-table version counters, bumped by a statement trigger on every write so in-process
+# caches in any worker can tell when their table has changed
+def _create_table_versions(cur: cursor) -> None:
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name VARCHAR(64) PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO table_versions (name, version) VALUES (TG_TABLE_NAME, 1)
+            ON CONFLICT (name) DO UPDATE SET version = table_versions.version + 1;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("INSERT INTO table_versions (name) VALUES ('pantry_directory') ON CONFLICT (name) DO NOTHING")
+    cur.execute("DROP TRIGGER IF EXISTS pantry_directory_version ON pantry_directory")
+    cur.execute("""
+        CREATE TRIGGER pantry_directory_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON pantry_directory
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+    """)
+
+# Version 6: queue of background PDF render jobs, see src/jobs.py
+def _create_render_jobs(cur: cursor) -> None:
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS render_jobs (
+            id UUID PRIMARY KEY,
+            kind VARCHAR(32) NOT NULL,
+            params JSONB NOT NULL,
+            dedupe_key CHAR(64) NOT NULL UNIQUE,
+            status VARCHAR(16) NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            filename VARCHAR(255),
+            result BYTEA,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            expires_at TIMESTAMP
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS render_jobs_queued_idx ON render_jobs (created_at) WHERE status = 'queued'")
+    cur.execute("CREATE INDEX IF NOT EXISTS render_jobs_expires_idx ON render_jobs (expires_at)")
+
+# Version 7: per-item stock counts and earliest expiration, kept up to date by statement triggers on pantry.
+# Deletes lock the affected stock rows before recomputing the earliest expiration, so the recompute
+# runs on a fresh snapshot that includes any concurrent delete that committed first.
+def _create_pantry_stock(cur: cursor) -> None:
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pantry_stock (
+            id BIGINT PRIMARY KEY,
+            count BIGINT NOT NULL,
+            earliest_expiration DATE
+        )
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION pantry_stock_sync() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                DELETE FROM pantry_stock;
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                PERFORM 1 FROM pantry_stock WHERE id IN (SELECT id FROM old_rows) ORDER BY id FOR UPDATE;
+                UPDATE pantry_stock s
+                SET count = s.count - d.removed,
+                    earliest_expiration = CASE
+                        WHEN d.earliest > s.earliest_expiration THEN s.earliest_expiration
+                        ELSE (SELECT min(p.expiration_date) FROM pantry p WHERE p.id = s.id)
+                    END
+                FROM (SELECT id, count(*) AS removed, min(expiration_date) AS earliest FROM old_rows GROUP BY id) d
+                WHERE s.id = d.id;
+                DELETE FROM pantry_stock WHERE count <= 0;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO pantry_stock (id, count, earliest_expiration)
+                SELECT id, count(*), min(expiration_date) FROM new_rows GROUP BY id ORDER BY id
+                ON CONFLICT (id) DO UPDATE
+                SET count = pantry_stock.count + EXCLUDED.count,
+                    earliest_expiration = LEAST(pantry_stock.earliest_expiration, EXCLUDED.earliest_expiration);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    # Block pantry writes so none land between the backfill and the triggers
+    cur.execute("LOCK TABLE pantry IN SHARE ROW EXCLUSIVE MODE")
+    for name in ('pantry_stock_insert', 'pantry_stock_delete', 'pantry_stock_update', 'pantry_stock_truncate'):
+        cur.execute(f"DROP TRIGGER IF EXISTS {name} ON pantry")
+    cur.execute("""
+        CREATE TRIGGER pantry_stock_insert AFTER INSERT ON pantry
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION pantry_stock_sync()
+    """)
+    cur.execute("""
+        CREATE TRIGGER pantry_stock_delete AFTER DELETE ON pantry
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION pantry_stock_sync()
+    """)
+    cur.execute("""
+        CREATE TRIGGER pantry_stock_update AFTER UPDATE ON pantry
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION pantry_stock_sync()
+    """)
+    cur.execute("""
+        CREATE TRIGGER pantry_stock_truncate AFTER TRUNCATE ON pantry
+        FOR EACH STATEMENT EXECUTE FUNCTION pantry_stock_sync()
+    """)
+    cur.execute("DELETE FROM pantry_stock")
+    cur.execute("""
+        INSERT INTO pantry_stock (id, count, earliest_expiration)
+        SELECT id, count(*), min(expiration_date) FROM pantry GROUP BY id
+    """)
+
+# Version 8: ingredient index for meal weeks, one row per planned ingredient, so the weeks that use
+# an item can be found without reading every week. Backfilled from the stored weeks by the rules
+# MealDB.save_week indexes with: only lists under section names of up to 32 characters, entries whose
+# ID is 1 to 18 digits, and a quantity of 1 for bare IDs and quantities that are not 1 to 9 digits.
+def _create_meal_week_items(cur: cursor) -> None:
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS meal_week_items (
+            week VARCHAR(10) NOT NULL,
+            section VARCHAR(32) NOT NULL,
+            position INTEGER NOT NULL,
+            item_id BIGINT NOT NULL,
+            qty INTEGER NOT NULL,
+            PRIMARY KEY (week, section, position)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS meal_week_items_item_idx ON meal_week_items (item_id, week)")
+    cur.execute("LOCK TABLE meal_weeks IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute("DELETE FROM meal_week_items")
+    cur.execute("""
+        INSERT INTO meal_week_items (week, section, position, item_id, qty)
+        SELECT week, section, position, item_id::bigint, qty
+        FROM (
+            SELECT w.week,
+                   left(k.key, -length('_ingredients')) AS section,
+                   e.position - 1 AS position,
+                   CASE WHEN jsonb_typeof(e.value) = 'object' THEN e.value->>'id' ELSE e.value #>> '{}' END AS item_id,
+                   CASE WHEN e.value->>'qty' ~ '^[0-9]{1,9}$' THEN (e.value->>'qty')::int ELSE 1 END AS qty
+            FROM meal_weeks w
+            CROSS JOIN LATERAL jsonb_each(w.data) k
+            CROSS JOIN LATERAL jsonb_array_elements(
+                CASE WHEN jsonb_typeof(k.value) = 'array' THEN k.value ELSE '[]'::jsonb END
+            ) WITH ORDINALITY e(value, position)
+            WHERE k.key LIKE '%\_ingredients' AND length(k.key) - length('_ingredients') <= 32
+        ) ingredients
+        WHERE item_id ~ '^[0-9]{1,18}$'
+    """)
+
+# Version 9: pantry index for expiry windows of one category. Windows over every category and over one
+# item are served by the (expiration_date, serial) and (id, expiration_date, serial) indexes.
+def _create_pantry_category_expiration_index(cur: cursor) -> None:
+    cur.execute("CREATE INDEX IF NOT EXISTS pantry_category_expiration_idx ON pantry (category, expiration_date, serial)")
+
+# Version 10: change versions for conditional GETs. pantry gets the statement trigger of table_versions,
+# and each meal week a version that every update of its row sets from a sequence. Versions are never
+# reused, so a week deleted and saved again cannot come back with a version a browser has already seen.
+def _create_view_versions(cur: cursor) -> None:
+    cur.execute("INSERT INTO table_versions (name) VALUES ('pantry') ON CONFLICT (name) DO NOTHING")
+    cur.execute("DROP TRIGGER IF EXISTS pantry_version ON pantry")
+    cur.execute("""
+        CREATE TRIGGER pantry_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON pantry
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+    """)
+    cur.execute("CREATE SEQUENCE IF NOT EXISTS meal_weeks_version_seq")
+    cur.execute("ALTER TABLE meal_weeks ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('meal_weeks_version_seq')")
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION bump_meal_week_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := nextval('meal_weeks_version_seq');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS meal_weeks_version ON meal_weeks")
+    cur.execute("""
+        CREATE TRIGGER meal_weeks_version BEFORE UPDATE ON meal_weeks
+        FOR EACH ROW EXECUTE FUNCTION bump_meal_week_version()
+    """)
+
+# Version 11: finished job PDFs are stored uncompressed and out of line, so the result route can read
+# them in slices without detoasting the whole value for each one. PDFs are already compressed.
+def _store_job_results_external(cur: cursor) -> None:
+    cur.execute("ALTER TABLE render_jobs ALTER COLUMN result SET STORAGE EXTERNAL")
+
+MIGRATIONS: list[tuple[int, str, Callable[[cursor], None]]] = [
+    (1, "Create meal_weeks, pantry_directory and pantry", _create_tables),
+    (2, "Create ID allocator sequences", _create_allocators),
+    (3, "Index pantry_directory names for search", _create_directory_search_indexes),
+    (4, "Index pantry for counts, FIFO removal and sorting", _create_pantry_indexes),
+    (5, "Track table versions for cache invalidation", _create_table_versions),
+    (6, "Create render_jobs queue", _create_render_jobs),
+    (7, "Maintain per-item pantry stock counts", _create_pantry_stock),
+    (8, "Index meal week ingredients by item", _create_meal_week_items),
+    (9, "Index pantry expiry windows by category", _create_pantry_category_expiration_index),
+    (10, "Track pantry and meal week versions for conditional requests", _create_view_versions),
+    (11, "Store render job results uncompressed", _store_job_results_external),
+]
+
+# Get the versions already applied to the database
+def applied_versions(pool: ConnectionPool) -> set[int]:
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('schema_migrations')")
+        if cur.fetchone()[0] is None:
+            return set()
+        cur.execute("SELECT version FROM schema_migrations")
+        return {row[0] for row in cur.fetchall()}
+
+# Apply every pending migration in order, returning the versions applied
+def migrate(pool: ConnectionPool) -> list[int]:
+    applied = []
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s)", (LOCK_KEY,))
+        try:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            conn.commit()
+            done = applied_versions(pool)
+            for version, description, apply in MIGRATIONS:
+                if version in done:
+                    continue
+                apply(cur)
+                cur.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description))
+                conn.commit()
+                applied.append(version)
+        finally:
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY,))
+            conn.commit()
+    return applied
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Apply database schema migrations")
+    parser.add_argument('--status', action='store_true', help="list pending migrations without applying them")
+    args = parser.parse_args()
+
+    load_dotenv()
+    pool = ConnectionPool.from_env()
+    if args.status:
+        done = applied_versions(pool)
+        for version, description, _ in MIGRATIONS:
+            print(f"{version:>4} {'applied' if version in done else 'pending'}  {description}")
+    else:
+        applied = migrate(pool)
+        print(f"Applied migrations: {', '.join(map(str, applied))}" if applied else "Schema is up to date")
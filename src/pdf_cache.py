@@ -0,0 +1,153 @@
+from hashlib import sha256
+from json import dumps
+from typing import BinaryIO, Callable
+import os
+import tempfile
+import threading
+import time
+
+from src.metrics import RENDER_SECONDS
+
+# Generated PDFs by kind, and a content-addressed cache for them.
+# A PDF is fully described by its kind and parameters, which hold every input the renderer reads:
+# the computed shopping list (week plan and the stock counts it depends on), or the serials, item,
+# expiry, name and renderer of a label set. The key is a hash of those, so saving a week or changing
+# the pantry gives a new key and old entries simply stop being used until they are evicted.
+# The renderers import ReportLab, Pillow and python-barcode on first use, so processes that only
+# serve cached PDFs or queue jobs never load them.
+
+# Part of every key: bump it when renderers change what they draw for the same parameters, so cached
+# PDFs, finished jobs and browser copies of the old output are not served again
+PDF_VERSION = 2
+
+def _render_labels(params: dict, out: BinaryIO) -> None:
+    from src.labels import generate_labels
+    generate_labels(params['serials'], params['item_id'], params['expiration_date'], params['item_name'],
+                    params['renderer'], out)
+
+def _render_shopping_list(params: dict, out: BinaryIO) -> None:
+    from src.shopping_list import generate_shopping_list
+    generate_shopping_list(params, out)
+
+PDF_KINDS: dict[str, Callable[[dict, BinaryIO], None]] = {
+    'labels': _render_labels,
+    'shopping_list': _render_shopping_list,
+}
+
+# Write the PDF for a kind and its parameters to out
+def render_pdf(kind: str, params: dict, out: BinaryIO) -> None:
+    if kind not in PDF_KINDS:
+        raise Exception(f"Unknown PDF kind: {kind}")
+    with RENDER_SECONDS.time(kind=kind):
+        PDF_KINDS[kind](params, out)
+
+# Download name of the PDF for a kind and its parameters
+def pdf_filename(kind: str, params: dict) -> str:
+    if kind == 'labels':
+        return f"labels_{params['item_id']}.pdf"
+    return f"{kind}_{params['week']}.pdf"
+
+# Hash identifying the PDF for a kind and its parameters, also used as its ETag
+def pdf_key(kind: str, params: dict) -> str:
+    return sha256(dumps({'kind': kind, 'params': params, 'version': PDF_VERSION}, sort_keys=True).encode()).hexdigest()
+
+# PDFCache keeps generated PDFs as files named by key in a directory shared by every worker process.
+# Reads bump a file's modification time, and writes evict the least recently used files once the
+# directory grows past max_bytes. Files are written under a temporary name and renamed into place,
+# so readers in other processes never see a partial PDF.
+class PDFCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    # Build the cache from PDF_CACHE_DIR and PDF_CACHE_SIZE, or return None if PDF_CACHE_SIZE is 0
+    @classmethod
+    def from_env(cls) -> 'PDFCache | None':
+        if not (max_bytes := int(os.getenv("PDF_CACHE_SIZE", 256 * 1024 * 1024))):
+            return None
+        return cls(os.getenv("PDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), 'meal-planner-pdfs')), max_bytes)
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    # Open the cached PDF for key, or return None. An open file stays readable if it is evicted meanwhile.
+    def open(self, key: str) -> BinaryIO | None:
+        try:
+            file = open(self.__path(key), 'rb')
+        except FileNotFoundError:
+            with self.__lock:
+                self.__misses += 1
+            return None
+        try:
+            os.utime(file.fileno())
+        except OSError:
+            pass
+        with self.__lock:
+            self.__hits += 1
+        return file
+
+    # Render a PDF into the cache under key and open it
+    def put(self, key: str, render: Callable[[BinaryIO], None]) -> BinaryIO:
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                render(out)
+            os.replace(temp_path, self.__path(key))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        file = open(self.__path(key), 'rb')
+        self.__evict()
+        return file
+
+    # Open the cached PDF for key, rendering it first if it is not cached
+    def get_or_render(self, key: str, render: Callable[[BinaryIO], None]) -> BinaryIO:
+        return self.open(key) or self.put(key, render)
+
+    # Delete least recently used PDFs until the cache fits in max_bytes.
+    # Temporary files older than an hour are left over from crashed renders and are deleted too.
+    def __evict(self) -> None:
+        files = []
+        total = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith('.tmp'):
+                    if stat.st_mtime < time.time() - 3600:
+                        self.__unlink(entry.path)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if self.__unlink(path):
+                with self.__lock:
+                    self.__evictions += 1
+            total -= size
+
+    @staticmethod
+    def __unlink(path: str) -> bool:
+        try:
+            os.unlink(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    # Cache effectiveness metrics for this process
+    def stats(self) -> dict[str, int]:
+        with self.__lock:
+            return {
+                'max_bytes': self.max_bytes,
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'evictions': self.__evictions,
+            }
@@ -0,0 +1,86 @@
+from hashlib import md5
+from typing import BinaryIO
+import zlib
+
+# StreamingPDFWriter writes a PDF straight to a file, one page at a time: full-page images, or text
+# pages drawn with the standard fonts. Unlike a ReportLab canvas, which keeps every page until it is
+# saved, only the object offsets are held in memory, so writing a job of any length uses the same
+# memory as writing a single page.
+
+# Objects 1 and 2 are the page tree and catalog, written last once every page is known
+PAGES_OBJ = 1
+CATALOG_OBJ = 2
+
+# Standard fonts for text pages by resource name. They are built into every PDF viewer, so nothing is
+# embedded. Courier glyphs are all 0.6 em wide, which lines up columns without font metrics.
+FONTS = {'F1': b'Courier', 'F2': b'Helvetica-Bold'}
+
+# Content stream operators drawing a line of text with its baseline starting at x, y
+def text(x: float, y: float, font: str, size: float, string: str) -> bytes:
+    data = string.encode('cp1252', errors='replace').replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+    return b"BT /%s %.1f Tf %.2f %.2f Td (%s) Tj ET\n" % (font.encode(), size, x, y, data)
+
+class StreamingPDFWriter:
+    def __init__(self, out: BinaryIO, page_width: float, page_height: float):
+        self.out = out
+        self.page_width = page_width
+        self.page_height = page_height
+        self.__offsets: dict[int, int] = {}
+        self.__next_obj = CATALOG_OBJ + 1
+        self.__pages: list[int] = []
+        self.__images: dict[str, int] = {}
+        self.__fonts: bytes | None = None
+        self.__start = out.tell()
+        self.__write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __write(self, data: bytes) -> None:
+        self.out.write(data)
+
+    def __object(self, body: bytes, stream: bytes | None = None, number: int | None = None) -> int:
+        if number is None:
+            number = self.__next_obj
+            self.__next_obj += 1
+        self.__offsets[number] = self.out.tell() - self.__start
+        self.__write(b"%d 0 obj\n" % number + body)
+        if stream is not None:
+            self.__write(b"\nstream\n" + stream + b"\nendstream")
+        self.__write(b"\nendobj\n")
+        return number
+
+    # Add a page showing a Flate-compressed 1-bit grayscale image scaled to the full page.
+    # Identical images, such as repeated serials, are written once and shared.
+    def add_image_page(self, data: bytes, width: int, height: int) -> None:
+        key = md5(data).hexdigest()
+        if (image := self.__images.get(key)) is None:
+            image = self.__object(
+                b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray "
+                b"/BitsPerComponent 1 /Filter /FlateDecode /Length %d >>" % (width, height, len(data)), data)
+            self.__images[key] = image
+        content = b"q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q" % (self.page_width, self.page_height)
+        contents = self.__object(b"<< /Length %d >>" % len(content), content)
+        self.__pages.append(self.__object(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.4f %.4f] /Resources << /XObject << /Im0 %d 0 R >> >> "
+            b"/Contents %d 0 R >>" % (PAGES_OBJ, self.page_width, self.page_height, image, contents)))
+
+    # Add a page drawn by a content stream, which can use the FONTS by name
+    def add_text_page(self, content: bytes) -> None:
+        if self.__fonts is None:
+            self.__fonts = b" ".join(b"/%s %d 0 R" % (name.encode(), self.__object(
+                b"<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>" % base))
+                for name, base in FONTS.items())
+        data = zlib.compress(content)
+        contents = self.__object(b"<< /Length %d /Filter /FlateDecode >>" % len(data), data)
+        self.__pages.append(self.__object(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.4f %.4f] /Resources << /Font << %s >> >> "
+            b"/Contents %d 0 R >>" % (PAGES_OBJ, self.page_width, self.page_height, self.__fonts, contents)))
+
+    # Write the page tree, catalog, cross-reference table and trailer
+    def close(self) -> None:
+        kids = b" ".join(b"%d 0 R" % page for page in self.__pages)
+        self.__object(b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.__pages)), number=PAGES_OBJ)
+        self.__object(b"<< /Type /Catalog /Pages %d 0 R >>" % PAGES_OBJ, number=CATALOG_OBJ)
+        xref = self.out.tell() - self.__start
+        self.__write(b"xref\n0 %d\n0000000000 65535 f \n" % self.__next_obj)
+        for number in range(1, self.__next_obj):
+            self.__write(b"%010d 00000 n \n" % self.__offsets[number])
+        self.__write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.__next_obj, CATALOG_OBJ, xref))
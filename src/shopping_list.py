@@ -0,0 +1,121 @@
+from io import BytesIO
+from typing import BinaryIO
+import time
+
+from src.data_handling import PantryDB
+from src.metrics import RENDER_PHASE_SECONDS
+
+DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# Sum the quantity of each item ID across a list of {"id": ..., "qty": ...} ingredients,
+# keeping the order in which items first appear
+def _sum_quantities(ingredients: list[dict], totals: dict[int, int]) -> dict[int, int]:
+    for ingredient in ingredients:
+        item_id = str(ingredient.get('id', ''))
+        if not item_id.isdigit():
+            continue
+        totals[int(item_id)] = totals.get(int(item_id), 0) + int(ingredient.get('qty') or 1)
+    return totals
+
+# Build the shopping list for a saved week.
+# Demand for each item is summed over the whole week and compared against pantry stock, fetched for
+# every item in a single query. Items short on stock go on the shopping list, items whose stock
+# exactly covers the week go on the check list, and additional items are always bought.
+def build_shopping_list(week: str, week_data: dict, pdb: PantryDB) -> dict:
+    demand = {}
+    for day in DAYS:
+        _sum_quantities(week_data.get(f"{day}_ingredients", []), demand)
+    additional = _sum_quantities(week_data.get('additional_ingredients', []), {})
+
+    stock = pdb.stock_for_items(list(demand.keys() | additional.keys()))
+
+    items = []
+    check_items = []
+    for item_id, needed in demand.items():
+        if not (item := stock.get(item_id)):
+            continue
+        entry = {
+            'id': item_id,
+            'name': item['name'],
+            'needed': needed,
+            'in_stock': item['count'],
+            'shortfall': max(needed - item['count'], 0)
+        }
+        if item['count'] < needed:
+            items.append(entry)
+        elif item['count'] == needed:
+            check_items.append(entry)
+
+    additional_items = [
+        {'id': item_id, 'name': stock[item_id]['name'], 'qty': qty}
+        for item_id, qty in additional.items() if item_id in stock
+    ]
+
+    return {'week': week, 'items': items, 'check_items': check_items, 'additional_items': additional_items}
+
+# Generates a PDF shopping list for the specified week, including checkboxes for each item
+# with 2 secions, one for items to check stock and one for items to buy, and handles pagination for long lists.
+# The PDF is written to out if given, otherwise to a new in-memory buffer.
+def generate_shopping_list(shopping_list: dict, out: BinaryIO | None = None) -> BinaryIO:
+    # ReportLab is imported here rather than with the module, which the web app imports for build_shopping_list
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.units import inch
+
+    week = shopping_list['week']
+    items = [item['name'] for item in shopping_list['items'] + shopping_list['additional_items']]
+    check_items = [item['name'] for item in shopping_list['check_items']]
+
+    out = out if out is not None else BytesIO()
+    started = time.perf_counter()
+    pdf = canvas.Canvas(out, pagesize=letter)
+    pdf.setTitle(f"Shopping List - Week {week}")
+
+    y_position = 10 * inch
+
+    # Section 1: Check Item Stock
+    if len(items) > 0:
+        pdf.setFont("Helvetica-Bold", 16)
+        pdf.drawString(1 * inch, y_position, f"Shopping List - {week}")
+        y_position -= 0.5 * inch
+        pdf.setFont("Helvetica", 12)
+
+        for item in items:
+            if y_position < 1 * inch:
+                pdf.showPage()
+                y_position = 10.5 * inch
+                pdf.setFont("Helvetica", 12)
+
+            pdf.rect(0.5 * inch, y_position - 0.05 * inch, 0.15 * inch, 0.15 * inch)
+            pdf.drawString(0.8 * inch, y_position, item)
+            y_position -= 0.3 * inch
+
+        y_position -= 0.3 * inch  # Extra space between sections
+
+    # Section 2: Shopping List
+    if len(check_items) > 0:
+        if y_position < 2 * inch:
+            pdf.showPage()
+            y_position = 10.5 * inch
+
+        pdf.setFont("Helvetica-Bold", 16)
+        pdf.drawString(1 * inch, y_position, "Check Item Stock")
+        y_position -= 0.5 * inch
+        pdf.setFont("Helvetica", 12)
+
+        for item in check_items:
+            if y_position < 1 * inch:
+                pdf.showPage()
+                y_position = 10.5 * inch
+                pdf.setFont("Helvetica", 12)
+
+            pdf.rect(0.5 * inch, y_position - 0.05 * inch, 0.15 * inch, 0.15 * inch)
+            pdf.drawString(0.8 * inch, y_position, item)
+            y_position -= 0.3 * inch
+
+    RENDER_PHASE_SECONDS.observe(time.perf_counter() - started, document='shopping_list', phase='draw')
+    with RENDER_PHASE_SECONDS.time(document='shopping_list', phase='save'):
+        pdf.save()
+    out.seek(0)
+
+    return out
@@ -0,0 +1,26 @@
+import argparse
+from dotenv import load_dotenv
+
+from src.data_handling import ConnectionPool, PantryDB
+
+# Consistency check for the pantry_stock counts maintained by triggers on pantry.
+# `python -m src.stock_check` lists every item whose stored count or earliest expiration differs
+# from what pantry holds, `--repair` rewrites those rows. Exits with status 1 when drift is found
+# and not repaired, so it can run from cron or a health check.
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check pantry_stock against the pantry table")
+    parser.add_argument('--repair', action='store_true', help="rewrite the stock rows that differ")
+    args = parser.parse_args()
+
+    load_dotenv()
+    drift = PantryDB(ConnectionPool.from_env()).check_stock(repair=args.repair)
+    for row in drift:
+        print(f"{row['id']}: pantry has {row['count']} (earliest {row['earliest_expiration']}), "
+              f"stock has {row['stock_count']} (earliest {row['stock_earliest_expiration']})")
+    if not drift:
+        print("pantry_stock is consistent")
+    elif args.repair:
+        print(f"Repaired {len(drift)} item(s)")
+    else:
+        raise SystemExit(1)
@@ -0,0 +1,36 @@
+from typing import Iterator
+import pytest
+
+from benchmarks.postgres import postgres
+from benchmarks.seed import SCALES, make_pool, seed
+
+# Tests that need Postgres run against scratch databases from benchmarks/postgres.py: on the server
+# named by the DB_* environment variables when DB_HOST is set, otherwise on a private initdb cluster.
+# They are skipped when neither is available.
+
+@pytest.fixture(scope='session')
+def postgres_instance():
+    try:
+        with postgres() as instance:
+            yield instance
+    except Exception as e:
+        pytest.skip(f"Postgres not available: {e}")
+
+# An empty scratch database, as DB_* style parameters
+@pytest.fixture
+def database(postgres_instance) -> Iterator[dict[str, str]]:
+    with postgres_instance.database('test') as params:
+        yield params
+
+# A scratch database migrated and seeded at the medium benchmark scale, shared by the whole session,
+# as its DB_* style parameters and the seeded IDs, serials and weeks
+@pytest.fixture(scope='session')
+def seeded(postgres_instance) -> Iterator[tuple[dict[str, str], dict[str, list]]]:
+    from app import CATEGORIES
+    with postgres_instance.database('test') as params:
+        pool = make_pool(params)
+        try:
+            data = seed(pool, SCALES['medium'], CATEGORIES)
+        finally:
+            pool.close()
+        yield params, data
@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import random
+import pytest
+
+from benchmarks.postgres import connect
+from src.allocators import ID_MAX, ID_MIN, ID_SPACE, FeistelAllocator, make_allocator
+
+# Allocators must never hand out an ID twice, whichever threads and processes ask, and every ID must
+# be a 10-digit number so it prints as a barcode.
+
+KINDS = ['feistel', 'sequence']
+
+# Request sizes cross the 1000-counter blocks of FeistelAllocator, in both directions
+SIZES = [1, 7, 999, 1, 1000, 2500, 3, 1001, 250]
+
+def _allocate_all(allocator, params: dict[str, str]) -> list[int]:
+    conn = connect(params)
+    try:
+        ids = []
+        for n in SIZES:
+            ids += allocator.allocate(conn, n)
+            conn.commit()
+        return ids
+    finally:
+        conn.close()
+
+# Allocator the parent shares with its forked children
+_inherited = None
+
+# Run in forked children: one allocator inherited from the parent, which may hold part of a block,
+# and one built in the child
+def _allocate_in_child(kind: str, params: dict[str, str]) -> list[int]:
+    return _allocate_all(_inherited, params) + _allocate_all(make_allocator(kind, 'test_id'), params)
+
+def _check(ids: list[int], expected: int) -> None:
+    assert len(ids) == expected
+    assert len(set(ids)) == len(ids), "duplicate IDs"
+    assert all(ID_MIN <= i <= ID_MAX and len(str(i)) == 10 for i in ids)
+
+@pytest.fixture(params=KINDS)
+def allocator(request, database):
+    allocator = make_allocator(request.param, 'test_id')
+    conn = connect(database)
+    try:
+        allocator.setup(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    return request.param, allocator, database
+
+def test_threads_get_unique_ids(allocator):
+    kind, shared, params = allocator
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: _allocate_all(shared, params), range(8)))
+    _check([i for ids in results for i in ids], 8 * sum(SIZES))
+
+def test_processes_get_unique_ids(allocator):
+    global _inherited
+    kind, shared, params = allocator
+    # The parent takes part of a block before forking, so the children inherit its position
+    parent_ids = _allocate_all(shared, params)
+    _inherited = shared
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        results = pool.starmap(_allocate_in_child, [(kind, params)] * 4)
+    _check(parent_ids + [i for ids in results for i in ids], 9 * sum(SIZES))
+
+def test_permute_is_a_bijection(database):
+    allocator = FeistelAllocator('test_id')
+    conn = connect(database)
+    try:
+        allocator.setup(conn)
+        allocator.allocate(conn, 1)  # loads the permutation key
+    finally:
+        conn.close()
+    rng = random.Random(0)
+    counters = set(range(50_000)) | set(range(ID_SPACE - 50_000, ID_SPACE))
+    counters |= {rng.randrange(ID_SPACE) for _ in range(50_000)}
+    ids = [allocator.permute(counter) for counter in counters]
+    _check(ids, len(counters))
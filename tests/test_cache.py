@@ -0,0 +1,57 @@
+import threading
+
+from src.cache import LRUCache, MISSING
+
+# A value loaded from the database while another thread invalidates the cache must not be cached,
+# or later reads would get the old row under the new version.
+
+def test_put_after_validate_is_dropped():
+    version = 1
+    cache = LRUCache(10, lambda: version, check_interval=0)
+    loaded = threading.Event()
+    validated = threading.Event()
+
+    # Thread A misses, reads the row at version 1, then waits for B before caching it
+    def reader():
+        assert cache.get('k') is MISSING
+        generation = cache.generation()
+        row = 'old'
+        loaded.set()
+        validated.wait(5)
+        cache.put('k', row, generation)
+
+    # Thread B writes version 2 and validates the cache against it while A holds the old row
+    def writer():
+        nonlocal version
+        loaded.wait(5)
+        version = 2
+        cache.clear()
+        cache.validate(version)
+        validated.set()
+
+    threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.get('k') is MISSING
+    cache.put('k', 'new', cache.generation())
+    assert cache.get('k') == 'new'
+
+def test_put_after_version_change_is_dropped():
+    version = 1
+    cache = LRUCache(10, lambda: version, check_interval=0)
+    assert cache.get('k') is MISSING
+    generation = cache.generation()
+    version = 2
+    assert cache.get('other') is MISSING
+    cache.put('k', 'old', generation)
+    assert cache.get('k') is MISSING
+
+def test_put_without_invalidation_is_kept():
+    cache = LRUCache(10, lambda: 1, check_interval=0)
+    assert cache.get('k') is MISSING
+    generation = cache.generation()
+    assert cache.get('other') is MISSING
+    cache.put('k', None, generation)
+    assert cache.get('k') is None
@@ -0,0 +1,55 @@
+from itertools import groupby
+import pytest
+
+from src.labels import BAR_HEIGHT, BAR_TOP, ITEM_BARCODE_Y, RENDERERS, SERIAL_BARCODE_Y, WIDTH, generate_labels
+from barcode.charsets.code128 import CODES, START_CODES
+
+pdfium = pytest.importorskip('pypdfium2')
+
+# Every label renderer must print barcodes that scan as the serial and item ID on the label. Pages are
+# rasterized at the label's own 300 DPI and a row through the middle of each barcode is decoded as Code128.
+
+SERIALS = ['1000000000', '5829301746', '9999999999']
+ITEM_ID = '4206981337'
+
+PATTERNS = {pattern: value for value, pattern in enumerate(CODES)}
+START = {code: charset for charset, code in START_CODES.items()}
+SWITCH = {99: 'C', 100: 'B', 101: 'A'}
+
+# Decode the Code128 symbol crossing the label row at y, from the first dark pixel to the last
+def decode_row(page, y: int) -> str:
+    dark = [page.getpixel((x, y)) < 128 for x in range(WIDTH)]
+    first, last = dark.index(True), WIDTH - dark[::-1].index(True)
+    runs = [len(list(run)) for _, run in groupby(dark[first:last])]
+    # Each symbol is 3 bars and 3 spaces over 11 modules, the stop symbol 4 bars and 3 spaces over 13
+    if (len(runs) - 7) % 6:
+        raise Exception(f"{len(runs)} bars and spaces do not make whole symbols")
+    module = (last - first) / ((len(runs) - 7) // 6 * 11 + 13)
+    bits = ''.join(('1' if i % 2 == 0 else '0') * max(1, round(run / module)) for i, run in enumerate(runs))
+    values = [PATTERNS.get(bits[i:i + 11]) for i in range(0, len(bits) - 13, 11)]
+    if None in values or bits[-13:] != '1100011101011':
+        raise Exception(f"Not a Code128 symbol: {bits}")
+    start, *data, check = values
+    if (start + sum(i * value for i, value in enumerate(data, 1))) % 103 != check:
+        raise Exception("Bad Code128 check digit")
+    charset, text = START[start], ''
+    for value in data:
+        # In code set C, 99 is the digits 99 rather than a switch to C
+        if value in SWITCH and SWITCH[value] != charset:
+            charset = SWITCH[value]
+        elif charset == 'C':
+            text += f"{value:02d}"
+        elif value < 64 or (charset == 'B' and value < 95):
+            text += chr(value + 32)
+        else:
+            raise Exception("Control codes are not supported")
+    return text
+
+@pytest.mark.parametrize('renderer', sorted(RENDERERS))
+def test_barcodes_scan(renderer):
+    pdf = pdfium.PdfDocument(generate_labels(SERIALS, ITEM_ID, '2027-01-01', 'Canned beans', renderer).getvalue())
+    assert len(pdf) == len(SERIALS)
+    for serial, page in zip(SERIALS, pdf):
+        image = page.render(scale=300 / 72).to_pil().convert('L')
+        assert decode_row(image, SERIAL_BARCODE_Y + BAR_TOP + BAR_HEIGHT // 2) == serial
+        assert decode_row(image, ITEM_BARCODE_Y + BAR_TOP + BAR_HEIGHT // 2) == ITEM_ID
@@ -0,0 +1,86 @@
+from typing import Iterator
+import pytest
+
+from benchmarks.seed import make_pool
+from src.data_handling import ConnectionPool, MealDB
+from src.migrations import _create_meal_week_items, migrate
+
+# Saving a week writes only the fields that changed, and keeps the meal_week_items index in step with
+# the saved ingredient lists by the same rules as its migration backfill, whatever the form sent.
+
+WEEK = '2026-W40'
+
+@pytest.fixture
+def pool(database) -> Iterator[ConnectionPool]:
+    pool = make_pool(database)
+    migrate(pool)
+    try:
+        yield pool
+    finally:
+        pool.close()
+
+def _index(pool: ConnectionPool) -> list[tuple]:
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT week, section, position, item_id, qty FROM meal_week_items ORDER BY 1, 2, 3")
+        rows = cur.fetchall()
+        conn.rollback()
+        return rows
+
+def test_save_writes_only_changed_fields(pool):
+    mdb = MealDB(pool)
+    week = {'monday_lunch': 'Soup', 'monday_ingredients': [{'id': '1000000001', 'qty': 2}]}
+    assert sorted(mdb.save_week(WEEK, week)) == ['monday_ingredients', 'monday_lunch']
+    version = mdb.week_version(WEEK)[0]
+    assert mdb.save_week(WEEK, week) == []
+    assert mdb.week_version(WEEK)[0] == version
+    assert mdb.save_week(WEEK, {'tuesday_lunch': 'Salad'}) == ['tuesday_lunch']
+    assert mdb.week_version(WEEK)[0] != version
+    assert mdb.load_week(WEEK) == {**week, 'tuesday_lunch': 'Salad'}
+
+def test_index_follows_saved_lists(pool):
+    mdb = MealDB(pool)
+    mdb.save_week(WEEK, {
+        'monday_ingredients': [{'id': '1000000001', 'qty': 2}, {'id': '1000000002', 'qty': '3'}],
+        'additional_ingredients': ['1000000001'],
+    })
+    assert _index(pool) == [
+        (WEEK, 'additional', 0, 1000000001, 1),
+        (WEEK, 'monday', 0, 1000000001, 2),
+        (WEEK, 'monday', 1, 1000000002, 3),
+    ]
+    mdb.save_week(WEEK, {'monday_ingredients': [{'id': '1000000002', 'qty': 1}]})
+    assert _index(pool) == [
+        (WEEK, 'additional', 0, 1000000001, 1),
+        (WEEK, 'monday', 0, 1000000002, 1),
+    ]
+    assert mdb.weeks_using_item(1000000001) == [{'week': WEEK, 'sections': ['additional'], 'qty': 1}]
+
+def test_index_skips_malformed_input(pool):
+    mdb = MealDB(pool)
+    mdb.save_week(WEEK, {
+        'foo_ingredients': '123',
+        f"{'x' * 40}_ingredients": [{'id': '5', 'qty': 1}],
+        'monday_ingredients': [
+            {'id': '²'}, {'id': '1' * 19}, {'id': '42', 'qty': 2 ** 31}, {'id': '43', 'qty': '3'}, '44', None,
+        ],
+    })
+    assert _index(pool) == [
+        (WEEK, 'monday', 2, 42, 1),
+        (WEEK, 'monday', 3, 43, 3),
+        (WEEK, 'monday', 4, 44, 1),
+    ]
+
+# The backfill rebuilds exactly the rows save_week wrote
+def test_backfill_matches_save(pool):
+    mdb = MealDB(pool)
+    mdb.save_week(WEEK, {
+        'monday_ingredients': [{'id': '42', 'qty': 2 ** 31}, {'id': '43', 'qty': 0}, '44', {'id': '²'}],
+        'tuesday_ingredients': 'not a list',
+        f"{'x' * 40}_ingredients": [{'id': '5'}],
+    })
+    mdb.save_week('2026-W41', {'additional_ingredients': [{'id': '1000000001', 'qty': '7'}]})
+    saved = _index(pool)
+    with pool.connection() as conn, conn.cursor() as cur:
+        _create_meal_week_items(cur)
+        conn.commit()
+    assert _index(pool) == saved
@@ -0,0 +1,110 @@
+from datetime import date, timedelta
+from functools import lru_cache
+from typing import Callable
+from psycopg2.extensions import cursor
+import pytest
+
+from benchmarks.postgres import connect
+from benchmarks.seed import make_pool
+from src import data_handling
+from src.data_handling import PantryDB, PantryDirectoryDB
+from src.metrics import TimedConnection
+
+# Query plan regression tests: every statement the pantry data layer issues is captured with its
+# parameters while it runs against the seeded database, then EXPLAINed. A sequential scan of pantry
+# or pantry_directory means a statement has lost the index it was written for.
+
+SCANNED_TABLES = {'pantry', 'pantry_directory'}
+
+# Operations that read the whole pantry on purpose, so a sequential scan is the right plan
+WHOLE_TABLE = {'get_all_items', 'check_stock'}
+
+# Operations whose substring matches need the trigram index, only created where pg_trgm is available
+NEEDS_TRIGRAM = {'directory search'}
+
+_statements: list[str] = []
+
+@lru_cache(maxsize=None)
+def _recording_cursor(base: type) -> type:
+    class RecordingCursor(base):
+        def execute(self, query, vars=None):
+            _statements.append(self.mogrify(query, vars).decode())
+            return super().execute(query, vars)
+    return RecordingCursor
+
+class RecordingConnection(TimedConnection):
+    def cursor(self, *args, **kwargs):
+        kwargs['cursor_factory'] = _recording_cursor(kwargs.get('cursor_factory') or self.cursor_factory or cursor)
+        return super().cursor(*args, **kwargs)
+
+def _expiry_report(pdb: PantryDB, **filters) -> None:
+    with pdb.expiry_report(None, date.today() + timedelta(days=7), **filters) as report:
+        list(report['items'])
+        list(report['units'])
+
+# (name, call) pairs covering every PantryDB statement, and the directory lookups the app makes per request
+CASES: list[tuple[str, Callable[[PantryDB, PantryDirectoryDB, dict], object]]] = [
+    ('add_items', lambda pdb, pddb, data: pdb.add_items(pddb, data['items'][0], '2030-01-01', 3)),
+    ('item_count', lambda pdb, pddb, data: pdb.item_count(data['items'][0])),
+    ('next_expiration', lambda pdb, pddb, data: pdb.next_expiration(data['items'][0])),
+    ('stock_for_items', lambda pdb, pddb, data: pdb.stock_for_items(data['items'][:20])),
+    ('check_stock', lambda pdb, pddb, data: pdb.check_stock()),
+    ('remove_item', lambda pdb, pddb, data: pdb.remove_item(data['serials'][-1])),
+    ('checkout', lambda pdb, pddb, data: pdb.checkout([data['serials'][-2]], [(data['items'][1], 2)])),
+    ('expiry_report', lambda pdb, pddb, data: _expiry_report(pdb)),
+    ('expiry_report category', lambda pdb, pddb, data: _expiry_report(pdb, category='Dairy')),
+    ('expiry_report item', lambda pdb, pddb, data: _expiry_report(pdb, item_id=data['items'][0])),
+    ('get_all_items', lambda pdb, pddb, data: pdb.get_all_items()),
+    ('get_page', lambda pdb, pddb, data: pdb.get_page()),
+    ('get_page next', lambda pdb, pddb, data: pdb.get_page(after=pdb.get_page()['next'])),
+    ('get_page name', lambda pdb, pddb, data: pdb.get_page(sort='name')),
+    ('get_page category', lambda pdb, pddb, data: pdb.get_page(sort='category', category='Dairy')),
+    ('get_page expiring', lambda pdb, pddb, data: pdb.get_page(expires_from=str(date.today()),
+                                                               expires_to=str(date.today() + timedelta(days=7)))),
+    ('get_page search', lambda pdb, pddb, data: pdb.get_page(search='toma')),
+    ('get_item_by_serial', lambda pdb, pddb, data: pdb.get_item_by_serial(data['serials'][0])),
+    ('remove_oldest_by_id', lambda pdb, pddb, data: pdb.remove_oldest_by_id(data['items'][2])),
+    ('directory get_item_by_id', lambda pdb, pddb, data: pddb.get_item_by_id(data['items'][3])),
+    ('directory get_items_by_ids', lambda pdb, pddb, data: pddb.get_items_by_ids(data['items'][3:30])),
+    ('directory search', lambda pdb, pddb, data: pddb.search('fresh')),
+]
+
+# Relations read by a sequential scan anywhere in a JSON plan
+def _seq_scans(plan: dict) -> set[str]:
+    found = {plan['Relation Name']} if plan['Node Type'] == 'Seq Scan' else set()
+    for child in plan.get('Plans', []):
+        found |= _seq_scans(child)
+    return found
+
+@pytest.fixture(scope='module')
+def layer(seeded):
+    params, data = seeded
+    patch = pytest.MonkeyPatch()
+    patch.setattr(data_handling, 'TimedConnection', RecordingConnection)
+    pool = make_pool(params)
+    try:
+        yield PantryDB(pool), PantryDirectoryDB(pool), data, params
+    finally:
+        pool.close()
+        patch.undo()
+
+@pytest.mark.parametrize('name, call', CASES, ids=[name for name, _ in CASES])
+def test_statements_use_indexes(layer, name, call):
+    pdb, pddb, data, params = layer
+    _statements.clear()
+    call(pdb, pddb, data)
+    statements = [sql for sql in _statements if sql.lstrip().split(None, 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')]
+    assert statements, f"{name} issued no statements"
+    conn = connect(params)
+    try:
+        with conn.cursor() as cur:
+            if name in NEEDS_TRIGRAM:
+                cur.execute("SELECT to_regclass('pantry_directory_name_trgm_idx')")
+                if cur.fetchone()[0] is None:
+                    pytest.skip("pg_trgm is not available, so substring searches scan the directory")
+            for sql in statements:
+                cur.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+                scanned = _seq_scans(cur.fetchone()[0][0]['Plan']) & SCANNED_TABLES
+                assert name in WHOLE_TABLE or not scanned, f"{name} scans {', '.join(sorted(scanned))} sequentially:\n{sql}"
+    finally:
+        conn.close()